@@ -0,0 +1,197 @@
+'''
+On-disk cache for compiler artifacts.
+
+Entries are content-addressed: the key of an entry is a
+structural hash (see digest) of everything it was computed from,
+so changing the policy, assumptions, ports, topology or demands
+simply selects a different entry. Stale entries are evicted by
+age and by the total size of the cache directory.
+'''
+
+from snap.lang import Policy
+from snap.util import frozendict, EthAddr
+from ipaddr import IPv4Network, IPv4Address
+import hashlib
+import os
+import pickle
+import tempfile
+import time
+
+# bump when the format of cached artifacts changes
+CACHE_VERSION = 3
+
+default_cache_dir = os.path.expanduser('~/.snap_cache')
+
+#########################################
+#####        Structural hash        #####
+#########################################
+
+def digest(x, memo=None):
+    '''
+    returns a hex sha1 of the structure of x. Policies and other
+    objects are hashed by class and attributes, dicts and sets
+    independently of their order, and networkx graphs by their
+    nodes and edges along with their data.
+    '''
+    if memo is None:
+        memo = {}
+    if id(x) in memo:
+        return memo[id(x)][0]
+
+    typ = type(x)
+    if x is None or typ in (bool, int, long, float, str, unicode):
+        parts = [typ.__name__, repr(x)]
+    elif isinstance(x, (IPv4Network, IPv4Address, EthAddr)):
+        parts = [typ.__name__, str(x)]
+    elif isinstance(x, (tuple, list)):
+        parts = [typ.__name__] + [digest(y, memo) for y in x]
+    elif isinstance(x, (set, frozenset)):
+        parts = ['set'] + sorted([digest(y, memo) for y in x])
+    elif isinstance(x, (dict, frozendict)):
+        if isinstance(x, frozendict):
+            x = x._dict
+        parts = ['dict'] + sorted([digest(k, memo) + digest(v, memo)
+                                        for (k, v) in x.items()])
+    elif hasattr(x, 'adj') and hasattr(x, 'is_directed'):
+        # networkx graph
+        nodes = dict(x.nodes(data=True))
+        edges = []
+        for (u, v, d) in x.edges(data=True):
+            end_points = [digest(u, memo), digest(v, memo)]
+            if not x.is_directed():
+                end_points.sort()
+            edges.append(''.join(end_points) + digest(d, memo))
+        parts = [typ.__name__, digest(nodes, memo)] + sorted(edges)
+    elif isinstance(x, Policy) or hasattr(x, '__dict__'):
+        parts = [typ.__module__, typ.__name__, digest(vars(x), memo)]
+    else:
+        raise TypeError('can not hash %s' % typ)
+
+    res = hashlib.sha1('\0'.join(parts)).hexdigest()
+    # keeps x alive so its id is not reused while hashing
+    memo[id(x)] = (res, x)
+    return res
+
+#########################################
+#####             Cache             #####
+#########################################
+
+class CompileCache(object):
+    '''
+    a directory of cached artifacts, one file per entry,
+    named <key>.<kind>. Reading an entry refreshes its
+    time stamp, so eviction drops the least recently used.
+    '''
+
+    def __init__(self, path=default_cache_dir,
+                 max_bytes=1 << 30, max_age=30 * 24 * 3600):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def key(self, *parts):
+        return digest((CACHE_VERSION,) + parts)
+
+    def entry(self, kind, key):
+        return os.path.join(self.path, '%s.%s' % (key, kind))
+
+    def entries(self):
+        '''
+        the file names of the entries in the cache, leaving out
+        the temporary files of entries still being written
+        '''
+        res = []
+        for name in os.listdir(self.path):
+            (key, _, kind) = name.partition('.')
+            if len(key) == 40 and kind and kind != 'tmp':
+                res.append(os.path.join(self.path, name))
+        return res
+
+    def get(self, kind, key, load=pickle.load):
+        '''
+        returns the entry read by load, or None if there is no
+        such entry (or it could not be read)
+        '''
+        fname = self.entry(kind, key)
+        try:
+            f = open(fname, 'rb')
+        except IOError:
+            self.misses += 1
+            return None
+        try:
+            res = load(f)
+        except Exception:
+            res = None
+        finally:
+            f.close()
+        if res is None:
+            self.misses += 1
+            self.remove(fname)
+            return None
+        self.hits += 1
+        os.utime(fname, None)
+        return res
+
+    def put(self, kind, key, value, dump=None):
+        ''' writes value with dump (pickle by default) and evicts '''
+        if dump is None:
+            dump = lambda v, f: pickle.dump(v, f, pickle.HIGHEST_PROTOCOL)
+        (fd, tmp) = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        f = os.fdopen(fd, 'wb')
+        try:
+            dump(value, f)
+        except:
+            f.close()
+            self.remove(tmp)
+            raise
+        f.close()
+        os.rename(tmp, self.entry(kind, key))
+        self.evict()
+
+    def remove(self, fname):
+        try:
+            os.remove(fname)
+        except OSError:
+            pass
+
+    def evict(self, max_bytes=None, max_age=None):
+        '''
+        removes entries older than max_age seconds, then the
+        least recently used ones until the cache is at most
+        max_bytes. Returns the number of bytes freed.
+        '''
+        if max_bytes is None:
+            max_bytes = self.max_bytes
+        if max_age is None:
+            max_age = self.max_age
+
+        entries = []
+        for fname in self.entries():
+            try:
+                st = os.stat(fname)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, fname))
+        entries.sort()
+
+        now = time.time()
+        total = sum([size for (_, size, _) in entries])
+        freed = 0
+        for (mtime, size, fname) in entries:
+            if ((max_age is None or now - mtime <= max_age) and
+                (max_bytes is None or total - freed <= max_bytes)):
+                break
+            self.remove(fname)
+            freed += size
+        return freed
+
+    def clear(self):
+        for fname in self.entries():
+            self.remove(fname)
+
+    def stats(self):
+        return {'hits' : self.hits, 'misses' : self.misses}
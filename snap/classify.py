@@ -0,0 +1,171 @@
+'''
+Batch classification of packets through an FDD with NumPy.
+
+Packets are given as columns: a dict from field names to equal
+length arrays. IPv4 fields hold addresses as integers (uint32),
+MAC fields integers and other fields numbers (or any values
+NumPy compares with ==). Instead of walking the FDD once per
+packet, each node is visited once, parents before children,
+with the indices of the packets reaching it: its test is
+evaluated on all of them as an array mask and the packets are
+split between its children. The FDD is walked in its
+frozen form (see fdd.FrozenFDD).
+'''
+
+from snap.fdd import (Leaf, FVTest, FFTest, STest, FrozenFDD, freeze, 
+                      postorder, type_dict)
+from snap.util import EthAddr
+from ipaddr import IPv4Network, IPv4Address
+import numpy as np
+
+def leaf_list(fdd):
+    ''' the leaves of fdd, in the order classify_batch numbers them '''
+    if isinstance(fdd, FrozenFDD):
+        return list(reversed(fdd.leaves))
+    return [d for d in reversed(list(postorder(fdd))) if isinstance(d, Leaf)]
+
+def to_number(v):
+    ''' the column representation of the FDD value v '''
+    if isinstance(v, IPv4Network):
+        return int(v.ip)
+    if isinstance(v, EthAddr):
+        return int(v.to_bytes().encode('hex'), 16)
+    if isinstance(v, bool):
+        return int(v)
+    return v
+
+def is_field(e):
+    return isinstance(e, str) and e in type_dict
+
+def column(headers, f, idx):
+    if not f in headers:
+        raise KeyError('no column for field %s' % f)
+    return np.asarray(headers[f])[idx]
+
+def test_mask(t, headers, idx, state, tables):
+    ''' whether t holds for each of the packets idx '''
+    if isinstance(t, FVTest):
+        col = column(headers, t.lh, idx)
+        if isinstance(t.rh, IPv4Network):
+            mask = int(t.rh.netmask)
+            return (col.astype(np.int64) & mask) == int(t.rh.network)
+        return col == to_number(t.rh)
+    elif isinstance(t, FFTest):
+        return column(headers, t.lh, idx) == column(headers, t.rh, idx)
+    elif isinstance(t, STest):
+        return state_mask(t, headers, idx, state, tables)
+    raise TypeError
+
+def state_table(mapping):
+    '''
+    returns the entries of mapping (a dict, or a lang.StateMapping)
+    by their keys in column representation, and its default value
+    '''
+    if hasattr(mapping, 'default_value'):
+        (entries, default) = (mapping.mapping, mapping.default_value)
+    else:
+        (entries, default) = (mapping, None)
+    res = dict([(tuple([to_number(x) for x in key]), value)
+                    for (key, value) in entries.iteritems()])
+    return (res, default)
+
+def state_mask(t, headers, idx, state, tables):
+    '''
+    whether the state test t holds for each of the packets idx,
+    with the values of state[t.var][key] (state is for instance 
+    a lang.PolicyState, or a dict of dicts). tables keeps the 
+    state_table of each variable, which is read once for each 
+    distinct key among the packets.
+    '''
+    if state is None:
+        raise KeyError('no state for %s' % t.var)
+    if not t.var in tables:
+        tables[t.var] = state_table(state[t.var])
+    (table, default) = tables[t.var]
+
+    cols = [column(headers, e, idx) for e in t.index if is_field(e)]
+    if len(cols) == 0:
+        inverse = np.zeros(len(idx), dtype=np.intp)
+        rows = [()]
+    else:
+        try:
+            (rows, inverse) = np.unique(np.stack(cols, axis=1), axis=0,
+                                        return_inverse=True)
+            rows = rows.tolist()
+        except TypeError:
+            # values NumPy can not order (such as strings)
+            key_index = {}
+            inverse = np.empty(len(idx), dtype=np.intp)
+            rows = []
+            for (i, r) in enumerate(zip(*cols)):
+                if not r in key_index:
+                    key_index[r] = len(rows)
+                    rows.append(r)
+                inverse[i] = key_index[r]
+
+    values = []
+    for r in rows:
+        r = iter(r)
+        key = tuple([next(r) if is_field(e) else to_number(e) for e in t.index])
+        values.append(table.get(key, default))
+
+    found = np.array([not v is None for v in values], dtype=bool)
+    res = found[inverse]
+    for (j, e) in enumerate(t.rh):
+        if is_field(e):
+            vals = np.array([to_number(v[j]) if not v is None else 0
+                                for v in values])
+            res &= vals[inverse] == column(headers, e, idx)
+        else:
+            eq = np.array([not v is None and v[j] == e for v in values], dtype=bool)
+            res &= eq[inverse]
+    return res
+
+def classify_batch(fdd, headers, state=None):
+    '''
+    returns, for each packet in headers, the index of the leaf
+    of fdd (an FDD or a FrozenFDD) it reaches in leaf_list(fdd). 
+    State tests are answered from state (see state_mask).
+    '''
+    if not isinstance(fdd, FrozenFDD):
+        fdd = freeze(fdd)
+    sizes = set([len(headers[f]) for f in headers])
+    if len(sizes) > 1:
+        raise ValueError('header columns of different lengths')
+    n = sizes.pop() if len(sizes) > 0 else 0
+    res = np.empty(n, dtype=np.intp)
+    # frozen nodes are in postorder, so going down the
+    # indices visits parents before children
+    pending = [None] * len(fdd)
+    pending[fdd.root] = [np.arange(n)]
+    num_leaves = 0
+    tables = {}
+    (test_id, lo, hi) = (fdd.test_id, fdd.lo, fdd.hi)
+    for i in xrange(fdd.root, -1, -1):
+        parts = pending[i]
+        pending[i] = None
+        if parts is None:
+            idx = np.arange(0)
+        else:
+            idx = parts[0] if len(parts) == 1 else np.concatenate(parts)
+        if test_id[i] < 0:
+            res[idx] = num_leaves
+            num_leaves += 1
+            continue
+        if len(idx) == 0:
+            continue
+        mask = test_mask(fdd.tests[test_id[i]], headers, idx, state, tables)
+        for (c, part) in ((lo[i], idx[mask]), (hi[i], idx[~mask])):
+            if pending[c] is None:
+                pending[c] = []
+            pending[c].append(part)
+    return res
+
+def leaf_shares(fdd, headers, state=None):
+    '''
+    returns the fraction of the packets in headers
+    reaching each leaf of fdd, in leaf_list order
+    '''
+    res = classify_batch(fdd, headers, state)
+    counts = np.bincount(res, minlength=len(leaf_list(fdd)))
+    return counts / float(max(len(res), 1))
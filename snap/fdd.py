@@ -4,9 +4,18 @@ from snap.lang import (identity, drop, match, modify, matchState,
                                     sequential, intersection, if_)
 from ipaddr import IPv4Network
 from snap.util import MAC
-from collections import Iterable
+from snap.cache import digest as policy_digest
+from collections import Iterable, deque
+from functools import wraps
+from multiprocessing import Pool
+import array
+import bisect
 import copy
+import hashlib
 import itertools 
+import resource
+import sys
+import time
 
 type_dict = copy.copy(td)
 type_dict['id'] = str
@@ -23,15 +32,117 @@ type_dict['frametype'] = int
 type_dict['apptype'] = int
 
 
-field_rank = {'dstip' : 0, 'srcport' : 1, 'srcip' : 2, 'inport' : 3}
+default_field_rank = {'dstip' : 0, 'srcport' : 1, 'srcip' : 2, 'inport' : 3}
+field_rank = dict(default_field_rank)
 state_rank = {}
 
+# unique table for hash-consing: maps the structure of a node
+# to the only FDD object with that structure
+unique_table = {}
+
+# interned tests, in the order they were interned. 
+# Tests are hashed by their id (test.tid), which are 
+# not reused (see collect).
+test_table = []
+test_index = {}
+test_ids = itertools.count()
+
+# interned tests sorted by test order, with their order keys.
+# test.rank is an integer consistent with this order, so 
+# tests are compared with a single integer comparison.
+test_order = []
+test_order_keys = []
+rank_gap = 1 << 32
+
+# interned action sets of leaves, in the order they were interned
+action_table = []
+action_index = {}
+action_ids = itertools.count()
+
+# leaves by the (unrefined) action set they are built from,
+# so that each distinct action set is refined once
+leaf_index = {}
+
+# the id and drop leaves, see id_leaf and drop_leaf
+leaf_singletons = {}
+
+# if set, n-ary parallel and sequential compositions are
+# translated by pairwise (balanced) reduction of the 
+# translated sub-policies instead of a left to right fold
+balanced_reduction = True
+
+# FDDs specialized to inports (see specialize_inports) by
+# FDD and assumptions
+inport_fdds = {}
+
+# next id for the new nodes of the FDDs specialized from each
+# FDD, whatever the assumptions, so that their ids are unique
+inport_ids = {}
+
+# FDDIndex of each FDD indexed by fdd_index
+fdd_indexes = {}
+
+# number of times the tables were reset, so that FDDs kept
+# across compilations can tell if they are still in the tables
+tables_generation = 0
+
+# operation caches of FDDTranslator, by operation name
+op_caches = {}
+op_cache_size = 1 << 17
+
+# FDDs with more nodes than this are reordered by sift
+# after translation. None turns it off.
+sift_threshold = None
+
+# sift stops moving a field in one direction once the FDD
+# is this many times larger than the smallest one seen
+sift_max_growth = 1.2
+
+# chains of at least this many equality tests of a field
+# become Switch nodes after translation (see to_switches).
+# None keeps the FDDs binary.
+switch_min_cases = 4
+
+def reset_tables():
+    '''
+    clears the unique table, the test and action set tables,
+    the operation caches and the roots (see collect). 
+    Should be called at the beginning
+    of each compilation as test order (state_rank) may change.
+    FDDs built before keep referring to their own tests
+    and action sets.
+    '''
+    global tables_generation
+    tables_generation += 1
+    unique_table.clear()
+    del test_table[:]
+    test_index.clear()
+    del test_order[:]
+    del test_order_keys[:]
+    del action_table[:]
+    action_index.clear()
+    leaf_index.clear()
+    leaf_singletons.clear()
+    inport_fdds.clear()
+    inport_ids.clear()
+    fdd_indexes.clear()
+    roots.clear()
+    for cache in op_caches.values():
+        cache.clear()
+
+def get_cache_stats():
+    return dict([(name, cache.stats()) for (name, cache) in op_caches.items()])
+
 def is_number(x):
     return isinstance(x, (int, long, float, complex))
 
 def is_iterable(x):
     return isinstance(x, (list, tuple)) and not isinstance(x, str)
 
+def is_prefix(x):
+    ''' whether x is an IPv4 prefix other than a single address '''
+    return isinstance(x, IPv4Network) and x.prefixlen < x.max_prefixlen
+
 def literal_cmp(e1, e2):
     '''
     compares e1 and e2, reversing
@@ -66,15 +177,109 @@ def literal_cmp(e1, e2):
                 return cmp(field_rank[e2], field_rank[e1])
             return cmp(e1, e2) ##TODO: can use fields order here
 
+def field_key(f):
+    '''
+    sort key of field f in the test order. Fields in 
+    field_rank come after (closer to the root of the FDD
+    than) the other fields, which are ordered by name.
+    '''
+    if f in field_rank:
+        return (1, -field_rank[f])
+    return (0, f)
+
+def literal_key(e):
+    '''
+    sort key version of literal_cmp, except that fields
+    are ordered by field_key so that the order is total
+    '''
+    if is_iterable(e):
+        return (0, -len(e), tuple([literal_key(x) for x in e]))
+    elif is_number(e):
+        return (3, -e)
+    elif isinstance(e, str):
+        return (1, field_key(e))
+    else:
+        # IPv4Networks compare by network, then prefix length, 
+        # so prefixes are tested before the prefixes they are in
+        return (2, e)
+
+def rank_test(t):
+    '''
+    inserts the newly interned test t in test_order
+    and sets its rank between the ranks of its neighbors,
+    renumbering all the tests if there is no gap left.
+    '''
+    key = t.order_key()
+    pos = bisect.bisect(test_order_keys, key)
+    low = test_order[pos - 1].rank if pos > 0 else 0
+    high = test_order[pos].rank if pos < len(test_order) else (len(test_order) + 2) * rank_gap
+    test_order_keys.insert(pos, key)
+    test_order.insert(pos, t)
+    if high - low > 1:
+        t.rank = (low + high) / 2
+    else:
+        for (i, x) in enumerate(test_order):
+            x.rank = (i + 1) * rank_gap
+
+def rerank_tests():
+    '''
+    recomputes the order of all interned tests, 
+    should be called after field_rank or state_rank change.
+    '''
+    order = sorted([(t.order_key(), t) for t in test_table], key=lambda x : x[0])
+    test_order_keys[:] = [k for (k, _) in order]
+    test_order[:] = [t for (_, t) in order]
+    for (i, t) in enumerate(test_order):
+        t.rank = (i + 1) * rank_gap
+
 #########################################
 #####             FDD               #####
 #########################################
 
+class HashConsed(type):
+    '''
+    metaclass for FDD nodes. Constructing a node that is
+    structurally equal to an existing one returns the 
+    existing object, so equality of FDDs is identity.
+    '''
+
+    def __call__(cls, *args):
+        key = cls.unique_key(*args)
+        if key is None:
+            fdd = super(HashConsed, cls).__call__(*args)
+            key = fdd.unique_key_of()
+        else:
+            fdd = None
+        res = unique_table.get(key)
+        if res is None:
+            if fdd is None:
+                fdd = super(HashConsed, cls).__call__(*args)
+            unique_table[key] = fdd
+            res = fdd
+        return res
+
+class InternedLeaf(HashConsed):
+    '''
+    metaclass for leaves. Leaves are also looked up by 
+    the action set they are constructed with, so that
+    the action set is refined only the first time.
+    '''
+
+    def __call__(cls, act_set):
+        if not isinstance(act_set, frozenset):
+            act_set = frozenset(act_set)
+        res = leaf_index.get(act_set)
+        if res is None:
+            res = super(InternedLeaf, cls).__call__(act_set)
+            leaf_index[act_set] = res
+        return res
+
 class FDD(object):
-    
+    __metaclass__ = HashConsed
+    __slots__ = ['id']
+
     def __init__(self):
         self.id = None
-        self.string = None
 
     def set_id(self, new_id, x=None):
         if self.id is None:
@@ -83,9 +288,21 @@ class FDD(object):
     def get_id(self):
         return self.id
 
-    def level_repr(self, acc, shift):
+    def children(self):
+        raise NotImplementedError
+
+    def level_line(self, shift):
         raise NotImplementedError
 
+    def level_repr(self, acc, shift):
+        stack = [(self, shift)]
+        while stack:
+            (d, shift) = stack.pop()
+            acc.append(d.level_line(shift))
+            for c in reversed(d.children()):
+                stack.append((c, shift + '\t'))
+        return acc
+
     def __str__(self):
         return str(self.string)
         
@@ -94,25 +311,327 @@ class FDD(object):
         lrepr = self.level_repr([], '')
         return '\n'.join(lrepr) + "\n\n-------------------\n"
 
-    def __hash__(self):
-        return hash(str(self))
+    def classify_batch(self, headers, state=None):
+        ''' see classify.classify_batch, needs NumPy '''
+        from snap.classify import classify_batch
+        return classify_batch(self, headers, state)
+
+    @classmethod
+    def unique_key(cls, *args):
+        '''
+        key of the node in the unique table computed from
+        the constructor arguments, None if the node has to
+        be built first (see unique_key_of)
+        '''
+        return None
+
+    def unique_key_of(self):
+        raise NotImplementedError
+
+#########################################
+#####           Traversal           #####
+#########################################
+# FDDs are DAGs after hash-consing and can be much deeper 
+# than the recursion limit, so passes over them use 
+# explicit stacks and visit each shared node once.
+
+def preorder(fdd, prune=None):
+    '''
+    yields each node of the fdd once, parents before 
+    children and left children first. If prune(d) holds,
+    the children of d are not visited (through d).
+    '''
+    seen = set()
+    stack = [fdd]
+    while stack:
+        d = stack.pop()
+        if d in seen:
+            continue
+        seen.add(d)
+        yield d
+        if prune is None or not prune(d):
+            stack.extend(reversed(d.children()))
+
+def postorder(fdd):
+    '''
+    yields each node of the fdd once, 
+    children before parents
+    '''
+    seen = set()
+    stack = [(fdd, False)]
+    while stack:
+        (d, expanded) = stack.pop()
+        if expanded:
+            yield d
+        elif not d in seen:
+            seen.add(d)
+            stack.append((d, True))
+            for c in reversed(d.children()):
+                if not c in seen:
+                    stack.append((c, False))
+
+def map_fdd(fdd, leaf_fun, node_fun, switch_fun=None):
+    '''
+    rebuilds the fdd bottom-up: leaves are mapped by leaf_fun 
+    and nodes by node_fun(node, new_lchild, new_rchild). 
+    Switches are mapped by switch_fun(switch, new_cases, 
+    new_default), or to a switch on the same field with the
+    new children if it is None. Shared nodes are mapped once.
+    '''
+    res = {}
+    for d in postorder(fdd):
+        if isinstance(d, Node):
+            res[d] = node_fun(d, res[d.lchild], res[d.rchild])
+        elif isinstance(d, Leaf):
+            res[d] = leaf_fun(d)
+        elif isinstance(d, Switch):
+            cases = [(v, res[c]) for (v, c) in d.cases]
+            if switch_fun is None:
+                res[d] = switch(d.field, cases, res[d.default])
+            else:
+                res[d] = switch_fun(d, cases, res[d.default])
+        else:
+            raise TypeError
+    return res[fdd]
+
+def binary_nodes(fdd):
+    '''
+    yields (d, test, lchild, rchild) for the nodes of fdd in
+    postorder, test being None for leaves. Switches are 
+    yielded as their chain of tests (see Switch.chain): d is 
+    the switch for the top of the chain and (switch, i) for
+    the i-th test from the bottom, so that the chain does not
+    have to be built.
+    '''
+    for d in postorder(fdd):
+        if isinstance(d, Node):
+            yield (d, d.test, d.lchild, d.rchild)
+        elif isinstance(d, Leaf):
+            yield (d, None, None, None)
+        elif isinstance(d, Switch):
+            chain = d.chain()
+            below = d.default
+            for (i, (t, c)) in enumerate(chain):
+                key = d if i == len(chain) - 1 else (d, i)
+                yield (key, t, c, below)
+                below = key
+        else:
+            raise TypeError
+
+#########################################
+#####         Serialization         #####
+#########################################
+
+def test_to_tuple(t):
+    if isinstance(t, FVTest):
+        return ('FV', t.lh, t.rh)
+    elif isinstance(t, FFTest):
+        return ('FF', t.lh, t.rh)
+    elif isinstance(t, STest):
+        return ('S', t.lh, t.rh)
+    raise TypeError
+
+def tuple_to_test(x):
+    (kind, lh, rh) = x
+    if kind == 'FV':
+        return FVTest(lh, rh)
+    elif kind == 'FF':
+        return FFTest(lh, rh)
+    elif kind == 'S':
+        return STest(lh, rh)
+    raise TypeError
+
+def action_to_tuple(a):
+    if isinstance(a, FAction):
+        return ('F', a.lh, a.rh)
+    elif isinstance(a, SAction):
+        return ('S', a.lh, a.rh)
+    elif isinstance(a, SInc):
+        return ('I', a.lh, a.step)
+    raise TypeError
+
+def tuple_to_action(x):
+    (kind, lh, rh) = x
+    if kind == 'F':
+        return FAction(lh, rh)
+    elif kind == 'S':
+        return SAction(lh, rh)
+    elif kind == 'I':
+        return SInc(lh, rh)
+    raise TypeError
+
+def to_tables(fdd):
+    '''
+    flattens the fdd into plain tuples:
+    tests: (kind, lh, rh) for each distinct test
+    act_sets: each distinct action set, as a tuple of 
+              action sequences of (kind, lh, rh) actions
+    nodes: in postorder (the root is last), 
+           (test index, lchild index, rchild index) for nodes 
+           and (-1, action set index, -1) for leaves
+    Switches are written as their chains of tests.
+    '''
+    tests = []
+    test_ids = {}
+    act_sets = []
+    act_set_ids = {}
+    nodes = []
+    node_ids = {}
+    for (d, t, lchild, rchild) in binary_nodes(fdd):
+        if not t is None:
+            if not t in test_ids:
+                test_ids[t] = len(tests)
+                tests.append(test_to_tuple(t))
+            entry = (test_ids[t], node_ids[lchild], node_ids[rchild])
+        else:
+            if not d.acts in act_set_ids:
+                act_set_ids[d.acts] = len(act_sets)
+                act_sets.append(tuple([tuple([action_to_tuple(a) for a in act_seq]) 
+                                                for act_seq in d.act_set]))
+            entry = (-1, act_set_ids[d.acts], -1)
+        node_ids[d] = len(nodes)
+        nodes.append(entry)
+    return (tuple(tests), tuple(act_sets), tuple(nodes))
+
+def from_tables(tables):
+    ''' rebuilds (and hash-conses) an fdd flattened by to_tables '''
+    (tests, act_sets, nodes) = tables
+    tests = [tuple_to_test(x) for x in tests]
+    act_sets = [frozenset([tuple([tuple_to_action(a) for a in act_seq]) 
+                            for act_seq in act_set]) 
+                    for act_set in act_sets]
+    res = []
+    for (ti, l, r) in nodes:
+        if ti < 0:
+            res.append(Leaf(act_sets[l]))
+        else:
+            res.append(Node(tests[ti], res[l], res[r]))
+    return res[-1]
+
+class FrozenFDD(object):
+    '''
+    read-only FDD as parallel arrays, indexed by node in 
+    postorder (children before parents, the root last):
+    test_id[i]: index of the test of node i in tests, -1 for leaves
+    lo[i], hi[i]: the children of node i where the test holds
+                  (lchild) and where it does not, -1 for leaves
+    leaf_id[i]: index of leaf i in leaves, -1 for nodes
+    Walking the arrays by index avoids chasing the FDD objects.
+    Switches are stored as their chains of tests.
+    Frozen FDDs pickle to plain tuples and arrays, tests and 
+    leaves are interned again in the tables of the reader.
+    '''
+
+    def __init__(self, fdd):
+        self.tests = []
+        self.leaves = []
+        self.test_id = array.array('i')
+        self.lo = array.array('i')
+        self.hi = array.array('i')
+        self.leaf_id = array.array('i')
+        test_ids = {}
+        leaf_ids = {}
+        node_ids = {}
+        for (d, t, lchild, rchild) in binary_nodes(fdd):
+            if not t is None:
+                if not t in test_ids:
+                    test_ids[t] = len(self.tests)
+                    self.tests.append(t)
+                self.test_id.append(test_ids[t])
+                self.lo.append(node_ids[lchild])
+                self.hi.append(node_ids[rchild])
+                self.leaf_id.append(-1)
+            else:
+                leaf_ids[d] = len(self.leaves)
+                self.leaves.append(d)
+                self.test_id.append(-1)
+                self.lo.append(-1)
+                self.hi.append(-1)
+                self.leaf_id.append(leaf_ids[d])
+            node_ids[d] = len(node_ids)
+
+    def __len__(self):
+        return len(self.test_id)
+
+    @property
+    def root(self):
+        return len(self.test_id) - 1
+
+    def is_leaf(self, i):
+        return self.test_id[i] < 0
+
+    def test(self, i):
+        return self.tests[self.test_id[i]]
+
+    def leaf(self, i):
+        return self.leaves[self.leaf_id[i]]
+
+    def thaw(self):
+        ''' rebuilds the fdd in the current tables '''
+        res = []
+        for i in range(len(self)):
+            if self.is_leaf(i):
+                res.append(self.leaf(i))
+            else:
+                res.append(Node(self.test(i), res[self.lo[i]], res[self.hi[i]]))
+        return res[-1]
+
+    def share(self):
+        '''
+        moves the arrays to shared memory, so that worker
+        processes forked afterwards read them without copies
+        '''
+        from multiprocessing.sharedctypes import RawArray
+        for name in ('test_id', 'lo', 'hi', 'leaf_id'):
+            setattr(self, name, RawArray('i', getattr(self, name)))
+        return self
+
+    def __getstate__(self):
+        arrays = [array.array('i', getattr(self, name)) 
+                    for name in ('test_id', 'lo', 'hi', 'leaf_id')]
+        tests = [test_to_tuple(t) for t in self.tests]
+        leaves = [tuple([tuple([action_to_tuple(a) for a in act_seq])
+                            for act_seq in d.act_set])
+                    for d in self.leaves]
+        return (tests, leaves, arrays)
+
+    def __setstate__(self, st):
+        (tests, leaves, arrays) = st
+        self.tests = [tuple_to_test(x) for x in tests]
+        self.leaves = [Leaf(frozenset([tuple([tuple_to_action(a) for a in act_seq])
+                                            for act_seq in act_set]))
+                        for act_set in leaves]
+        (self.test_id, self.lo, self.hi, self.leaf_id) = arrays
+
+def freeze(fdd):
+    ''' returns fdd as a FrozenFDD '''
+    return FrozenFDD(fdd)
 
 def asgn_id(fdd, num):
     '''
     traverses the fdd, setting fdd.id
     for each intermediate node and leaf 
-    to a unique number
+    to a unique number (in-order)
     '''
-
-    if not fdd.id is None:
-        return num
-    if isinstance(fdd, Node):
-        num = asgn_id(fdd.lchild, num)
-        fdd.set_id(num)
-        num = asgn_id(fdd.rchild, num + 1)
-    elif isinstance(fdd, Leaf):
-        fdd.set_id(num, 1)
-        num += 1
+    stack = [(fdd, False)]
+    while stack:
+        (d, expanded) = stack.pop()
+        if expanded:
+            d.set_id(num)
+            num += 1
+        elif d.id is None:
+            if isinstance(d, Node):
+                stack.append((d.rchild, False))
+                stack.append((d, True))
+                stack.append((d.lchild, False))
+            elif isinstance(d, Switch):
+                stack.append((d.default, False))
+                stack.append((d, True))
+                for (_, c) in reversed(d.cases):
+                    stack.append((c, False))
+            elif isinstance(d, Leaf):
+                d.set_id(num, 1)
+                num += 1
     return num
 
 #TODO: what is this exactly doing? I know why it is here but what exactly?
@@ -149,6 +668,8 @@ def asgn_smod(fdd):
 #########################################
 
 class Node(FDD):
+    __slots__ = ['test', 'lchild', 'rchild', 'string']
+
     def __init__(self, test, lchild, rchild):
         assert issubclass(test.__class__, Test)
         assert issubclass(lchild.__class__, FDD)
@@ -159,27 +680,192 @@ class Node(FDD):
         self.rchild = rchild
         self.set_string()
 
+    @classmethod
+    def unique_key(cls, test, lchild, rchild):
+        # children are already hash-consed, so they
+        # are hashed and compared by identity
+        return (test, lchild, rchild)
+
     def set_string(self):
         self.string = 1 + self.rchild.string + self.lchild.string
         return
 
-    def level_repr(self, acc, shift):
-        acc.append(shift + str(self.id) + ": " + self.test.__repr__())
-        acc = (self.lchild.level_repr(acc, shift + '\t'))
-        acc = (self.rchild.level_repr(acc, shift + '\t')) 
-        return acc
+    def children(self):
+        return (self.lchild, self.rchild)
 
-    def __eq__(self, other):
-        return (type(self) == type(other) and
-                self.test == other.test and
-                self.lchild == other.lchild and
-                self.rchild == other.rchild)
+    def level_line(self, shift):
+        return shift + str(self.id) + ": " + self.test.__repr__()
 
     def __repr__(self):
         return self.test.__repr__()
 
+class Switch(FDD):
+    '''
+    multi-way node on the value of a field: packets with the
+    value of one of the cases go to its child, the others to
+    default. It stands for the chain of equality tests of the 
+    field (see chain), which the translation works on. Cases 
+    are (value, child) pairs ordered by value, built by switch.
+    '''
+    __slots__ = ['field', 'cases', 'default', 'table', 'string']
+
+    def __init__(self, field, cases, default):
+        super(Switch, self).__init__()
+        self.field = field
+        self.cases = cases
+        self.default = default
+        self.table = dict(cases)
+        self.set_string()
+
+    @classmethod
+    def unique_key(cls, field, cases, default):
+        return (cls, field, cases, default)
+
+    def set_string(self):
+        self.string = 1 + self.default.string + sum([c.string for (_, c) in self.cases])
+
+    def children(self):
+        return tuple([c for (_, c) in self.cases]) + (self.default,)
+
+    def child(self, v):
+        ''' the child taken by packets whose field is v '''
+        return self.table.get(v, self.default)
+
+    def chain(self):
+        ''' (test, child) of each case, in test order from the bottom '''
+        res = [(FVTest(self.field, v), c) for (v, c) in self.cases]
+        res.sort(key=lambda x : x[0].rank)
+        return res
+
+    def expand(self):
+        ''' the switch as a chain of nodes '''
+        res = expand_cache.get(self)
+        if res is None:
+            res = self.default
+            for (t, c) in self.chain():
+                res = Node(t, c, res)
+            expand_cache.put(self, res)
+        return res
+
+    def level_line(self, shift):
+        values = ', '.join([repr(v) for (v, _) in self.cases])
+        return shift + str(self.id) + ": " + self.field + " in [" + values + "]"
+
+    def __repr__(self):
+        return 'switch(%s)' % self.field
+
+def switch(field, cases, default):
+    '''
+    returns the Switch on field with cases, a list of 
+    (value, child) with distinct values, and default.
+    Cases going to default are left out, and default is
+    returned if there is no case left.
+    '''
+    cases = [(v, c) for (v, c) in cases if not c is default]
+    if len(cases) == 0:
+        return default
+    cases.sort(key=lambda x : literal_key(x[0]))
+    return Switch(field, tuple(cases), default)
+
+def to_switches(fdd, min_cases=None):
+    '''
+    returns fdd with each chain of at least min_cases 
+    (switch_min_cases by default) equality tests of a field
+    against values (not prefixes), linked by the edges where
+    they do not hold, replaced by a Switch. Only the chains
+    reached from the root are followed, from their top.
+    '''
+    if min_cases is None:
+        min_cases = switch_min_cases
+    if min_cases is None:
+        return fdd
+
+    def is_case(d, f):
+        return (isinstance(d, Node) and isinstance(d.test, FVTest) and 
+                d.test.lh == f and not is_prefix(d.test.rh))
+
+    def plan(d):
+        if isinstance(d, Switch):
+            return (d.field, list(d.cases), d.default)
+        if is_case(d, d.test.lh):
+            f = d.test.lh
+            cases = []
+            values = set()
+            while is_case(d, f) and not d.test.rh in values:
+                cases.append((d.test.rh, d.lchild))
+                values.add(d.test.rh)
+                d = d.rchild
+            if (isinstance(d, Switch) and d.field == f and 
+                values.isdisjoint(d.table)):
+                cases.extend(d.cases)
+                d = d.default
+            if len(cases) >= min_cases:
+                return (f, cases, d)
+        return None
+
+    memo = {}
+    plans = {}
+    stack = [(fdd, False)]
+    while stack:
+        (d, expanded) = stack.pop()
+        if d in memo:
+            continue
+        if isinstance(d, Leaf):
+            memo[d] = d
+            continue
+        if not d in plans:
+            plans[d] = plan(d)
+        p = plans[d]
+        if p is None:
+            children = d.children()
+        else:
+            children = [c for (_, c) in p[1]] + [p[2]]
+        if not expanded:
+            stack.append((d, True))
+            for c in reversed(children):
+                stack.append((c, False))
+        elif p is None:
+            memo[d] = Node(d.test, memo[d.lchild], memo[d.rchild])
+        else:
+            (f, cases, default) = p
+            memo[d] = switch(f, [(v, memo[c]) for (v, c) in cases], memo[default])
+    return memo[fdd]
+
+def expand_switches(fdd):
+    ''' returns fdd with its switches expanded to chains of nodes '''
+    def switch_fun(d, cases, default):
+        res = switch(d.field, cases, default)
+        return res.expand() if isinstance(res, Switch) else res
+    return map_fdd(fdd, lambda l : l, 
+                   lambda n, lchild, rchild : Node(n.test, lchild, rchild),
+                   switch_fun)
+
+class InternedTest(type):
+    '''
+    metaclass for tests. Tests are interned in test_table
+    and addressed by a small integer id, so equal tests 
+    are the same object.
+    '''
+
+    def __call__(cls, lh, rh):
+        key = (cls, lh, rh)
+        res = test_index.get(key)
+        if res is None:
+            res = super(InternedTest, cls).__call__(lh, rh)
+            res.tid = next(test_ids)
+            test_table.append(res)
+            test_index[key] = res
+            rank_test(res)
+        return res
 
 class Test(object):
+    '''
+    Tests are totally ordered by their rank: FVTests come
+    after FFTests which come after STests, and greater tests
+    are placed closer to the root of the FDD.
+    '''
+    __metaclass__ = InternedTest
+    __slots__ = ['lh', 'rh', 'tid', 'rank']
 
     def __init__(self, lh, rh):
         self.lh = lh
@@ -187,39 +873,36 @@ class Test(object):
         
     
     def __eq__(self, other):
-        return (type(self) == type(other) and
-                self.lh == other.lh and
-                self.rh == other.rh)
+        return self is other
+
+    def __ne__(self, other):
+        return not self is other
+
+    def __hash__(self):
+        return self.tid
 
     def __cmp__(self, other):
-        raise NotImplementedError 
+        return cmp(self.rank, other.rank)
+
+    def order_key(self):
+        raise NotImplementedError
     
 class FVTest(Test):
+    __slots__ = []
     
     def __init__(self, lh, rh):
         assert lh in type_dict
         assert isinstance(rh, type_dict[lh])
         super(FVTest, self).__init__(lh, rh)
 
-    def __cmp__(self, other):
-        if self == other:
-            return 0
-        
-        if isinstance(other, FFTest) or isinstance(other, STest):
-            return 1
-
-        if not isinstance(other, FVTest):
-            return -1
-
-        if self.lh == other.lh:
-            return literal_cmp(self.rh, other.rh)
-        else:
-            return literal_cmp(self.lh, other.lh)
+    def order_key(self):
+        return (2, field_key(self.lh), literal_key(self.rh))
     
     def __repr__(self):
         return '(%s = %s)' % (str(self.lh), str(self.rh))
 
 class FFTest(Test):
+    __slots__ = []
     
     def __init__(self, lh, rh):
         assert lh in type_dict and rh in type_dict
@@ -228,28 +911,14 @@ class FFTest(Test):
         super(FFTest, self).__init__(lh, rh)
 
     
-    def __cmp__(self, other):
-        if self == other:
-            return 0
-        
-        if isinstance(other, FVTest): 
-            return -1
-        
-        if isinstance(other, STest):
-            return 1
-
-        if not isinstance(other, FFTest):
-            return -1
-
-        if self.lh == other.lh:
-            return literal_cmp(self.rh, other.rh)
-        else:
-            return literal_cmp(self.lh, other.lh)
+    def order_key(self):
+        return (1, field_key(self.lh), field_key(self.rh))
 
     def __repr__(self):
         return '(%s = %s)' % (str(self.lh), str(self.rh))
 
 class STest(Test):
+    __slots__ = ['var', 'index', 'smods']
    
     def __init__(self, lh, rh):
         assert isinstance(lh, tuple) and len(lh) == 2
@@ -259,22 +928,13 @@ class STest(Test):
         self.index = lh[1]
         self.smods = {}
     
-    def __cmp__(self, other):
-        if self == other:
-            return 0
-        
-        if isinstance(other, FVTest) or isinstance(other, FFTest):
-            return -1
-
-        if not isinstance(other, STest):
-            return -1
-
-        if self.lh == other.lh:
-            return literal_cmp(self.rh, other.rh)
-        elif self.var == other.var:
-            return literal_cmp(self.index, other.index)
+    def order_key(self):
+        # variables missing from state_rank come first, by name
+        if self.var in state_rank:
+            var_key = (1, -state_rank[self.var])
         else:
-            return literal_cmp(state_rank[self.var], state_rank[other.var])
+            var_key = (0, self.var)
+        return (0, var_key, literal_key(self.index), literal_key(self.rh))
 
     def __repr__(self):
         index_str = ','.join([str(x) for x in self.index])
@@ -284,18 +944,51 @@ class STest(Test):
 #####           Actions             #####
 #########################################
 
+class ActionSet(object):
+    '''
+    refined action set of a leaf, interned in action_table.
+    act_info: see Leaf.refine_act_set
+    port_state_dict: see Leaf.get_port_state_dict
+    '''
+    __slots__ = ['aid', 'act_set', 'act_info', 'port_state_dict']
+
+    def __init__(self, aid, act_set, act_info):
+        self.aid = aid
+        self.act_set = act_set
+        self.act_info = act_info
+        self.port_state_dict = None
+
+def intern_action_set(act_set, act_info):
+    res = action_index.get(act_set)
+    if res is None:
+        res = ActionSet(next(action_ids), act_set, act_info)
+        action_table.append(res)
+        action_index[act_set] = res
+    return res
+
 class Leaf(FDD):
+    __metaclass__ = InternedLeaf
+    __slots__ = ['acts']
+    
+    # size of the FDD
+    string = 1
 
     def __init__(self, act_set):
         super(Leaf, self).__init__()
         if len(act_set) == 0:
             raise TypeError
-        self.act_set, self.act_info = self.refine_act_set(act_set)
-        self.port_state_dict = None
-        self.string = 1
-        
-        ## for assump
-        self.assump_trace = None
+        self.acts = intern_action_set(*self.refine_act_set(act_set))
+
+    def unique_key_of(self):
+        return self.acts
+
+    @property
+    def act_set(self):
+        return self.acts.act_set
+
+    @property
+    def act_info(self):
+        return self.acts.act_info
  
     def refine_act_set(self, act_set):
         '''TODO: more refinement on neutral same field
@@ -377,24 +1070,25 @@ class Leaf(FDD):
 
             
             if id_needed and not concrete_act_seen:
-                ref_act_seq.append(FAction('id', 'id'))
+                ref_act_seq.append(id_action)
             if len(ref_act_seq) > 0:
                 ref_act_seq = tuple(ref_act_seq)
                 ref_act_set.add(ref_act_seq)
                 act_info[ref_act_seq] = (fmap, smods)
         return frozenset(ref_act_set), act_info
             
-    def level_repr(self, acc, shift):
-        acc.append(shift + self.__repr__())
-        #acc.append(shift + str(self.assump_trace))
-        return acc
+    def children(self):
+        return ()
+
+    def level_line(self, shift):
+        return shift + self.__repr__()
 
     def get_port_state_dict(self):
         '''
         Returns a dictionary from outports with its 
         corresponding set of actions and state modifications
         '''
-        if self.port_state_dict is None:
+        if self.acts.port_state_dict is None:
             res = {}
             for act_seq in self.act_info:
                 fmap, smods = self.act_info[act_seq]
@@ -414,19 +1108,19 @@ class Leaf(FDD):
                 sorted_st = sorted(smods_dict.items(), lambda x,y : cmp(state_rank[x[0]], state_rank[y[0]])) # TODO: is this necessary?
                 sorted_st = zip(*sorted_st)
                 res[outport] += (sorted_st,)
-            self.port_state_dict = res 
-        return self.port_state_dict
+            self.acts.port_state_dict = res 
+        return self.acts.port_state_dict
 
     def seq(self, other, T):
         #TODO: can use T to refine more
         res = None
         for act_seq1 in self.act_set:
-            if act_seq1[-1] == FAction('drop', 'drop'):
+            if act_seq1[-1] == drop_action:
                 new_leaf = Leaf(self.act_set)
             else:
                 new_act_set = set()
                 for act_seq2 in other.act_set:
-                    if (act_seq2[0] == FAction('drop', 'drop') and
+                    if (act_seq2[0] == drop_action and
                             len(self.act_info[act_seq1][1]) == 0): #there are no state modifications
                         new_act_set.add(act_seq2)
                     else:
@@ -439,11 +1133,7 @@ class Leaf(FDD):
         return res
 
     def is_drop(self):
-        if len(self.act_set) == 1:
-            (act, ) = self.act_set
-            if len(act) == 1 and act[0] == FAction('drop', 'drop'):
-                return True
-        return False
+        return self is drop_leaf()
 
     def par(self, other, T):
         if self.is_drop():
@@ -470,14 +1160,10 @@ class Leaf(FDD):
             print self.act_set
             raise TypeError
         (act, ) = self.act_set
-        if act[0] == FAction('id', 'id'):
-            a = FAction('drop', 'drop')
-            new_leaf = Leaf(frozenset([(a,)]))
-            return new_leaf
-        elif act[0] == FAction('drop', 'drop'):
-            a = FAction('id', 'id')
-            new_leaf = Leaf(frozenset([(a,)]))
-            return new_leaf
+        if act[0] == id_action:
+            return drop_leaf()
+        elif act[0] == drop_action:
+            return id_leaf()
         else:
             print self.act_set
             raise TypeError
@@ -491,13 +1177,6 @@ class Leaf(FDD):
                 res.add(fmap['outport'])
         return res
 
-    def __eq__(self, other):
-        res = isinstance(other, Leaf) and self.act_set == other.act_set
-        return res 
-
-    def __hash__(self):
-        return hash(self.act_set)
-
     def __repr__(self):
 
         def tuple_repr(l):
@@ -509,6 +1188,7 @@ class Leaf(FDD):
         return res
 
 class Action(object):
+    __slots__ = ['lh', 'rh']
 
     def __init__(self, lh, rh):
         super(Action, self).__init__()
@@ -536,6 +1216,8 @@ class Action(object):
             return literal_cmp(self.lh, other.lh)
 
 class FAction(Action):
+    __slots__ = []
+
     def __init__(self, lh, rh):
         assert lh in type_dict
         assert isinstance(rh, type_dict[lh])
@@ -546,7 +1228,27 @@ class FAction(Action):
         return '%s <- %s' % (str(self.lh), str(self.rh))
 
 
+id_action = FAction('id', 'id')
+drop_action = FAction('drop', 'drop')
+
+def id_leaf():
+    ''' the (shared) leaf of identity '''
+    res = leaf_singletons.get('id')
+    if res is None:
+        res = Leaf(frozenset([(id_action,)]))
+        leaf_singletons['id'] = res
+    return res
+
+def drop_leaf():
+    ''' the (shared) leaf of drop '''
+    res = leaf_singletons.get('drop')
+    if res is None:
+        res = Leaf(frozenset([(drop_action,)]))
+        leaf_singletons['drop'] = res
+    return res
+
 class SAction(Action):
+    __slots__ = ['var', 'index']
 
     def __init__(self, lh, rh):
         assert isinstance(lh, tuple) and len(lh) == 2
@@ -560,6 +1262,8 @@ class SAction(Action):
         return '%s[%s] <- %s' % (self.var, index_str, str(self.rh))
 
 class SInc(Action):
+    __slots__ = ['var', 'index', 'step']
+
     def __init__(self, lh, step):
         assert isinstance(lh, tuple) and len(lh) == 2
         assert isinstance(lh[0], str) and isinstance(lh[1], tuple)
@@ -585,17 +1289,39 @@ class ContradictionError(Exception):
 class RedundentError(Exception):
     def __init__(self, k, v):
         message = '%s already set to %s' % (str(k), str(v))
-        super(ContradictionError, self).__init__(message)
+        super(RedundentError, self).__init__(message)
+
+# keys of Traces are sums of SHA-1 digests of their constraints
+key_modulus = 1 << 160
+
+def fact_digest(fact):
+    ''' digest of a constraint of a Trace, as an integer '''
+    return int(hashlib.sha1(repr(fact)).hexdigest(), 16)
+
+def neq_digest(f, e):
+    return fact_digest(('neq', f, (type(e).__name__, e)))
 
 class Trace(dict):
     '''
-    If any of the fields in an equality set have a value,
-    all of them will be assigned that value in the dictionary.
-    There may be some fields that have equal values in the dictionary
-    and are not in each other's equality sets.
+    Constraints on the fields of the packet along a path of the FDD:
+    equalities between fields, kept as a union-find forest over the 
+    fields (parent), values of the equality classes (value, by the 
+    root of the class) and inequalities of each field with 
+    other fields and values (neq_dict).
+    Values of IPv4Network type are prefixes: a field with value
+    (or a test against) a prefix is only known to be in it.
+    As prefixes are either nested or disjoint, the prefixes a
+    field is in come down to the most specific one, and it
+    is not in any prefix nested in one it is not in
+    (neq_prefixes keeps those, by field).
+    Every change is recorded in trail, so the trace can be rolled
+    back to an earlier checkpoint. Path compression is recorded
+    too, so that rolling back a union leaves no stale parents.
+    key is the key of the constraints (see fingerprint): the sum
+    of the digests of the equality classes (with their members,
+    kept by root in members, and value) and of the inequalities,
+    updated by each change and restored by rollback.
     Invariant: no contradiction in the trace itself
-    if a field equality or inequality is added, both sides are updates in
-    corresponding dictionaries
     '''
     EQ = 0
     NEQ = 1
@@ -604,111 +1330,309 @@ class Trace(dict):
     FIELD = 3
     VALUE = 4
 
+    # kinds of trail entries
+    PARENT = 0
+    RANK = 1
+    SET_VALUE = 2
+    NEQ_ADD = 3
+    NEQ_PREFIX_ADD = 4
+    KEY = 5
+    MEMBERS = 6
+    NEQ_REMOVE = 7
+    NEQ_PREFIX_REMOVE = 8
+
+    # old value of a class that had none
+    missing = object()
+
     def __init__(self):
         super(Trace, self).__init__()
-        self.fmap = {}
-        self.eq_sets = {}
+        self.parent = {}
+        self.rank = {}
+        self.value = {}
         self.neq_dict = {}
-        self.fields = type_dict.keys()
+        self.neq_prefixes = {}
+        self.members = {}
+        self.key = 0
+        self.trail = []
+        self.fields = set(type_dict)
+
+    def checkpoint(self):
+        return len(self.trail)
+
+    def rollback(self, mark):
+        ''' undoes the changes made since checkpoint mark '''
+        trail = self.trail
+        while len(trail) > mark:
+            (kind, x, old) = trail.pop()
+            if kind == Trace.PARENT:
+                if old is None:
+                    del self.parent[x]
+                else:
+                    self.parent[x] = old
+            elif kind == Trace.RANK:
+                self.rank[x] = old
+            elif kind == Trace.SET_VALUE:
+                if old is Trace.missing:
+                    del self.value[x]
+                else:
+                    self.value[x] = old
+            elif kind == Trace.NEQ_ADD:
+                self.neq_dict[x].discard(old)
+            elif kind == Trace.NEQ_PREFIX_ADD:
+                self.neq_prefixes[x].discard(old)
+            elif kind == Trace.KEY:
+                self.key = old
+            elif kind == Trace.NEQ_REMOVE:
+                self.neq_dict[x].add(old)
+            elif kind == Trace.NEQ_PREFIX_REMOVE:
+                self.neq_prefixes[x].add(old)
+            elif old is None:
+                del self.members[x]
+            else:
+                self.members[x] = old
+
+    @staticmethod
+    def relation(w, v):
+        '''
+        whether a field that is (in) w is (in) v:
+        EQ if it is, NEQ if it is not, BOTH if it depends
+        '''
+        if w == v:
+            return Trace.EQ
+        if isinstance(w, IPv4Network) and isinstance(v, IPv4Network):
+            if w in v:
+                return Trace.EQ
+            elif v in w:
+                return Trace.BOTH
+        return Trace.NEQ
+
+    def find(self, f):
+        parent = self.parent
+        if not f in parent:
+            return f
+        root = parent[f]
+        while root in parent:
+            root = parent[root]
+        while f != root:
+            p = parent[f]
+            if p != root:
+                self.trail.append((Trace.PARENT, f, p))
+                parent[f] = root
+            f = p
+        return root
+
+    def class_digest(self, root):
+        ''' digest of the equality class of root, 0 if it says nothing '''
+        members = self.members.get(root)
+        val = self.value.get(root, Trace.missing)
+        if members is None and val is Trace.missing:
+            return 0
+        if val is Trace.missing:
+            val = ()
+        else:
+            val = (type(val).__name__, val)
+        return fact_digest(('class', members or (root,), val))
+
+    def update_key(self, old, new):
+        ''' replaces the digests old by the digests new in key '''
+        self.trail.append((Trace.KEY, None, self.key))
+        self.key = (self.key - old + new) % key_modulus
+
+    def set_members(self, root, members):
+        self.trail.append((Trace.MEMBERS, root, self.members.get(root)))
+        if members is None:
+            del self.members[root]
+        else:
+            self.members[root] = members
+
+    def set_parent(self, f, p):
+        ''' sets the parent of f to p, or makes f a root if p is None '''
+        self.trail.append((Trace.PARENT, f, self.parent.get(f)))
+        if p is None:
+            del self.parent[f]
+        else:
+            self.parent[f] = p
+
+    def set_value(self, root, val):
+        old = self.class_digest(root)
+        self.trail.append((Trace.SET_VALUE, root, self.value.get(root, Trace.missing)))
+        self.value[root] = val
+        self.update_key(old, self.class_digest(root))
+
+    def has_value(self, f):
+        return self.find(f) in self.value
+
+    def union(self, f1, f2):
+        r1 = self.find(f1)
+        r2 = self.find(f2)
+        if r1 == r2:
+            return
+        old = self.class_digest(r1) + self.class_digest(r2)
+        rank1 = self.rank.get(r1, 0)
+        rank2 = self.rank.get(r2, 0)
+        if rank1 > rank2:
+            (r1, r2) = (r2, r1)
+        elif rank1 == rank2:
+            self.trail.append((Trace.RANK, r2, rank2))
+            self.rank[r2] = rank2 + 1
+        # r1 goes under r2
+        self.trail.append((Trace.PARENT, r1, None))
+        self.parent[r1] = r2
+        if r1 in self.value:
+            if (not r2 in self.value or (self.value[r1] != self.value[r2] and
+                Trace.relation(self.value[r1], self.value[r2]) == Trace.EQ)):
+                # the more specific prefix
+                self.trail.append((Trace.SET_VALUE, r2, self.value.get(r2, Trace.missing)))
+                self.value[r2] = self.value[r1]
+            self.trail.append((Trace.SET_VALUE, r1, self.value[r1]))
+            del self.value[r1]
+        members = tuple(sorted(self.members.get(r1, (r1,)) + 
+                               self.members.get(r2, (r2,))))
+        if r1 in self.members:
+            self.set_members(r1, None)
+        self.set_members(r2, members)
+        self.update_key(old, self.class_digest(r2))
+
+    def add_neq(self, f, e):
+        if not f in self.neq_dict:
+            self.neq_dict[f] = set()
+        self.neq_dict[f].add(e)
+        self.trail.append((Trace.NEQ_ADD, f, e))
+        self.update_key(0, neq_digest(f, e))
+        if is_prefix(e):
+            if not f in self.neq_prefixes:
+                self.neq_prefixes[f] = set()
+            self.neq_prefixes[f].add(e)
+            self.trail.append((Trace.NEQ_PREFIX_ADD, f, e))
+
+    def remove_neq(self, f, e):
+        self.neq_dict[f].discard(e)
+        self.trail.append((Trace.NEQ_REMOVE, f, e))
+        self.update_key(neq_digest(f, e), 0)
+        if e in self.neq_prefixes.get(f, ()):
+            self.neq_prefixes[f].discard(e)
+            self.trail.append((Trace.NEQ_PREFIX_REMOVE, f, e))
+
+    def detach(self, f):
+        ''' takes f out of its equality class, which keeps its value '''
+        root = self.find(f)
+        members = self.members.get(root)
+        if members is None:
+            return
+        old = self.class_digest(root)
+        rest = tuple([g for g in members if g != f])
+        new_root = root if root != f else rest[0]
+        for g in rest:
+            if g != new_root and self.parent.get(g) != new_root:
+                self.set_parent(g, new_root)
+        if new_root in self.parent:
+            self.set_parent(new_root, None)
+        if f in self.parent:
+            self.set_parent(f, None)
+        if root == f:
+            if f in self.value:
+                self.trail.append((Trace.SET_VALUE, new_root, Trace.missing))
+                self.value[new_root] = self.value[f]
+                self.trail.append((Trace.SET_VALUE, f, self.value[f]))
+                del self.value[f]
+            self.set_members(f, None)
+            self.trail.append((Trace.RANK, new_root, self.rank.get(new_root, 0)))
+            self.rank[new_root] = 1
+        if len(rest) > 1:
+            self.set_members(new_root, rest)
+        elif new_root in self.members:
+            self.set_members(new_root, None)
+        self.update_key(old, self.class_digest(new_root))
+
+    def overwrite(self, f, val):
+        '''
+        sets f to val as a modification of f does: whatever
+        the trace said about f before no longer holds, so f
+        leaves its equality class and its inequalities
+        '''
+        self.detach(f)
+        for e in list(self.neq_dict.get(f, ())):
+            self.remove_neq(f, e)
+            if e in self.fields:
+                self.remove_neq(e, f)
+        self.set_value(f, val)
+
+    @property
+    def fmap(self):
+        ''' the value of each field that has one '''
+        res = {}
+        for f in self.parent:
+            root = self.find(f)
+            if root in self.value:
+                res[f] = self.value[root]
+        res.update(self.value)
+        return res
+
+    def eq_classes(self):
+        ''' the equality classes with more than one field '''
+        res = {}
+        for f in self.parent.keys():
+            root = self.find(f)
+            if not root in res:
+                res[root] = set([root])
+            res[root].add(f)
+        return res.values()
+
     def __setitem__(self, key, val):
-        if key in self.fmap:
-            if self.fmap[key] == val:
-                if val in self.neq_dict[key]:
+        root = self.find(key)
+        if root in self.value:
+            rel = Trace.relation(self.value[root], val)
+            if rel == Trace.EQ:
+                if val in self.neq_dict.get(key, ()):
                     #TODO: I think this can't happen
                     raise ContradictionError(key, val, self)
                 else:
                     raise RedundentError(key, val)
-            else:
+            elif rel == Trace.NEQ:
                 raise ContradictionError(key, val, self)
-       
-        if not key in self.neq_dict:
-            self.neq_dict[key] = set()
-
-        if key in self.eq_sets:
-            for f in self.eq_sets[key]:
-                self.fmap[f] = val
-        else:
-            self.eq_sets[key] = set([key])
-            self.fmap[key] = val
-
-    def update(self, key, val):
-        if key in self.fmap:
-            prev_val = self.fmap[key]
-            if val != prev_val:
-                self.fmap[key] = val
-                self.neq_dict[key].discard(val)
-                self.eq_sets[key].discard(key)
-                self.eq_sets[key] = set([key])
-        else:
-            self[key] = val
+        # no value yet, or a prefix nested in it
+        self.set_value(root, val)
 
     def __getitem__(self, key):
-        return self.fmap[key]
-
-    def merge_sets(self, f1, f2):
-        new_eq_set = self.eq_sets[f1] | self.eq_sets[f2]
-        for f in new_eq_set:
-            self.eq_sets[f] = new_eq_set
+        return self.value[self.find(key)]
 
     def add_field_equality(self, f1, f2):
-        if f1 in self.eq_sets and f2 in self.eq_sets[f1]:
-            return (None, None)
+        r1 = self.find(f1)
+        r2 = self.find(f2)
+        if r1 == r2:
+            return
       
         if f1 in self.neq_dict and f2 in self.neq_dict[f1]:
             raise ContradictionError(f1, f2, self) 
 
-        if f1 in self.fmap and f2 in self.fmap:
-            if self[f1] == self[f2]:
-                set1 = self.eq_sets[f1]
-                set2 = self.eq_sets[f2]
-                self.merge_sets(f1, f2)
-                return (set1, set2)
-            else:
+        if r1 in self.value and r2 in self.value:
+            if Trace.relation(self.value[r1], self.value[r2]) == Trace.NEQ:
                 raise ContradictionError(f1, f2, self)
-
-        elif f1 in self.fmap:
-            self[f2] = self[f1]
-        elif f2 in self.fmap:
-            self[f1] = self[f2]
-        else:
-            if not f1 in self.eq_sets:
-                self.eq_sets[f1] = set([f1])
-            if not f2 in self.eq_sets:
-                self.eq_sets[f2] = set([f2])
-        set1 = self.eq_sets[f1]
-        set2 = self.eq_sets[f2]
-        self.merge_sets(f1, f2)
-        return (set1, set2)
+        self.union(r1, r2)
 
     def add_field_inequality(self, f1, f2):
         if f1 in self.neq_dict and f2 in self.neq_dict[f1]:
-            return False
+            return
 
-        if f1 in self.eq_sets and f2 in self.eq_sets[f1]:
+        r1 = self.find(f1)
+        r2 = self.find(f2)
+        if r1 == r2:
             raise ContradictionError(f1, f2, self)
         
-        if f1 in self.fmap and f2 in self.fmap and self[f1] == self[f2]:
+        if (r1 in self.value and r2 in self.value and 
+            self.value[r1] == self.value[r2] and not is_prefix(self.value[r1])):
             raise ContradictionError(f1, f2, self)
-        
-        if not f1 in self.neq_dict:
-            self.neq_dict[f1] = set()
-        if not f2 in self.neq_dict:
-            self.neq_dict[f2] = set()
 
-        self.neq_dict[f1].add(f2)
-        self.neq_dict[f2].add(f1)
-        return True
+        self.add_neq(f1, f2)
+        self.add_neq(f2, f1)
             
     def add_value_inequality(self, f, v):
         if f in self.neq_dict and v in self.neq_dict[f]:
-            return False
-        if f in self.fmap and self[f] == v:
+            return
+        root = self.find(f)
+        if root in self.value and Trace.relation(self.value[root], v) == Trace.EQ:
             raise ContradictionError(f, v, self)
-
-        if not f in self.neq_dict:
-            self.neq_dict[f] = set()
-        self.neq_dict[f].add(v)
-        return True
+        self.add_neq(f, v)
 
     def get_type(self, elem):
         if elem in self.fields:
@@ -720,44 +1644,11 @@ class Trace(dict):
         type1 = self.get_type(e1)
         type2 = self.get_type(e2)
         if type1 == type2 and type1 == Trace.FIELD:
-            val1 = None
-            val2 = None
-            if e1 in self.fmap and e2 in self.fmap:
-                dtype = 1
-                val1 = self.fmap[e1]
-                val2 = self.fmap[e2]
-            elif e1 in self.fmap:
-                dtype = 2
-                val1 = self.fmap[e1]
-            elif e2 in self.fmap:
-                dtype = 2
-                val2 = self.fmap[e2]
-            else:
-                dtype = 3
-            
-            (set1, set2) = self.add_field_equality(e1, e2)
-            digest = ((e1, e2, True), dtype, val1, val2, set1, set2)
-            return [digest]
+            self.add_field_equality(e1, e2)
         elif type1 == Trace.FIELD and type2 == Trace.VALUE:
-            set1 = None
-            if e1 in self.eq_sets:
-                dtype = 1
-                set1 = self.eq_sets[e1]
-            else:
-                dtype = 2
             self[e1] = e2
-            digest = ((e1, e2, True), dtype, set1)
-            return [digest]
         elif type2 == Trace.FIELD and type1 == Trace.VALUE:
-            set2 = None
-            if e2 in self.eq_sets:
-                dtype = 1
-                set2 = self.eq_sets[e2]
-            else:
-                dtype = 2
             self[e2] = e1
-            digest = ((e2, e1, True), dtype, set2)
-            return [digest]
         else:
             raise TypeError
     
@@ -765,103 +1656,42 @@ class Trace(dict):
         type1 = self.get_type(e1)
         type2 = self.get_type(e2)
         if type1 == type2 and type1 == Trace.FIELD:
-            res = self.add_field_inequality(e1, e2)
+            self.add_field_inequality(e1, e2)
         elif type1 == Trace.FIELD and type2 == Trace.VALUE:
-            res = self.add_value_inequality(e1, e2)
+            self.add_value_inequality(e1, e2)
         elif type2 == Trace.FIELD and type1 == Trace.VALUE:
-            res = self.add_value_inequality(e2, e1)
+            self.add_value_inequality(e2, e1)
         else:
             raise TypeError
-        return [((e1, e2, False), res)]
-
-    
-    def revert(self, digests):
-        for digest in digests:
-            #print "reverting:", digest
-            if digest is None:
-                continue
-            (e1, e2, holds) = digest[0]
-            type1 = self.get_type(e1)
-            type2 = self.get_type(e2)
-            if holds:
-                if type1 == type2 and type1 == Trace.FIELD:
-                    (dtype, val1, val2, set1, set2) = digest[1:]
-                    if set1 is None and set2 is None:
-                        continue
-                    if dtype == 1:
-                        for f in set1:
-                            self.eq_sets[f] = set1
-                        for f in set2:
-                            self.eq_sets[f] = set2
-                    elif dtype == 2:
-                        if val1 is None:
-                            for f in set1:
-                                del self.fmap[f]
-                                self.eq_sets[f] = set1
-                            for f in set2:
-                                self.eq_sets[f] = set2
-                        else:
-                            assert val2 is None
-                            for f in set2:
-                                del self.fmap[f]
-                                self.eq_sets[f] = set2
-                            for f in set1:
-                                self.eq_sets[f] = set1
-                    elif dtype == 3:
-                        for f in set1:
-                            self.eq_sets[f] = set1
-                        for f in set2:
-                            self.eq_sets[f] = set2
-                elif type1 == Trace.FIELD and type2 == Trace.VALUE:
-                    (dtype, set1) = digest[1:]
-                    if dtype == 1:
-                        for f in set1:
-                            del self.fmap[f]
-                    else:
-                        del self.fmap[e1]
-            else:
-                if type1 == type2 and type1 == Trace.FIELD:
-                    self.neq_dict[e1].discard(e2)
-                    self.neq_dict[e2].discard(e1)
-                elif type1 == Trace.FIELD and type2 == Trace.VALUE:
-                    self.neq_dict[e1].discard(e2)
-                elif type2 == Trace.FIELD and type1 == Trace.VALUE:
-                    self.neq_dict[e2].discard(e1)
-                else:
-                    raise TypeError
-    
 
     def equal_field(self, f1, f2):
         if type_dict[f1] != type_dict[f2]:
             return Trace.NEQ
-        if f1 in self.fmap and f2 in self.fmap:
-            if self[f1] == self[f2]:
-                '''if not f2 in self.eq_sets[f1]:
-                    self.eq_sets[f1].add(f2)
-                    self.eq_sets[f2] = self.eq_sets[f1]
-                '''
+        r1 = self.find(f1)
+        r2 = self.find(f2)
+        if r1 == r2:
+            return Trace.EQ
+        elif r1 in self.value and r2 in self.value:
+            (v1, v2) = (self.value[r1], self.value[r2])
+            if v1 == v2 and not is_prefix(v1):
                 return Trace.EQ
-            else:
-                '''
-                if not f2 in self.neq_dict[f1]:
-                    self.neq_dict[f1].add(f2)
-                    self.neq_dict[f2].add(f1)
-                '''
+            elif Trace.relation(v1, v2) == Trace.NEQ:
                 return Trace.NEQ
-        elif f1 in self.eq_sets and f2 in self.eq_sets[f1]:
-            return Trace.EQ
-        elif f1 in self.neq_dict and f2 in self.neq_dict[f1]:
+        if f1 in self.neq_dict and f2 in self.neq_dict[f1]:
             return Trace.NEQ
         else:
             return Trace.BOTH
 
     def equal_value(self, f, v):
-        if f in self.fmap:
-            if self[f] == v:
-                return Trace.EQ
-            else:
-                return Trace.NEQ
-        elif f in self.neq_dict and v in self.neq_dict[f]:
+        root = self.find(f)
+        if root in self.value:
+            res = Trace.relation(self.value[root], v)
+            if res != Trace.BOTH:
+                return res
+        if f in self.neq_dict and v in self.neq_dict[f]:
+            return Trace.NEQ
+        elif (f in self.neq_prefixes and isinstance(v, IPv4Network) and
+              any([v in u for u in self.neq_prefixes[f]])):
             return Trace.NEQ
         else:
             return Trace.BOTH
@@ -869,7 +1699,35 @@ class Trace(dict):
     def equal(self, e1, e2):
         return self.equal_with_test(e1, e2)[0]
 
+    def fingerprint(self):
+        '''
+        key of the constraints in the trace (see constraints), 
+        kept up to date by each change. Traces with the same 
+        constraints have the same fingerprint, and traces with
+        different ones a different fingerprint unless SHA-1
+        collides, so it can key the caches of the translation.
+        '''
+        return self.key
+
+    def constraints(self):
+        '''
+        the values of the fields, the equality classes and 
+        the inequalities, as frozensets
+        '''
+        eq_classes = frozenset([frozenset(s) for s in self.eq_classes()])
+        neqs = frozenset([(f, frozenset(vs)) for (f, vs) in self.neq_dict.items()
+                                                    if len(vs) > 0])
+        return (frozenset(self.fmap.items()), eq_classes, neqs)
+
     def equal_with_test(self, e1, e2):
+        key = (tuple(e1), tuple(e2), self.fingerprint())
+        res = equal_cache.get(key)
+        if res is None:
+            res = self.compare(e1, e2)
+            equal_cache.put(key, res)
+        return res
+
+    def compare(self, e1, e2):
         if len(e1) != len(e2):
             return (Trace.NEQ, None)
 
@@ -901,6 +1759,9 @@ class Trace(dict):
                     field_elem = elem2
                     value_elem = elem1
 
+                # a field never equals a value of another type
+                if not isinstance(value_elem, type_dict[field_elem]):
+                    return (Trace.NEQ, None)
                 v_eq = self.equal_value(field_elem, value_elem)
                 if v_eq == Trace.NEQ:
                     return (Trace.NEQ, None)
@@ -918,12 +1779,139 @@ class Trace(dict):
         res += '-------- field map -----------\n'
         res += str(self.fmap)
         res += '\n--------- equality sets ---------- \n'
-        res +=  str(self.eq_sets)
+        res +=  str(self.eq_classes())
         res +=  '\n--------- non equalities ----------\n'
         res +=  str(self.neq_dict)
         res +=  '\n-----------------------------\n'
         return res
 
+#########################################
+#####        Operation Caches       #####
+#########################################
+
+class OpCache(object):
+    '''
+    bounded memo table for an FDD operation. When full,
+    the oldest entries are evicted first.
+    '''
+
+    def __init__(self, name, max_size=None):
+        self.name = name
+        self.max_size = op_cache_size if max_size is None else max_size
+        self.table = {}
+        self.order = deque()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        res = self.table.get(key)
+        if res is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return res
+
+    def put(self, key, val):
+        if key in self.table:
+            self.table[key] = val
+            return
+        if len(self.table) >= self.max_size:
+            # evicting the older half at once so that 
+            # eviction cost is amortized over insertions
+            for _ in xrange(len(self.order) / 2):
+                del self.table[self.order.popleft()]
+        self.table[key] = val
+        self.order.append(key)
+
+    def clear(self):
+        self.table.clear()
+        self.order.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        return {'hits' : self.hits, 'misses' : self.misses,
+                'size' : len(self.table)}
+
+# results of Trace.equal_with_test, by the compared 
+# elements and the fingerprint of the trace
+equal_cache = OpCache('equal_with_test')
+op_caches['equal_with_test'] = equal_cache
+
+# chains of nodes of switches, see Switch.expand
+expand_cache = OpCache('expand_switch')
+op_caches['expand_switch'] = expand_cache
+
+# negations of filter FDDs, both ways, see complement
+neg_cache = OpCache('neg')
+op_caches['neg'] = neg_cache
+
+def complement(fdd):
+    '''
+    returns the negation of the filter FDD fdd: the same 
+    diagram with id and drop leaves swapped. Negations are
+    kept in neg_cache both ways, so sub-FDDs negated before
+    are not walked again and negating the negation of an 
+    FDD returns it at once.
+    '''
+    res = neg_cache.get(fdd)
+    if not res is None:
+        return res
+    done = {}
+    def negated(d):
+        res = done.get(d)
+        return neg_cache.get(d) if res is None else res
+    stack = [(fdd, False)]
+    while stack:
+        (d, expanded) = stack.pop()
+        if d in done:
+            continue
+        if isinstance(d, Leaf):
+            res = ~d
+        elif not expanded:
+            res = neg_cache.get(d)
+            if res is None:
+                stack.append((d, True))
+                stack.extend([(c, False) for c in d.children()])
+                continue
+        elif isinstance(d, Switch):
+            cases = [(v, negated(c)) for (v, c) in d.cases]
+            res = switch(d.field, cases, negated(d.default))
+        else:
+            res = Node(d.test, negated(d.lchild), negated(d.rchild))
+        done[d] = res
+        if not expanded:
+            continue
+        neg_cache.put(d, res)
+        neg_cache.put(res, d)
+    return done[fdd]
+
+def cached_op(name, key_of=None):
+    '''
+    memoizes an FDDTranslator operation whose last 
+    argument is the Trace. Results are keyed on 
+    the other arguments (or key_of applied to them)
+    and the fingerprint of the Trace.
+    '''
+    cache = OpCache(name)
+    op_caches[name] = cache
+
+    def decorator(f):
+        @wraps(f)
+        def wrapper(cls, *args):
+            T = args[-1]
+            if key_of is None:
+                key = (args[:-1], T.fingerprint())
+            else:
+                key = (key_of(*args[:-1]), T.fingerprint())
+            res = cache.get(key)
+            if res is None:
+                res = f(cls, *args)
+                cache.put(key, res)
+            return res
+        return wrapper
+    return decorator
+
 def fdd_str(fdd):
     return '\n'.join(fdd.level_repr([], ""))
 
@@ -931,21 +1919,25 @@ class FDDTranslator(object):
     
     @classmethod
     def get_next_trace(cls, T, t, holds):
-        #res = copy.deepcopy(T)
-        digest = [None]
+        '''
+        adds t (or its negation) to T and returns the
+        checkpoint to roll T back to afterwards
+        '''
+        mark = T.checkpoint()
         if not isinstance(t, STest):
             if holds:
-                digest = T.add_equality(t.lh, t.rh)
+                T.add_equality(t.lh, t.rh)
             else:
-                digest = T.add_inequality(t.lh, t.rh)
-        #print "generated digest: ", digest
-        return digest
+                T.add_inequality(t.lh, t.rh)
+        return mark
 
     @classmethod
+    @cached_op('refine_tree')
     def refine_tree(cls, d, T):
         ''' refines/removes tests from the root
             of the FDD until a "non-trivial" test 
-            or a leaf is reached.
+            or a leaf is reached. Switches are 
+            expanded unless they are decided.
         '''
         if isinstance(d, Leaf):
             return d
@@ -992,6 +1984,11 @@ class FDDTranslator(object):
                 return cls.refine_tree(d.rchild, T)
             else:
                 return d
+        elif isinstance(d, Switch):
+            # decided by a lookup if the value of the field is known
+            if T.has_value(d.field) and not is_prefix(T[d.field]):
+                return cls.refine_tree(d.child(T[d.field]), T)
+            return cls.refine_tree(d.expand(), T)
         else:
             raise TypeError
 
@@ -1010,7 +2007,8 @@ class FDDTranslator(object):
         
         if type1 == type2:
             if type1 == FVTest:
-                if T.equal([t1.lh], [t2.lh]) == Trace.EQ and t1.rh != t2.rh:
+                if (T.equal([t1.lh], [t2.lh]) == Trace.EQ and 
+                    Trace.relation(t1.rh, t2.rh) == Trace.NEQ):
                     return True
                 else:
                     return False
@@ -1036,6 +2034,13 @@ class FDDTranslator(object):
                     return False
         return False
 
+    @classmethod
+    def nested_prefix_tests(cls, t1, t2):
+        ''' whether t1 and t2 test a field against nested prefixes '''
+        return (isinstance(t1, FVTest) and isinstance(t2, FVTest) and 
+                t1.lh == t2.lh and (is_prefix(t1.rh) or is_prefix(t2.rh)) and 
+                Trace.relation(t1.rh, t2.rh) != Trace.NEQ)
+
     @classmethod
     def equal_tests(cls, t1, t2, T):
         ''' Tests have been changed to the 
@@ -1064,20 +2069,21 @@ class FDDTranslator(object):
         return False
 
     @classmethod
+    @cached_op('act_seq', lambda act_seq, act_info, d : (act_seq, d))
     def act_seq(cls, act_seq, act_info, d, T):
         assert isinstance(d, Node)
 
-        new_leaf = Leaf(set([act_seq]))
-        if act_seq[-1] == FAction('drop', 'drop'):
+        new_leaf = Leaf(frozenset([act_seq]))
+        if act_seq[-1] == drop_action:
             return new_leaf
         fmap = act_info[0]
         #new_T = copy.deepcopy(T)
-        digests = []
+        mark = T.checkpoint()
         for f in fmap:
-            digest = self.get_next_trace(T, FVTest(f, fmap[f]), True)
-            digests.append(digest)
-            #new_T.update(f, fmap[f])
-        digests.reverse()
+            # seq on the children comes back here with the same
+            # act_seq, when T already has the modified values
+            if T.equal_value(f, fmap[f]) != Trace.EQ:
+                T.overwrite(f, fmap[f])
         new_T = T
         d = cls.refine_tree(d, new_T) 
         if isinstance(d, Node):
@@ -1096,45 +2102,48 @@ class FDDTranslator(object):
                             (res, new_test) = new_T.equal_with_test(sact.rh, t.rh)
                             if res == Trace.EQ:
                                 res = cls.seq(new_leaf, d.lchild, new_T)
-                                T.revert(digests)
+                                T.rollback(mark)
                                 return res
                             elif res == Trace.NEQ:
                                 res = cls.seq(new_leaf, d.rchild, new_T)
-                                T.revert(digests)
+                                T.rollback(mark)
                                 return res
                             else:
                                 new_d = Node(new_test, d ,d)
                                 res = cls.seq(new_leaf, new_d, new_T)
-                                T.revert(digests)
+                                T.rollback(mark)
                                 return res
                         elif res == Trace.NEQ:
                             continue
                         else:
                             new_d = Node(new_test, d, d)
                             res = cls.seq(new_leaf, new_d, new_T)
-                            T.revert(digests)
+                            T.rollback(mark)
                             return res
 
-            digest = cls.get_next_trace(new_T, t, True)
+            next_mark = cls.get_next_trace(new_T, t, True)
             lchild = cls.seq(new_leaf, d.lchild, new_T)
-            new_T.revert(digest)
+            new_T.rollback(next_mark)
             lchild = cls.restrict(lchild, t, True, new_T)
             #print 'lchild'
             #print lchild
-            digest = cls.get_next_trace(new_T, t, False)
+            next_mark = cls.get_next_trace(new_T, t, False)
             rchild = cls.seq(new_leaf, d.rchild, new_T)
-            new_T.revert(digest)
+            new_T.rollback(next_mark)
             rchild = cls.restrict(rchild, t, False, new_T)
             #print 'rchild'
             #print rchild
             res = cls.par(lchild, rchild, new_T)
-            T.revert(digests)
+            T.rollback(mark)
             return res
         elif isinstance(d, Leaf):
-            return cls.seq(new_leaf, d, T)
+            res = cls.seq(new_leaf, d, T)
+            T.rollback(mark)
+            return res
         raise TypeError
 
     @classmethod
+    @cached_op('seq')
     def seq(cls, d1, d2, T):
         '''d1 = cls.refine_tree(d1, T)
         print '---- in seq ------'
@@ -1143,17 +2152,21 @@ class FDDTranslator(object):
         print 'T'
         print T
         '''
+        if isinstance(d1, Switch):
+            d1 = d1.expand()
+        if isinstance(d2, Switch):
+            d2 = d2.expand()
         if isinstance(d1, Node):
             #print 1 
             #TODO: maybe we can avoid adding d1.test to the Trace
             # because of the restrict afterwards...
-            digest = cls.get_next_trace(T, d1.test, True)
+            mark = cls.get_next_trace(T, d1.test, True)
             lseq = cls.seq(d1.lchild, d2, T)
-            T.revert(digest)
+            T.rollback(mark)
             lseq = cls.restrict(lseq, d1.test, True, T)
-            digest = cls.get_next_trace(T, d1.test, False)
+            mark = cls.get_next_trace(T, d1.test, False)
             rseq = cls.seq(d1.rchild, d2, T)
-            T.revert(digest)
+            T.rollback(mark)
             rseq = cls.restrict(rseq, d1.test, False, T)
             res = cls.par(lseq, rseq, T)
             return res
@@ -1184,6 +2197,7 @@ class FDDTranslator(object):
             raise TypeError
 
     @classmethod
+    @cached_op('par')
     def par(cls, d1, d2, T):
         d1 = cls.refine_tree(d1, T)
         d2 = cls.refine_tree(d2, T)
@@ -1197,54 +2211,54 @@ class FDDTranslator(object):
             if isinstance(d2, Node):
                 t2 = d2.test
                 if cls.equal_tests(t1, t2, T):
-                    digest = cls.get_next_trace(T, t1, True)
+                    mark = cls.get_next_trace(T, t1, True)
                     lchild = cls.par(d1.lchild, d2.lchild, T)
-                    T.revert(digest)
-                    digest = cls.get_next_trace(T, t1, False)
+                    T.rollback(mark)
+                    mark = cls.get_next_trace(T, t1, False)
                     rchild = cls.par(d1.rchild, d2.rchild, T)
-                    T.revert(digest)
+                    T.rollback(mark)
                     test = t1
                 else:
-                    if t1 < t2:
+                    if t1.rank < t2.rank:
                         d1, d2 = d2, d1
                         t1, t2 = t2, t1
                     
                     if cls.contradicting_tests(t1, t2, T):
-                        digest = cls.get_next_trace(T, t1, True)
+                        mark = cls.get_next_trace(T, t1, True)
                         lchild = cls.par(d1.lchild, d2.rchild, T)
-                        T.revert(digest)
-                        digest = cls.get_next_trace(T, t1, False)
+                        T.rollback(mark)
+                        mark = cls.get_next_trace(T, t1, False)
                         rchild = cls.par(d1.rchild, d2, T)
-                        T.revert(digest)
+                        T.rollback(mark)
                         test = t1
                     else:
-                        digest = cls.get_next_trace(T, t1, True)
+                        mark = cls.get_next_trace(T, t1, True)
                         lchild = cls.par(d1.lchild, d2, T)
-                        T.revert(digest)
-                        digest = cls.get_next_trace(T, t1, False)
+                        T.rollback(mark)
+                        mark = cls.get_next_trace(T, t1, False)
                         rchild = cls.par(d1.rchild, d2, T)
-                        T.revert(digest)
+                        T.rollback(mark)
                         test = t1
                          
             elif isinstance(d2, Leaf):
-                digest = cls.get_next_trace(T, t1, True)
+                mark = cls.get_next_trace(T, t1, True)
                 lchild = cls.par(d1.lchild, d2, T)
-                T.revert(digest)
-                digest = cls.get_next_trace(T, t1, False)
+                T.rollback(mark)
+                mark = cls.get_next_trace(T, t1, False)
                 rchild = cls.par(d1.rchild, d2, T)
-                T.revert(digest)
+                T.rollback(mark)
                 test = t1
             else:
                 raise TypeError
         elif isinstance(d1, Leaf):
             if isinstance(d2, Node):
                 t2 = d2.test
-                digest = cls.get_next_trace(T, t2, True)
+                mark = cls.get_next_trace(T, t2, True)
                 lchild = cls.par(d2.lchild, d1, T)
-                T.revert(digest)
-                digest = cls.get_next_trace(T, t2, False)
+                T.rollback(mark)
+                mark = cls.get_next_trace(T, t2, False)
                 rchild = cls.par(d2.rchild, d1, T)
-                T.revert(digest)
+                T.rollback(mark)
                 test = t2
 
             elif isinstance(d2, Leaf):
@@ -1261,17 +2275,11 @@ class FDDTranslator(object):
 
     @classmethod
     def neg(cls, d):
-        if isinstance(d, Node):
-            lchild = cls.neg(d.lchild)
-            rchild = cls.neg(d.rchild)
-            return Node(d.test, lchild, rchild)
-                    
-        elif isinstance(d, Leaf):
-            return ~d
-        else:
-            raise TypeError
+        ''' negation of the filter d (see complement) '''
+        return complement(d)
 
     @classmethod
+    @cached_op('restrict')
     def restrict(cls, d, t, holds, T):
 
         if not isinstance(t, STest):
@@ -1298,30 +2306,35 @@ class FDDTranslator(object):
                     res = Node(t, d.lchild, cls.get_drop())
                 else:
                     res = Node(t, cls.get_drop(), d.rchild)
-            elif t > d.test:
+            elif t.rank > d.test.rank:
                 if cls.contradicting_tests(t, d.test, T):
                     if holds:
                         return Node(t, d.rchild, cls.get_drop())
                     else:
                         return Node(t, cls.get_drop(), d)
                 else:
+                    if cls.nested_prefix_tests(t, d.test):
+                        # t decides some tests of d
+                        mark = cls.get_next_trace(T, t, holds)
+                        d = cls.refine_tree(d, T)
+                        T.rollback(mark)
                     if holds:
                         return Node(t, d, cls.get_drop())
                     else:
                         return Node(t, cls.get_drop(), d)
             else:
-                digest = cls.get_next_trace(T, d.test, False)
+                mark = cls.get_next_trace(T, d.test, False)
                 rchild = cls.restrict(d.rchild, t, holds, T)
-                T.revert(digest)
+                T.rollback(mark)
                 if cls.contradicting_tests(t, d.test, T):
                     if holds:
                         res = Node(d.test, cls.get_drop(), rchild)
                     else:
                         res = Node(d.test, d.lchild, rchild)        
                 else:
-                    digest = cls.get_next_trace(T, d.test, True)
+                    mark = cls.get_next_trace(T, d.test, True)
                     lchild = cls.restrict(d.lchild, t, holds, T)
-                    T.revert(digest)
+                    T.rollback(mark)
                     res = Node(d.test, lchild, rchild)
                                 
         elif isinstance(d, Leaf):
@@ -1341,15 +2354,33 @@ class FDDTranslator(object):
 
     @classmethod
     def get_id(cls):
-        a = FAction('id', 'id')
-        new_leaf = Leaf(frozenset([(a,)]))
-        return new_leaf
+        return id_leaf()
 
     @classmethod
     def get_drop(cls):
-        a = FAction('drop', 'drop')
-        new_leaf = Leaf(frozenset([(a,)])) 
-        return new_leaf
+        return drop_leaf()
+
+    @classmethod
+    def reduce(cls, op, fdds, T):
+        '''
+        combines fdds with op (par or seq), keeping their 
+        order. With balanced_reduction, adjacent pairs are 
+        combined level by level so operands stay of similar
+        size, otherwise fdds are folded from left to right.
+        '''
+        if not balanced_reduction:
+            res = fdds[0]
+            for d in fdds[1:]:
+                res = op(res, d, T)
+            return res
+
+        while len(fdds) > 1:
+            next_fdds = [op(fdds[i], fdds[i + 1], T) 
+                            for i in xrange(0, len(fdds) - 1, 2)]
+            if len(fdds) % 2 == 1:
+                next_fdds.append(fdds[-1])
+            fdds = next_fdds
+        return fdds[0]
 
     @classmethod 
     def translate(cls, pol, T):
@@ -1410,18 +2441,12 @@ class FDDTranslator(object):
             return cls.neg(inner_pol)
        
         if issubclass(typ, parallel):
-            res = cls.translate(pol.policies[0], T)            
-            for p in pol.policies[1:]:
-                p_fdd = cls.translate(p, T)
-                res = cls.par(res, p_fdd, T)
-            return res
+            fdds = [cls.translate(p, T) for p in pol.policies]
+            return cls.reduce(cls.par, fdds, T)
         
         if issubclass(typ, sequential):
-            res = cls.translate(pol.policies[0], T)
-            for p in pol.policies[1:]:
-                p_fdd = cls.translate(p, T)
-                res = cls.seq(res, p_fdd, T)
-            return res
+            fdds = [cls.translate(p, T) for p in pol.policies]
+            return cls.reduce(cls.seq, fdds, T)
 
         elif typ == if_:
             #print pol
@@ -1431,152 +2456,1238 @@ class FDDTranslator(object):
             #print 'ft:\n', fdd_str(ft)
             ff = cls.translate(pol.f_branch, T)
             #print 'ff:\n', fdd_str(ff)
-            true_part = cls.seq(fa, ft, T)
-            #print 'ture:\n', fdd_str(true_part)
-            false_part = cls.seq(cls.neg(fa), ff, T)
-            #print 'false:\n', fdd_str(false_part)
-            return cls.par(true_part, false_part, T)
+            return cls.ite(fa, ft, ff, T)
         raise TypeError
 
+    @classmethod
+    def ite(cls, fa, ft, ff, T):
+        ''' combines the translated parts of an if_ '''
+        true_part = cls.seq(fa, ft, T)
+        #print 'ture:\n', fdd_str(true_part)
+        false_part = cls.seq(cls.neg(fa), ff, T)
+        #print 'false:\n', fdd_str(false_part)
+        return cls.par(true_part, false_part, T)
 
-#########################################################
-#####        State Requirement Extraction           #####
-#########################################################
-def augment_assump(assump, all_inports, inport_trace):
-    if isinstance(assump, Node):
-        t = assump.test
-        if isinstance(t, FVTest):
-            (eq, neq) = inport_trace
-            new_eq = eq
-            new_neq = neq
-            if t.lh == 'inport':
-                new_eq = {t.rh}
-                new_neq = neq + [t.rh]
-            augment_assump(assump.lchild, all_inports, (new_eq, neq))
-            augment_assump(assump.rchild, all_inports, (eq, new_neq))
+    @classmethod
+    def translate_parallel(cls, pol, T, processes=None):
+        '''
+        translates the sub-policies of a top-level parallel 
+        (or the predicate and branches of a top-level if_)
+        in a pool of processes and combines them here.
+        Results are sent back as tables (see to_tables).
+        '''
+        typ = type(pol)
+        if issubclass(typ, parallel):
+            pols = pol.policies
+        elif typ == if_:
+            pols = [pol.pred, pol.t_branch, pol.f_branch]
         else:
-            raise TypeError
-    else:
-        (eq, neq) = inport_trace
-        assump.assump_trace = (eq, neq)
-
-def get_assump_inport_trace(assump, path):
-    if isinstance(assump, Node):
-        t = assump.test
-        if isinstance(t, FVTest):
-            (true_dict, false_set) = path
-            (f, v) = (t.lh, t.rh)
-            if f in true_dict:
-                if true_dict[f] == v:
-                    return get_assump_inport_trace(assump.lchild, path)
+            return cls.translate(pol, T)
+
+        # workers are forked after this, so they
+        # get the policies without pickling them
+        global pool_policies, pool_trace
+        pool_policies = pols
+        pool_trace = T
+        pool = Pool(processes)
+        try:
+            tables = pool.map(translate_worker, range(len(pols)))
+        finally:
+            pool.terminate()
+            pool_policies = None
+            pool_trace = None
+        fdds = [from_tables(x) for x in tables]
+
+        if typ == if_:
+            return cls.ite(fdds[0], fdds[1], fdds[2], T)
+        return cls.reduce(cls.par, fdds, T)
+
+# policies and trace of FDDTranslator.translate_parallel workers
+pool_policies = None
+pool_trace = None
+
+def translate_worker(i):
+    d = FDDTranslator.translate(pool_policies[i], pool_trace)
+    return to_tables(d)
+
+#########################################
+#####     Incremental translation   #####
+#########################################
+
+class TranslationMemo(object):
+    '''
+    FDDs of the sub-policies translated in the last compilation,
+    by structural hash (see cache.digest) and trace fingerprint,
+    so that recompiling an edited policy only translates the 
+    changed sub-policies (and the policies containing them).
+    The memo is dropped when the state order changes or the
+    tables are reset by someone else.
+    st_req: set by stateful.compile_to_req to the state 
+    requirements of the last compilation
+    translated, pol_fdd: the translated policy of the last 
+    compilation and the pol_fdd made of it (after sifting,
+    in the field order pol_fdd_rank), see remember
+    req: the assumptions and ports of the last compilation and
+    the state requirements of pol_fdd for them (before
+    stateful.revise_st_req)
+    unchanged: whether the last compilation found its policy
+    equivalent to the one before (see stateful.compile_to_req)
+    mip: the key and result of the last stateful.compile_from_req
+    '''
+
+    def __init__(self):
+        self.fdds = {}
+        self.used = {}
+        self.digests = {}
+        self.state_rank = None
+        self.generation = None
+        self.hits = 0
+        self.misses = 0
+        self.st_req = None
+        self.translated = None
+        self.pol_fdd = None
+        self.pol_fdd_rank = None
+        self.req = None
+        self.unchanged = False
+        self.mip = None
+
+    def prepare(self, rank):
+        '''
+        sets up the test order for a compilation with state_rank
+        rank, keeping the tables (and the memo) if possible
+        '''
+        global state_rank, field_rank
+        if rank != self.state_rank or self.generation != tables_generation:
+            state_rank = rank
+            field_rank = dict(default_field_rank)
+            reset_tables()
+            self.release()
+            self.forget()
+            self.state_rank = dict(rank)
+            self.generation = tables_generation
+        elif field_rank != default_field_rank:
+            # undoes the reordering of the last compilation
+            set_field_rank(default_field_rank)
+        # ids are assigned again (fdd_index) to the new FDD
+        for d in unique_table.values():
+            d.id = None
+        fdd_indexes.clear()
+        inport_ids.clear()
+
+    def translate(self, pol, T):
+        global active_memo
+        self.digests = {}
+        policy_digest(pol, self.digests)
+        self.used = {}
+        self.hits = 0
+        self.misses = 0
+        active_memo = self
+        try:
+            res = MemoTranslator.translate(pol, T)
+        finally:
+            active_memo = None
+        # only the sub-policies of the last version are kept
+        for d in self.used.values():
+            ref(d)
+        self.release()
+        self.fdds = self.used
+        return res
+
+    def release(self):
+        ''' drops the FDDs of the memo from the roots (see collect) '''
+        for d in self.fdds.values():
+            deref(d)
+        self.fdds = {}
+
+    def remember(self, translated, pol_fdd):
+        ''' keeps translated and pol_fdd, in the current field order '''
+        ref(translated)
+        ref(pol_fdd)
+        self.forget()
+        self.translated = translated
+        self.pol_fdd = pol_fdd
+        self.pol_fdd_rank = dict(field_rank)
+
+    def forget(self):
+        if self.translated is not None:
+            deref(self.translated)
+            deref(self.pol_fdd)
+        self.translated = None
+        self.pol_fdd = None
+        self.pol_fdd_rank = None
+        self.req = None
+
+# memo of the running MemoTranslator.translate
+active_memo = None
+
+class MemoTranslator(FDDTranslator):
+    ''' FDDTranslator that takes sub-policies from active_memo '''
+
+    @classmethod
+    def translate(cls, pol, T):
+        memo = active_memo
+        if not id(pol) in memo.digests:
+            policy_digest(pol, memo.digests)
+        key = (memo.digests[id(pol)][0], T.fingerprint())
+        res = memo.fdds.get(key)
+        if res is None:
+            memo.misses += 1
+            res = super(MemoTranslator, cls).translate(pol, T)
+        else:
+            memo.hits += 1
+        memo.used[key] = res
+        return res
+
+#########################################
+#####          Reordering           #####
+#########################################
+
+def dag_size(fdd):
+    ''' number of distinct nodes and leaves in fdd '''
+    return sum([1 for _ in preorder(fdd)])
+
+def tested_fields(fdd):
+    ''' fields tested in fdd, ordered as in the FDD (root first) '''
+    fields = set()
+    for d in preorder(fdd):
+        if isinstance(d, Node):
+            if isinstance(d.test, FVTest):
+                fields.add(d.test.lh)
+            elif isinstance(d.test, FFTest):
+                fields.update([d.test.lh, d.test.rh])
+        elif isinstance(d, Switch):
+            fields.add(d.field)
+    return sorted(fields, key=field_key, reverse=True)
+
+def field_order_ranks(fields):
+    '''
+    field_rank ranking fields in the given order (root 
+    first), ahead of the other ranked fields
+    '''
+    others = [f for f in sorted(field_rank, key=field_rank.get) 
+                    if not f in fields]
+    return dict([(f, i) for (i, f) in enumerate(list(fields) + others)])
+
+def set_field_order(fields):
+    '''
+    ranks fields in the given order (root first), ahead of 
+    the other ranked fields, and reorders the interned tests.
+    FDDs built before are not in the new order anymore.
+    '''
+    set_field_rank(field_order_ranks(fields))
+
+def set_field_rank(ranks):
+    ''' sets field_rank to ranks and reorders the interned tests '''
+    field_rank.clear()
+    field_rank.update(ranks)
+    rerank_tests()
+    for cache in op_caches.values():
+        cache.clear()
+
+def rebuild(fdd):
+    ''' rebuilds fdd (bottom-up, without switches) in the current test order '''
+    T = Trace()
+    def node_fun(d, lchild, rchild):
+        return FDDTranslator.par(FDDTranslator.restrict(lchild, d.test, True, T),
+                                 FDDTranslator.restrict(rchild, d.test, False, T), T)
+    return map_fdd(expand_switches(fdd), lambda l : l, node_fun)
+
+def swap_fields(fdd, order, i):
+    '''
+    returns fdd, without switches and with its field tests in the
+    order of the fields of order (root first), with the tests of
+    order[i] and order[i + 1] swapped. Only the nodes testing
+    them and the nodes above are rebuilt, by deciding the tests
+    in a Trace rather than with the operations of FDDTranslator,
+    so test ranks and op caches are left alone. The tests of 
+    each field stay in the order of their ranks.
+    '''
+    (f, g) = (order[i], order[i + 1])
+    above = set(order[:i])
+    def in_region(d):
+        return (isinstance(d, Node) and isinstance(d.test, FVTest) and 
+                d.test.lh in (f, g))
+    def mk(t, lchild, rchild):
+        return lchild if lchild is rchild else Node(t, lchild, rchild)
+
+    def region_tests(d):
+        ''' tests of g under d, root first in the new order '''
+        tests = set()
+        seen = set()
+        stack = [d]
+        while len(stack) > 0:
+            n = stack.pop()
+            if n in seen or not in_region(n):
+                continue
+            seen.add(n)
+            if n.test.lh == g:
+                tests.add(n.test)
+            stack.extend(n.children())
+        return sorted(tests, key=lambda t : -t.rank)
+
+    def resolve(d, T, memo):
+        ''' d with the tests of g decided by T '''
+        res = memo.setdefault(T.fingerprint(), {})
+        stack = [d]
+        while len(stack) > 0:
+            n = stack[-1]
+            if n in res:
+                stack.pop()
+            elif not in_region(n):
+                res[n] = n
+                stack.pop()
+            elif n.test.lh == g:
+                if T.equal_value(g, n.test.rh) == Trace.EQ:
+                    c = n.lchild
+                else:
+                    c = n.rchild
+                if c in res:
+                    res[n] = res[c]
+                    stack.pop()
+                else:
+                    stack.append(c)
+            else:
+                missing = [c for c in n.children() if not c in res]
+                if len(missing) == 0:
+                    res[n] = mk(n.test, res[n.lchild], res[n.rchild])
+                    stack.pop()
                 else:
-                    return get_assump_inport_trace(assump.rchild, path)
-            elif (f, v) in false_set:
-                return get_assump_inport_trace(assump.rchild, path)
+                    stack.extend(missing)
+        return res[d]
+
+    def chain(d, tests, T, memo):
+        '''
+        d with the tests in tests that T does not decide on
+        top, as a chain of their false branches
+        '''
+        branches = []
+        mark = T.checkpoint()
+        for (j, t) in enumerate(tests):
+            if T.equal_value(g, t.rh) != Trace.BOTH:
+                continue
+            tmark = FDDTranslator.get_next_trace(T, t, True)
+            branches.append((t, chain(d, tests[j + 1:], T, memo)))
+            T.rollback(tmark)
+            T.add_inequality(g, t.rh)
+        res = resolve(d, T, memo)
+        T.rollback(mark)
+        for (t, lchild) in reversed(branches):
+            res = mk(t, lchild, res)
+        return res
+
+    res = {}
+    stack = [fdd]
+    while len(stack) > 0:
+        d = stack[-1]
+        if d in res:
+            stack.pop()
+        elif in_region(d):
+            res[d] = chain(d, region_tests(d), Trace(), {})
+            stack.pop()
+        elif (isinstance(d, Node) and isinstance(d.test, FVTest) and 
+              d.test.lh in above):
+            missing = [c for c in d.children() if not c in res]
+            if len(missing) == 0:
+                res[d] = mk(d.test, res[d.lchild], res[d.rchild])
+                stack.pop()
             else:
-                lres = get_assump_inport_trace(assump.lchild, path)
-                rres = get_assump_inport_trace(assump.rchild, path)
-                return (lres[0] | rres[0], lres[1] + rres[1])
+                stack.extend(missing)
+        else:
+            res[d] = d
+            stack.pop()
+    return res[fdd]
+
+def sift(fdd):
+    '''
+    reorders the fields tested in fdd to make it smaller: each
+    field in turn (the most tested first) is moved down the 
+    order, then up, by swaps with its neighbors (see swap_fields)
+    and kept where the FDD is the smallest. A field stops 
+    moving in one direction when the FDD grows more than 
+    sift_max_growth times the smallest, or at a swap that would
+    reorder field-field or state tests, whose order also 
+    depends on field_rank. If some order is smaller, field_rank
+    is set to it (clearing the op caches) and fdd is returned
+    rebuilt in it, without switches. Otherwise fdd is returned
+    as is and field_rank is left alone.
+    '''
+    d = expand_switches(fdd)
+    start = tested_fields(d)
+    if len(start) < 2:
+        return fdd
+    num_tests = dict([(f, 0) for f in start])
+    others = set()
+    for n in preorder(d):
+        if isinstance(n, Node):
+            if isinstance(n.test, FVTest):
+                num_tests[n.test.lh] += 1
+                if isinstance(n.test.rh, str):
+                    others.add(n.test)
+            else:
+                others.add(n.test)
+    others = list(others)
+
+    old_rank = dict(field_rank)
+    ranks = {}
+    def others_order(order):
+        field_rank.clear()
+        field_rank.update(ranks[tuple(order)])
+        return sorted(others, key=lambda t : t.order_key())
+    def swap(d, order, i):
+        new_order = order[:i] + [order[i + 1], order[i]] + order[i + 2:]
+        for o in [order, new_order]:
+            if not tuple(o) in ranks:
+                ranks[tuple(o)] = field_order_ranks(o)
+        try:
+            if others_order(order) != others_order(new_order):
+                return (None, None)
+        finally:
+            field_rank.clear()
+            field_rank.update(old_rank)
+        return (swap_fields(d, order, i), new_order)
+
+    (best, best_size, best_order) = (d, dag_size(d), start)
+    for f in sorted(start, key=lambda x : -num_tests[x]):
+        if num_tests[f] == 0:
+            continue
+        (first, first_order) = (best, best_order)
+        for step in [1, -1]:
+            (cur, order) = (first, first_order)
+            i = order.index(f)
+            while 0 <= i + step < len(order):
+                (cur, order) = swap(cur, order, min(i, i + step))
+                if cur is None:
+                    break
+                i += step
+                size = dag_size(cur)
+                if size < best_size:
+                    (best, best_size, best_order) = (cur, size, order)
+                elif size > sift_max_growth * best_size:
+                    break
+    if best_order == start:
+        return fdd
+    set_field_order(best_order)
+    return best
+
+#########################################
+#####          Equivalence          #####
+#########################################
+
+def in_tables(fdd):
+    ''' whether fdd is made of the hash-consed nodes of the current tables '''
+    for d in preorder(fdd):
+        if isinstance(d, Node):
+            key = Node.unique_key(d.test, d.lchild, d.rchild)
+        elif isinstance(d, Switch):
+            key = Switch.unique_key(d.field, d.cases, d.default)
+        else:
+            key = d.unique_key_of()
+        if not unique_table.get(key) is d:
+            return False
+    return True
+
+def is_ordered(fdd):
+    ''' whether each test of fdd (without switches) is greater than the tests under it '''
+    for d in preorder(fdd):
+        if isinstance(d, Node):
+            for c in d.children():
+                if isinstance(c, Node) and not c.test.rank < d.test.rank:
+                    return False
+    return True
+
+def canonical(fdd):
+    '''
+    returns the FDD of the current tables and test order that
+    is the same function as fdd. FDDs of other tables (for
+    instance from before reset_tables) are hash-consed again,
+    switches expanded and FDDs built in another field order
+    (see sift) rebuilt.
+    '''
+    if not in_tables(fdd):
+        fdd = from_tables(to_tables(fdd))
+    fdd = expand_switches(fdd)
+    if not is_ordered(fdd):
+        fdd = rebuild(fdd)
+    return fdd
+
+def equivalent(fdd1, fdd2):
+    '''
+    whether fdd1 and fdd2 map each packet and state to the
+    same actions. In the same tables and order, the reduced
+    FDD of a function (without infeasible paths, which the
+    translation drops) is a single object, so this is one
+    comparison unless one of them needs canonical. It may miss
+    equivalences hidden by infeasible paths, never the converse.
+    '''
+    if fdd1 is fdd2:
+        return True
+    return canonical(fdd1) is canonical(fdd2)
+
+#########################################
+#####           Reduction           #####
+#########################################
+
+# translated FDDs are pruned (see prune) in stateful.compile_to_req
+prune_translated = True
+
+# sizes of the FDDs before and after the last prune
+prune_stats = {'before' : 0, 'after' : 0}
+
+def state_test_result(t, facts, T):
+    '''
+    whether the state test t holds given the state tests 
+    facts (tests with whether they hold) on the path to it:
+    Trace.EQ, Trace.NEQ or Trace.BOTH
+    '''
+    for (s, holds) in facts.get(t.var, ()):
+        if T.equal(s.index, t.index) == Trace.EQ:
+            res = T.equal(s.rh, t.rh)
+            if holds and res != Trace.BOTH:
+                return res
+            elif not holds and res == Trace.EQ:
+                return Trace.NEQ
+    return Trace.BOTH
+
+def prune(fdd, T=None):
+    '''
+    returns fdd without the branches made infeasible by the 
+    tests above them: each path is walked with a Trace (T if
+    given, for paths under constraints), and with the state
+    tests met on the way. Tests decided there are replaced by
+    the child taken and nodes with equal children by that 
+    child. A sub-FDD reached again under the same constraints
+    (see Trace.fingerprint) is pruned once. Switches are 
+    pruned as their chains of nodes. Sets prune_stats.
+    '''
+    if T is None:
+        T = Trace()
+    memo = {}
+    results = []
+    # state tests on the path by variable, and the set of them
+    facts = {}
+    fact_sets = [frozenset()]
+    def add_fact(t, holds):
+        facts.setdefault(t.var, []).append((t, holds))
+        fact_sets.append(fact_sets[-1] | frozenset([(t, holds)]))
+    def pop_fact(t):
+        facts[t.var].pop()
+        fact_sets.pop()
+
+    # frames: (0, d) enters d, (1, d) goes on to the rchild 
+    # of d once its lchild is pruned, (2, d) builds d from the
+    # pruned children, and (3, d) records the result of d 
+    # after the child its test decides (or its chain of nodes)
+    stack = [(0, fdd, None, None)]
+    while stack:
+        (kind, d, key, mark) = stack.pop()
+        if kind == 0:
+            key = (d, T.fingerprint(), fact_sets[-1])
+            if key in memo:
+                results.append(memo[key])
+            elif isinstance(d, Leaf):
+                memo[key] = d
+                results.append(d)
+            elif isinstance(d, Switch):
+                stack.append((3, d, key, None))
+                stack.append((0, d.expand(), None, None))
+            else:
+                t = d.test
+                if isinstance(t, STest):
+                    res = state_test_result(t, facts, T)
+                else:
+                    res = T.equal([t.lh], [t.rh])
+                if res == Trace.BOTH:
+                    if isinstance(t, STest):
+                        add_fact(t, True)
+                    mark = FDDTranslator.get_next_trace(T, t, True)
+                    stack.append((1, d, key, mark))
+                    stack.append((0, d.lchild, None, None))
+                else:
+                    stack.append((3, d, key, None))
+                    stack.append((0, d.lchild if res == Trace.EQ else d.rchild, None, None))
+        elif kind == 1:
+            T.rollback(mark)
+            if isinstance(d.test, STest):
+                pop_fact(d.test)
+                add_fact(d.test, False)
+            mark = FDDTranslator.get_next_trace(T, d.test, False)
+            stack.append((2, d, key, mark))
+            stack.append((0, d.rchild, None, None))
+        elif kind == 2:
+            T.rollback(mark)
+            if isinstance(d.test, STest):
+                pop_fact(d.test)
+            rchild = results.pop()
+            lchild = results.pop()
+            res = lchild if lchild is rchild else Node(d.test, lchild, rchild)
+            memo[key] = res
+            results.append(res)
+        else:
+            memo[key] = results[-1]
+    prune_stats['before'] = dag_size(fdd)
+    prune_stats['after'] = dag_size(results[-1])
+    return results[-1]
+
+#########################################
+#####          Statistics           #####
+#########################################
+
+# operations counted and timed when instrumentation is on
+instrumented_ops = {'FDDTranslator' : ['seq', 'par', 'restrict', 
+                                       'act_seq', 'refine_tree'],
+                    'Trace' : ['add_equality', 'add_inequality', 'rollback',
+                               'equal', 'equal_value', 'equal_field',
+                               'fingerprint']}
+
+# per-operation calls and time (of the outermost calls,
+# as operations are recursive), by 'class.operation'
+op_stats = {}
+
+# original methods, while instrumentation is on
+uninstrumented = {}
+
+def timed_op(name, f):
+    stat = op_stats.setdefault(name, {'calls' : 0, 'time' : 0.0})
+    depth = [0]
+
+    @wraps(f)
+    def wrapper(*args):
+        stat['calls'] += 1
+        if depth[0] > 0:
+            return f(*args)
+        depth[0] += 1
+        t_s = time.time()
+        try:
+            return f(*args)
+        finally:
+            stat['time'] += time.time() - t_s
+            depth[0] -= 1
+    return wrapper
+
+def set_instrumentation(on):
+    '''
+    turns counting and timing of the operations in 
+    instrumented_ops on or off. It costs nothing when off
+    as the original methods are put back.
+    '''
+    classes = {'FDDTranslator' : FDDTranslator, 'Trace' : Trace}
+    if on and not uninstrumented:
+        for (cls_name, names) in instrumented_ops.items():
+            cls = classes[cls_name]
+            for name in names:
+                meth = cls.__dict__[name]
+                uninstrumented[cls_name, name] = meth
+                op_name = '%s.%s' % (cls_name, name)
+                if isinstance(meth, classmethod):
+                    meth = classmethod(timed_op(op_name, meth.__func__))
+                else:
+                    meth = timed_op(op_name, meth)
+                setattr(cls, name, meth)
+    elif not on:
+        for ((cls_name, name), meth) in uninstrumented.items():
+            setattr(classes[cls_name], name, meth)
+        uninstrumented.clear()
+
+def reset_op_stats():
+    for stat in op_stats.values():
+        stat['calls'] = 0
+        stat['time'] = 0.0
+
+def fdd_stats(fdd):
+    '''
+    size and shape of fdd: nodes and leaves counted once
+    (dag_*) and once per path (tree_*), depth in tests
+    (a switch counting as one) and the number of distinct tests per field and 
+    per state variable
+    '''
+    res = {'dag_nodes' : 0, 'dag_leaves' : 0}
+    tree = {}
+    depth = {}
+    tests_per_field = {}
+    tests_per_state = {}
+    for d in postorder(fdd):
+        if isinstance(d, Node):
+            res['dag_nodes'] += 1
+            (ln, ll) = tree[d.lchild]
+            (rn, rl) = tree[d.rchild]
+            tree[d] = (ln + rn + 1, ll + rl)
+            depth[d] = max(depth[d.lchild], depth[d.rchild]) + 1
+            t = d.test
+            if isinstance(t, STest):
+                tests_per_state.setdefault(t.var, set()).add(t)
+            else:
+                tests_per_field.setdefault(t.lh, set()).add(t)
+                if isinstance(t, FFTest):
+                    tests_per_field.setdefault(t.rh, set()).add(t)
+        elif isinstance(d, Switch):
+            res['dag_nodes'] += 1
+            children = d.children()
+            tree[d] = (sum([tree[c][0] for c in children]) + 1,
+                       sum([tree[c][1] for c in children]))
+            depth[d] = max([depth[c] for c in children]) + 1
+            tests_per_field.setdefault(d.field, set()).update([t for (t, _) in d.chain()])
+        elif isinstance(d, Leaf):
+            res['dag_leaves'] += 1
+            tree[d] = (0, 1)
+            depth[d] = 0
         else:
             raise TypeError
+    (res['tree_nodes'], res['tree_leaves']) = tree[fdd]
+    res['depth'] = depth[fdd]
+    res['tests_per_field'] = dict([(f, len(ts)) for (f, ts) in tests_per_field.items()])
+    res['tests_per_state'] = dict([(v, len(ts)) for (v, ts) in tests_per_state.items()])
+    return res
+
+def get_stats(fdd=None):
+    '''
+    statistics as a dict of plain values (so it can be
+    written as JSON): the shape of fdd, if given, the 
+    operation counts and times, the operation caches 
+    with their hit rates, the garbage collections and 
+    the last prune
+    '''
+    caches = get_cache_stats()
+    for stat in caches.values():
+        total = stat['hits'] + stat['misses']
+        stat['hit_rate'] = float(stat['hits']) / total if total > 0 else 0.0
+    res = {'ops' : copy.deepcopy(op_stats), 'caches' : caches,
+           'gc' : dict(gc_stats), 'prune' : dict(prune_stats)}
+    if not fdd is None:
+        res['fdd'] = fdd_stats(fdd)
+    return res
+
+
+#########################################
+#####       Garbage collection      #####
+#########################################
+# The tables above own all the nodes, tests and action sets, 
+# and nodes are kept alive by the unique table and the operation
+# caches. In a process that compiles many times without 
+# resetting the tables (see TranslationMemo), FDDs that are 
+# still needed are registered as roots (ref/deref), and collect
+# drops everything that can not be reached from them.
+
+# number of references to each root FDD
+roots = {}
+
+# collect runs (in maybe_collect) when there are more nodes
+# than this in the unique table, which is then set to twice
+# the number of nodes left, or when the resident memory of
+# the process is more than gc_memory_limit bytes (if set)
+gc_threshold = 1 << 16
+gc_min_threshold = 1 << 16
+gc_memory_limit = None
+
+gc_stats = {'collections' : 0, 'nodes_freed' : 0, 'bytes_freed' : 0}
+
+def ref(fdd):
+    ''' registers fdd as a root, returns fdd '''
+    roots[fdd] = roots.get(fdd, 0) + 1
+    return fdd
+
+def deref(fdd):
+    '''
+    drops one reference to the root fdd, if it is
+    still a root (reset_tables drops all the roots)
+    '''
+    if not fdd in roots:
+        return
+    count = roots[fdd] - 1
+    if count == 0:
+        del roots[fdd]
     else:
-        #print '-----------'
-        #print path, assump.assump_trace
-        #print '-----------'
-        return assump.assump_trace
-    
-#TODO: more testing
-def state_req(fdd, all_inports, inport_trace, states, st_req, 
-              first, assump, path):
-    #print fdd_str(fdd)
-    #print st_req
-    #print '--------------------'
-    if isinstance(fdd, Node):
-        t = fdd.test
-        ttype = type(t)
-        if ttype == FVTest:
-            f = t.lh
-            v = t.rh
-            (true_dict, false_set) = path
-            assert not f in true_dict
-            true_dict[f] = v
-            (eq, neq) = inport_trace
-            new_eq = eq
-            new_neq = neq
-            if t.lh == 'inport':
-                new_eq = {t.rh}
-                new_neq = neq + [t.rh]
-            state_req(fdd.lchild, all_inports, (new_eq, neq), states, st_req, 
-                        first, assump, (true_dict, false_set))
-            del true_dict[f]
-            new_false = false_set | {(f, v)}
-            state_req(fdd.rchild, all_inports, (eq, new_neq), states, st_req, 
-                        first, assump, (true_dict, new_false))
+        roots[fdd] = count
+
+def rss():
+    ''' resident memory of the process in bytes, None if unknown '''
+    try:
+        f = open('/proc/self/statm')
+        try:
+            pages = int(f.read().split()[1])
+        finally:
+            f.close()
+    except (IOError, IndexError, ValueError):
+        return None
+    return pages * resource.getpagesize()
+
+def is_live(x, live, live_tests):
+    ''' whether the nodes and tests in x are all live '''
+    if isinstance(x, FDD):
+        return x in live
+    if isinstance(x, Test):
+        return x in live_tests
+    if isinstance(x, (tuple, frozenset)):
+        for y in x:
+            if not is_live(y, live, live_tests):
+                return False
+    return True
+
+def refill(table, items):
+    ''' replaces the items of table, so that its memory is freed '''
+    table.clear()
+    table.update(items)
+
+def collect():
+    '''
+    drops the nodes that can not be reached from the roots 
+    (or the id and drop leaves), along with the tests and action 
+    sets only they use and the cache entries that refer to them.
+    FDDs that are not reachable from a root must not be used
+    afterwards. Returns an estimate of the bytes freed.
+    '''
+    global gc_threshold
+    live = set()
+    for d in roots.keys() + [id_leaf(), drop_leaf()]:
+        live.update(preorder(d))
+    # FDDs specialized to inports live as long as the FDD
+    # (and the assumptions) they were specialized from
+    kept_inports = [(key, val) for (key, val) in inport_fdds.items()
+                    if key[0] in live and (key[1] is None or key[1] in live)]
+    for (_, cached) in kept_inports:
+        for d in cached.values():
+            live.update(preorder(d))
+    live_tests = set([d.test for d in live if isinstance(d, Node)])
+    live_acts = set([d.acts for d in live if isinstance(d, Leaf)])
+
+    before = 0
+    freed = 0
+    tables = [unique_table, test_index, action_index, leaf_index, 
+              inport_fdds, fdd_indexes, test_table, test_order, 
+              test_order_keys, action_table]
+    for cache in op_caches.values():
+        tables.extend([cache.table, cache.order])
+    for table in tables:
+        before += sys.getsizeof(table)
+
+    dead = [d for d in unique_table.itervalues() if not d in live]
+    freed += sum([sys.getsizeof(d) for d in dead])
+    refill(unique_table, [(k, d) for (k, d) in unique_table.iteritems() if d in live])
+    refill(leaf_index, [(k, d) for (k, d) in leaf_index.iteritems() if d in live])
+    refill(inport_fdds, kept_inports)
+    refill(inport_ids, [(d, x) for (d, x) in inport_ids.iteritems() if d in live])
+    refill(fdd_indexes, [(d, x) for (d, x) in fdd_indexes.iteritems() if d in live])
+
+    freed += sum([sys.getsizeof(t) for t in test_table if not t in live_tests])
+    refill(test_index, [(k, t) for (k, t) in test_index.iteritems() if t in live_tests])
+    test_table[:] = [t for t in test_table if t in live_tests]
+    order = [(k, t) for (k, t) in zip(test_order_keys, test_order) if t in live_tests]
+    test_order_keys[:] = [k for (k, _) in order]
+    test_order[:] = [t for (_, t) in order]
+
+    freed += sum([sys.getsizeof(a) for a in action_table if not a in live_acts])
+    refill(action_index, [(k, a) for (k, a) in action_index.iteritems() if a in live_acts])
+    action_table[:] = [a for a in action_table if a in live_acts]
+
+    for cache in op_caches.values():
+        items = [(k, v) for (k, v) in cache.table.iteritems() 
+                    if is_live(k, live, live_tests) and is_live(v, live, live_tests)]
+        refill(cache.table, items)
+        cache.order = deque([k for k in cache.order if k in cache.table])
+
+    after = sum([sys.getsizeof(table) for table in tables])
+    freed += max(before - after, 0)
+    gc_threshold = max(gc_min_threshold, 2 * len(unique_table))
+    gc_stats['collections'] += 1
+    gc_stats['nodes_freed'] += len(dead)
+    gc_stats['bytes_freed'] += freed
+    return freed
+
+def maybe_collect():
+    '''
+    runs collect if the unique table or the process
+    got too large, returns the bytes freed (or 0)
+    '''
+    if len(unique_table) > gc_threshold:
+        return collect()
+    if not gc_memory_limit is None:
+        size = rss()
+        if not size is None and size > gc_memory_limit:
+            return collect()
+    return 0
+
+
+#########################################
+#####            Indexing           #####
+#########################################
+
+class FDDIndex(object):
+    '''
+    what code generation needs to know about an FDD, 
+    gathered in a single pass over it (shared nodes once):
+    ids: set on the nodes without one, as asgn_id does
+    states: the state variables tested or modified 
+            in each sub-FDD
+    state_info: the length of the index of each state variable
+    next_id: the id after the last one assigned
+    '''
+
+    def __init__(self, fdd, num=0):
+        self.root = fdd
+        self.states = {}
+        self.state_info = {}
+        self.frontiers = {}
+        empty = frozenset()
+        # visits: 0 before the children, 1 between them
+        # (in-order, for the id) and 2 after them
+        stack = [(fdd, 0)]
+        while stack:
+            (d, visit) = stack.pop()
+            if visit == 0:
+                if d in self.states:
+                    continue
+                if isinstance(d, Leaf):
+                    if d.id is None:
+                        d.set_id(num, 1)
+                        num += 1
+                    mods = set()
+                    for act_seq in d.act_info:
+                        _, smods = d.act_info[act_seq]
+                        for s in smods:
+                            mods.add(s)
+                            if not s in self.state_info:
+                                self.state_info[s] = len(smods[s][0].index)
+                    self.states[d] = frozenset(mods) if len(mods) > 0 else empty
+                elif isinstance(d, Node):
+                    self.states[d] = None
+                    stack.append((d, 2))
+                    stack.append((d.rchild, 0))
+                    stack.append((d, 1))
+                    stack.append((d.lchild, 0))
+                elif isinstance(d, Switch):
+                    # the cases come first, as lchildren of its chain
+                    self.states[d] = None
+                    stack.append((d, 2))
+                    stack.append((d.default, 0))
+                    stack.append((d, 1))
+                    for (_, c) in reversed(d.cases):
+                        stack.append((c, 0))
+                else:
+                    raise TypeError
+            elif visit == 1:
+                if d.id is None:
+                    d.set_id(num)
+                    num += 1
+            else:
+                res = empty
+                for c in d.children():
+                    res = res | self.states[c]
+                if isinstance(d, Node) and isinstance(d.test, STest):
+                    if not d.test.var in self.state_info:
+                        self.state_info[d.test.var] = len(d.test.index)
+                    res = res | set([d.test.var])
+                self.states[d] = res
+        self.next_id = num
+
+    def sub_fdds(self, states):
+        '''
+        returns, in preorder, the nodes testing a state variable
+        of states that are not under another one, and the leaves
+        modifying one that are not under such a node either. 
+        Sub-FDDs without those state variables are skipped.
+        '''
+        key = frozenset(states)
+        if not key in self.frontiers:
+            def is_sub_fdd(d):
+                return isinstance(d, Node) and isinstance(d.test, STest) and d.test.var in key
+            def prune(d):
+                return is_sub_fdd(d) or key.isdisjoint(self.states[d])
+            res = []
+            for d in preorder(self.root, prune):
+                if is_sub_fdd(d) or (isinstance(d, Leaf) and not key.isdisjoint(self.states[d])):
+                    res.append(d)
+            self.frontiers[key] = res
+        return list(self.frontiers[key])
+
+def fdd_index(fdd):
+    '''
+    returns the FDDIndex of fdd, built (and ids assigned 
+    from 0) the first time. Indexes are dropped along with
+    the ids (see TranslationMemo.prepare) and the tables.
+    '''
+    if not fdd in fdd_indexes:
+        fdd_indexes[fdd] = FDDIndex(fdd)
+    return fdd_indexes[fdd]
+
+#########################################################
+#####        State Requirement Extraction           #####
+#########################################################
+def specialize(fdd, f, v, memo=None, holds=True):
+    '''
+    returns the part of fdd above its state tests (the part
+    edge switches run) for packets with f = v: tests of f 
+    decided by it are removed (for a prefix v, those against
+    the prefixes containing v or disjoint from it), other nodes
+    are kept. If holds is False, it is for packets with f != v 
+    instead and only the tests of f against v (or prefixes in 
+    it) are removed. Switches on f are decided by a lookup.
+    memo maps nodes to their results and can be shared 
+    between calls with the same arguments.
+    '''
+    if memo is None:
+        memo = {}
+    stack = [(fdd, False)]
+    while stack:
+        (d, expanded) = stack.pop()
+        if d in memo:
+            continue
+        if isinstance(d, Switch):
+            if d.field != f:
+                child = None
+            elif is_prefix(v):
+                child = d.expand()
+            elif holds:
+                child = d.child(v)
+            elif v in d.table:
+                child = switch(f, [x for x in d.cases if x[0] != v], d.default)
+            else:
+                child = None
+            if not child is None and expanded:
+                memo[d] = memo[child]
+            elif not child is None:
+                stack.append((d, True))
+                stack.append((child, False))
+            elif expanded:
+                memo[d] = switch(d.field, [(x, memo[c]) for (x, c) in d.cases], 
+                                 memo[d.default])
+            else:
+                stack.append((d, True))
+                for c in reversed(d.children()):
+                    stack.append((c, False))
+            continue
+        if isinstance(d, Leaf) or isinstance(d.test, STest):
+            memo[d] = d
+            continue
+        t = d.test
+        rel = Trace.BOTH
+        if isinstance(t, FVTest) and t.lh == f:
+            if holds:
+                rel = Trace.relation(v, t.rh)
+            elif Trace.relation(t.rh, v) == Trace.EQ:
+                rel = Trace.NEQ
+        if rel != Trace.BOTH:
+            child = d.lchild if rel == Trace.EQ else d.rchild
+            if expanded:
+                memo[d] = memo[child]
+            else:
+                stack.append((d, True))
+                stack.append((child, False))
+        elif expanded:
+            (lchild, rchild) = (memo[d.lchild], memo[d.rchild])
+            memo[d] = lchild if lchild == rchild else Node(t, lchild, rchild)
         else:
-            if first:
-                (eq1, neq1) = get_assump_inport_trace(assump, path)
-                (eq2, neq2) = inport_trace
-                inport_trace = (eq1 | eq2 , neq1 + neq2)
-            if ttype == STest:
-                states.add(t.var)
-                state_req(fdd.lchild, all_inports, inport_trace, states, st_req, False, None, None)
-                state_req(fdd.rchild, all_inports, inport_trace, states, st_req, False, None, None)
-                states.discard(t.var)
+            stack.append((d, True))
+            stack.append((d.rchild, False))
+            stack.append((d.lchild, False))
+    return memo[fdd]
+
+def assume(fdd, assump):
+    '''
+    returns fdd without the field tests above its state tests
+    that are decided by assump (which only tests fields) on
+    the way there, as packets that do not satisfy assump are
+    taken not to occur.
+    '''
+    fields = tested_fields(assump)
+    cofactors = {}
+    def cofactor(a, f, v, holds):
+        if not f in fields:
+            return a
+        if not (a, f, v, holds) in cofactors:
+            cofactors[a, f, v, holds] = specialize(a, f, v, holds=holds)
+        return cofactors[a, f, v, holds]
+
+    def switch_plan(d, a):
+        # follows the chain of the switch as for nodes: the 
+        # cases assump rules out are dropped, and so is the 
+        # rest of the chain after the first case it implies
+        (cases, rest) = ([], a)
+        for (t, c) in reversed(d.chain()):
+            (la, ra) = (cofactor(rest, d.field, t.rh, True), 
+                        cofactor(rest, d.field, t.rh, False))
+            if la is drop_leaf():
+                rest = ra
+            elif ra is drop_leaf():
+                return (cases, (c, la))
             else:
-                state_req(fdd.lchild, all_inports, inport_trace, states, st_req, False, None, None)
-                state_req(fdd.rchild, all_inports, inport_trace, states, st_req, False, None, None)
-    
-    elif isinstance(fdd, Leaf):
-        if not fdd.is_drop():
-            if first:
-                (eq1, neq1) = get_assump_inport_trace(assump, path)
-                (eq2, neq2) = inport_trace
-                inport_trace = (eq1 | eq2 , neq1 + neq2)
-
-            (eq, neq) = inport_trace
-            inports = set()
-            if len(eq) == 0:
-                #inport = set() is considered impossible branch
-                inports = all_inports - set(neq)
+                cases.append((t.rh, (c, la)))
+                rest = ra
+        return (cases, (d.default, rest))
+
+    memo = {}
+    plans = {}
+    stack = [(fdd, assump, False)]
+    while stack:
+        (d, a, expanded) = stack.pop()
+        if not expanded and (d, a) in memo:
+            continue
+        if isinstance(d, Leaf) or isinstance(a, Leaf):
+            memo[d, a] = d
+            continue
+        if isinstance(d, Switch):
+            if not (d, a) in plans:
+                plans[d, a] = switch_plan(d, a)
+            (cases, default) = plans[d, a]
+            if expanded:
+                memo[d, a] = switch(d.field, [(v, memo[x]) for (v, x) in cases], 
+                                    memo[default])
             else:
-                inports = eq
-            
-            port_state_dict = fdd.get_port_state_dict()
-            
-            for outport in port_state_dict:
-                m_states = set(port_state_dict[outport][1].keys())
-                #if outport is None:
-                #    pass 
-                #else:
-                if len(states | m_states) > 0:
-                    for i in inports:
-                        if not i in st_req:
-                            st_req[i] = {}
-                        if not outport in st_req[i]:
-                            st_req[i][outport] = set()
-                        st_req[i][outport] |= states | m_states
-    else:
-        raise TypeError
+                stack.append((d, a, True))
+                stack.append(default + (False,))
+                for (_, x) in reversed(cases):
+                    stack.append(x + (False,))
+            continue
+        if type(d.test) != FVTest:
+            memo[d, a] = d
+            continue
+        (f, v) = (d.test.lh, d.test.rh)
+        (la, ra) = (cofactor(a, f, v, True), cofactor(a, f, v, False))
+        if la is drop_leaf() or ra is drop_leaf():
+            child = (d.rchild, ra) if la is drop_leaf() else (d.lchild, la)
+            if expanded:
+                memo[d, a] = memo[child]
+            else:
+                stack.append((d, a, True))
+                stack.append(child + (False,))
+        elif expanded:
+            (lchild, rchild) = (memo[d.lchild, la], memo[d.rchild, ra])
+            memo[d, a] = lchild if lchild == rchild else Node(d.test, lchild, rchild)
+        else:
+            stack.append((d, a, True))
+            stack.append((d.rchild, ra, False))
+            stack.append((d.lchild, la, False))
+    return memo[fdd, assump]
+
+def specialize_inports(fdd, inports, assump=None):
+    '''
+    returns a dict from each of inports to fdd specialized to
+    it, and if given, to the assumptions for it (see assume).
+    Results are kept in inport_fdds, so ports and switches
+    with the same specialized FDD share it. If fdd has ids,
+    the new nodes get ids following those of fdd and of the
+    FDDs specialized from it before (see inport_ids).
+    '''
+    if not (fdd, assump) in inport_fdds:
+        inport_fdds[fdd, assump] = {}
+    cached = inport_fdds[fdd, assump]
+    res = {}
+    tests_inport = None
+    for i in inports:
+        if not i in cached:
+            if tests_inport is None:
+                tests_inport = 'inport' in tested_fields(fdd)
+            d = specialize(fdd, 'inport', i) if tests_inport else fdd
+            if not assump is None:
+                d = assume(d, specialize(assump, 'inport', i))
+            cached[i] = d
+        res[i] = cached[i]
+    if not fdd.id is None:
+        if not fdd in inport_ids:
+            inport_ids[fdd] = max([d.id for d in preorder(fdd)]) + 1
+        for i in sorted(res):
+            inport_ids[fdd] = asgn_id(res[i], inport_ids[fdd])
+    return res
+
+def path_states(fdd, inport, memo):
+    '''
+    returns a dict from the outports of the leaves of fdd
+    reached by packets from inport to the state variables 
+    tested or modified on the way there. Switches on the
+    inport are decided by a lookup. memo is shared 
+    between inports: results for sub-FDDs that do not 
+    test the inport are kept by node, others by node 
+    and inport.
+    '''
+    def lookup(d):
+        if d in memo:
+            return memo[d]
+        return memo.get((d, inport))
+
+    stack = [(fdd, False)]
+    while stack:
+        (d, expanded) = stack.pop()
+        if not expanded and not lookup(d) is None:
+            continue
+        if isinstance(d, Leaf):
+            res = {}
+            if not d.is_drop():
+                port_state_dict = d.get_port_state_dict()
+                for outport in port_state_dict:
+                    res[outport] = frozenset(port_state_dict[outport][1].keys())
+            memo[d] = (res, False)
+            continue
+        child = None
+        if isinstance(d, Switch):
+            if d.field == 'inport':
+                child = d.child(inport)
+        elif isinstance(d.test, FVTest) and d.test.lh == 'inport':
+            child = d.lchild if d.test.rh == inport else d.rchild
+        if not child is None:
+            if expanded:
+                memo[d, inport] = (lookup(child)[0], True)
+            else:
+                stack.append((d, True))
+                stack.append((child, False))
+        elif expanded:
+            res = {}
+            dep = False
+            for c in d.children():
+                (cres, cdep) = lookup(c)
+                for outport in cres:
+                    res[outport] = res.get(outport, frozenset()) | cres[outport]
+                dep = dep or cdep
+            if isinstance(d, Node) and isinstance(d.test, STest):
+                for outport in res:
+                    res[outport] = res[outport] | {d.test.var}
+            if dep:
+                memo[d, inport] = (res, True)
+            else:
+                memo[d] = (res, False)
+        else:
+            stack.append((d, True))
+            for c in reversed(d.children()):
+                stack.append((c, False))
+    return lookup(fdd)[0]
 
 def get_st_req(fdd, all_inports, assump):
+    '''
+    returns the state variables needed on the way from each 
+    inport to each outport, computed on fdd specialized to 
+    each inport and the assumptions for it
+    '''
     st_req = {}
-    state_req(fdd, set(all_inports), (set(), []), set(), st_req, True, assump, ({}, set()))
+    port_fdds = specialize_inports(fdd, all_inports, assump)
+    memo = {}
+    for i in all_inports:
+        if specialize(assump, 'inport', i) is drop_leaf():
+            # no packets come in from i
+            continue
+        res = path_states(port_fdds[i], i, memo)
+        for outport in res:
+            if len(res[outport]) > 0:
+                if not i in st_req:
+                    st_req[i] = {}
+                st_req[i][outport] = set(res[outport])
     return st_req
 
 
 def get_state_info(fdd, state_info):
-    if isinstance(fdd, Node):
-        t = fdd.test
+    '''
+    sets state_info to the length of the index of each state
+    variable of fdd (an FDD, see FDDIndex, or a FrozenFDD, 
+    whose distinct tests and leaves are read)
+    '''
+    if not isinstance(fdd, FrozenFDD):
+        for (s, n) in fdd_index(fdd).state_info.items():
+            if not s in state_info:
+                state_info[s] = n
+        return
+    for t in fdd.tests:
         if isinstance(t, STest):
             if not t.var in state_info:
                 state_info[t.var] = len(t.index)
-        get_state_info(fdd.lchild, state_info)
-        get_state_info(fdd.rchild, state_info)
-    elif isinstance(fdd, Leaf):
-        for act_seq in fdd.act_info:
-            _, smods = fdd.act_info[act_seq]
+    for d in fdd.leaves:
+        for act_seq in d.act_info:
+            _, smods = d.act_info[act_seq]
             for s in smods:
                 if not s in state_info:
                     state_info[s] = len(smods[s][0].index)
-    else:
-        raise TypeError 
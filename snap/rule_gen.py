@@ -42,6 +42,7 @@ ops = {
       "+" : "Op.Add",
       "-" : "Op.Sub",
       "xor" : "Op.Xor",
+      "&" : "Op.And",
       }
    
 def create_table(name, size, field_type, table_type):
@@ -138,23 +139,9 @@ def get_fields(fields):
     return insts    
 
 def get_sub_fdds(pol_fdd, states, acc):
-    if isinstance(pol_fdd, Node):
-        t = pol_fdd.test
-        if isinstance(t, STest) and t.var in states:
-            acc.append(pol_fdd)
-        else:
-            get_sub_fdds(pol_fdd.lchild, states, acc)
-            get_sub_fdds(pol_fdd.rchild, states, acc)
- 
-    elif isinstance(pol_fdd, Leaf):
-        for act_seq in pol_fdd.act_info:
-            _, smods = pol_fdd.act_info[act_seq]
-            keys = set(smods.keys())
-            if len(states & keys) > 0:
-                acc.append(pol_fdd)
-                break
-    else:
-        raise TypeError
+    # sub-fdds are shared between paths after hash-consing,
+    # each of them should be added (and generated) once
+    acc.extend(fdd_index(pol_fdd).sub_fdds(states))
 
 def field(fname):
     return "O.Field(Field('%s'))" % fname
@@ -219,6 +206,16 @@ def comp(dst, first, op, second):
     insts = ["I.OP(%s, %s, %s, %s)" % (dst, first, ops[op], second)]
     return insts
 
+def field_value(v):
+    if isinstance(v, IPv4Network):
+        return v._ip
+    elif isinstance(v, MAC):
+        raise TypeError # FIXME
+    elif isinstance(v, int):
+        return v
+    else:
+        raise TypeError
+
 def get_value(x):
     if isinstance(x, bool):
         return (1 if x else 0)
@@ -227,42 +224,68 @@ def get_value(x):
     else:
         raise TypeError
 
+def node_label(fdd, to_leaf):
+    # the code of a node at the edge (not to_leaf) stops at the
+    # state tests and differs from its code after LBL_ST, so
+    # the two have labels of their own
+    return ("LBL_%d" if to_leaf else "LBL_E%d") % fdd.id
+
 def get_fdd_insts(fdd, fields, states, ranks, state_sw_map, 
-                  state_port_map, insts, to_leaf=True):
-    insts.extend(ilabel("LBL_%d" % fdd.id))
+                  state_port_map, insts, to_leaf=True, emitted=None):
+    # nodes are generated in pre-order, left child first so that
+    # it falls through from its parent. A node shared between 
+    # paths (or with the FDDs in emitted, generated with the 
+    # same to_leaf) is generated once, other paths jump to its label
+    if emitted is None:
+        emitted = set()
+    stack = [fdd]
+    while stack:
+        fdd = stack.pop()
+        if fdd in emitted:
+            insts.extend(jump(node_label(fdd, to_leaf)))
+            continue
+        emitted.add(fdd)
+        get_node_insts(fdd, fields, states, ranks, state_sw_map,
+                       state_port_map, insts, to_leaf, stack)
+
+def get_node_insts(fdd, fields, states, ranks, state_sw_map, 
+                   state_port_map, insts, to_leaf, stack):
+    '''
+    generates the instructions of a single node, pushing
+    its children on stack if they should follow it
+    '''
+    insts.extend(ilabel(node_label(fdd, to_leaf)))
     if isinstance(fdd, Node):
         t = fdd.test
         if isinstance(t, FVTest):
-            if isinstance(t.rh, IPv4Network):
-                rh = t.rh._ip
-            elif isinstance(t.rh, MAC):
-                raise TypeError # FIXME
-            elif isinstance(t.rh, int):
-                rh = t.rh
-            else:
-                raise TypeError
             size = fields[t.lh][0] 
-            insts.extend(branch(field(t.lh), "!=", value(rh, size), label("LBL_%d" % (fdd.rchild.id))))
+            if is_prefix(t.rh):
+                # compares the masked field with the network
+                insts.extend(comp(field("value"), field(t.lh), "&", value(int(t.rh.netmask), size)))
+                insts.extend(branch(field("value"), "!=", value(int(t.rh.network), size), label(node_label(fdd.rchild, to_leaf))))
+            else:
+                rh = field_value(t.rh)
+                insts.extend(branch(field(t.lh), "!=", value(rh, size), label(node_label(fdd.rchild, to_leaf))))
         elif isinstance(t, FFTest):
-            insts.extend(branch(field(t.lh), "!=", field(t.rh), label("LBL_%d" % (fdd.rchild.id))))
+            insts.extend(branch(field(t.lh), "!=", field(t.rh), label(node_label(fdd.rchild, to_leaf))))
         elif isinstance(t, STest):
             s = t.var
             if s in states: 
                 if to_leaf: # TODO: lots of other cases here, index not field, value being field...
                     match = [field(f) for f in t.index]
                     insts.extend(lookup("%s_index" % s, operands(match, "_"), field("index")))
-                    insts.extend(branch(field("index"), "!=", value(-1, def_length), label("LBL_%d_1" % fdd.id))) 
+                    insts.extend(branch(field("index"), "!=", value(-1, def_length), label(node_label(fdd, to_leaf) + "_1"))) 
                     insts.extend(load("%s_meta" % s, operands([field("value")], "__"), value(1, def_length)))
-                    insts.extend(jump("LBL_%d_2" % fdd.id))
-                    insts.extend(ilabel("LBL_%d_1" % fdd.id))
+                    insts.extend(jump(node_label(fdd, to_leaf) + "_2"))
+                    insts.extend(ilabel(node_label(fdd, to_leaf) + "_1"))
                     insts.extend(load("%s_value" % s, operands([field("value")], "__"), field("index")))
-                    insts.extend(ilabel("LBL_%d_2" % fdd.id))
+                    insts.extend(ilabel(node_label(fdd, to_leaf) + "_2"))
                     try: # TODO: this is a hack, do a longer term fix
                         rh = get_value(t.rh[0])
-                        insts.extend(branch(field("value"), "!=", value(rh, def_length), label("LBL_%d" % (fdd.rchild.id))))
+                        insts.extend(branch(field("value"), "!=", value(rh, def_length), label(node_label(fdd.rchild, to_leaf))))
                     except TypeError:
                         rh = t.rh[0]
-                        insts.extend(branch(field("value"), "!=", field(rh), label("LBL_%d" % (fdd.rchild.id))))
+                        insts.extend(branch(field("value"), "!=", field(rh), label(node_label(fdd.rchild, to_leaf))))
                 else:
                     insts.extend(load_field(field("exec_node"), value(fdd.id, fdd_id_length))) 
                     insts.extend(jump("LBL_ST"))
@@ -276,10 +299,18 @@ def get_fdd_insts(fdd, fields, states, ranks, state_sw_map,
         else:
             raise TypeError
 
-        get_fdd_insts(fdd.lchild, fields, states, ranks, state_sw_map, 
-                      state_port_map, insts, to_leaf)
-        get_fdd_insts(fdd.rchild, fields, states, ranks, state_sw_map, 
-                      state_port_map, insts, to_leaf)
+        stack.append(fdd.rchild)
+        stack.append(fdd.lchild)
+
+    elif isinstance(fdd, Switch):
+        # NetASM has no indirect jumps, the cases branch to 
+        # their children from a single node and the others
+        # jump to the default
+        size = fields[fdd.field][0]
+        for (v, c) in fdd.cases:
+            insts.extend(branch(field(fdd.field), "=", value(field_value(v), size), label(node_label(c, to_leaf))))
+        insts.extend(jump(node_label(fdd.default, to_leaf)))
+        stack.extend(reversed(fdd.children()))
 
     elif isinstance(fdd, Leaf):
         # TODO: Assuming there is no parallel actions (not sure
@@ -287,11 +318,12 @@ def get_fdd_insts(fdd, fields, states, ranks, state_sw_map,
         act_seq = fdd.act_info.keys()[0]
         fmod, smod = fdd.act_info[act_seq]
         common_st = set(smod.keys()) & states
+        k = 0
         for s in common_st:
             for sm in smod[s]:
                 match = [field(f) for f in sm.index] #TODO: same lost of other cases here...
                 insts.extend(lookup("%s_index" % sm.var, operands(match, "_"), field("index")))
-                insts.extend(branch(field("index"), "!=", value(-1, def_length), label("LBL_%d_1" % fdd.id))) 
+                insts.extend(branch(field("index"), "!=", value(-1, def_length), label("%s_%d_1" % (node_label(fdd, to_leaf), k)))) 
                 
                 # load next index
                 insts.extend(load("%s_meta" % sm.var, operands([field("index")], "__"), value(0, def_length)))
@@ -317,10 +349,10 @@ def get_fdd_insts(fdd, fields, states, ranks, state_sw_map,
                 insts.extend(comp(field("index"), field("index"), "+", value(1, def_length))) # TODO: assuming no overflow
                 insts.extend(store("%s_meta" % sm.var, operands([field("index")], "_"), value(0, def_length))) 
 
-                insts.extend(jump("LBL_%d_2" % fdd.id))
+                insts.extend(jump("%s_%d_2" % (node_label(fdd, to_leaf), k)))
 
                 # figure out the new value
-                insts.extend(ilabel("LBL_%d_1" % fdd.id))
+                insts.extend(ilabel("%s_%d_1" % (node_label(fdd, to_leaf), k)))
                 if isinstance(sm, SInc):
                     insts.extend(load("%s_value" % sm.var, operands([field("value")], "__"), field("index")))
                     if sm.step > 0:
@@ -339,7 +371,8 @@ def get_fdd_insts(fdd, fields, states, ranks, state_sw_map,
 
                 # store the value
                 insts.extend(store("%s_value" % sm.var, operands([field("value")], "_"), field("index")))
-                insts.extend(ilabel("LBL_%d_2" % fdd.id))
+                insts.extend(ilabel("%s_%d_2" % (node_label(fdd, to_leaf), k)))
+                k += 1
                         
         other_st = set(smod.keys()) - common_st 
         max_rank = max([ranks[x] for x in states]) if len(states) > 0 else -1
@@ -359,11 +392,24 @@ def get_fdd_insts(fdd, fields, states, ranks, state_sw_map,
         raise TypeError
 
 def process(pol_fdd, fdds, is_edge, inports, fields,
-            states, ranks, state_sw_map, state_port_map):
+            states, ranks, state_sw_map, state_port_map,
+            port_inports=None, assump=None):
     insts = []
     ids = [f.id for f in fdds]
     insts.extend(ilabel("LBL_PROCESS"))
     if is_edge:
+        # each inport runs pol_fdd specialized to the packets coming 
+        # in from it (port_inports maps the ports of the switch to
+        # their value of the inport field), inports with the same 
+        # specialized FDD share its code
+        if port_inports is None:
+            port_inports = dict(zip(inports, inports))
+        specialized = specialize_inports(pol_fdd, port_inports.values(), assump)
+        port_fdds = dict([(i, specialized[port_inports[i]]) for i in inports])
+        roots = []
+        for i in inports:
+            if not port_fdds[i] in roots:
+                roots.append(port_fdds[i])
         for x in range(len(inports)):
             i = inports[x]
             insts.extend(ilabel("LBL_INP_%d" % i))
@@ -372,11 +418,14 @@ def process(pol_fdd, fdds, is_edge, inports, fields,
             else:
                 lbl = label("LBL_INP_%d" % inports[x + 1]) 
             insts.extend(branch(field("inport_bitmap"), "!=", value((1 << (i - 1)), sw_port_length), lbl))
-            insts.extend(jump("LBL_FDD")) 
-        insts.extend(ilabel("LBL_FDD"))
-        get_fdd_insts(pol_fdd, fields, states, ranks, state_sw_map,
-                    state_port_map, insts, False)
+            insts.extend(jump("LBL_FDD_%d" % roots.index(port_fdds[i]))) 
+        emitted = set()
+        for j in range(len(roots)):
+            insts.extend(ilabel("LBL_FDD_%d" % j))
+            get_fdd_insts(roots[j], fields, states, ranks, state_sw_map,
+                        state_port_map, insts, False, emitted)
     insts.extend(ilabel("LBL_ST"))
+    emitted = set()
     for i in range(len(fdds)):
         fdd = fdds[i]
         if i == len(fdds) - 1:
@@ -385,7 +434,8 @@ def process(pol_fdd, fdds, is_edge, inports, fields,
             lbl = label("LBL_ST_%d" % (i + 1))
         insts.extend(ilabel("LBL_ST_%d" % i))
         insts.extend(branch(field("exec_node"), "!=", value(fdd.id, fdd_id_length), lbl))
-        get_fdd_insts(fdd, fields, states, ranks, state_sw_map, state_port_map, insts, True)
+        get_fdd_insts(fdd, fields, states, ranks, state_sw_map, state_port_map, 
+                      insts, True, emitted)
         
     insts.extend(jump("LBL_ROUTE"))
     return insts
@@ -415,7 +465,8 @@ def routing():
     return insts
 
 def code(n, pol_fdd, is_edge, inports, fields,
-            states, ranks, state_sw_map, state_port_map):
+            states, ranks, state_sw_map, state_port_map,
+            port_inports=None, assump=None):
     insts = []
     insts.extend(branch(field("ethertype"), "=", value(0x0800, fields["ethertype"][0]), label("LBL_CODE")))
     insts.extend(comp(field("outport_bitmap"), field("inport_bitmap"), "xor", value(0xFFFF, 16)))
@@ -425,7 +476,8 @@ def code(n, pol_fdd, is_edge, inports, fields,
     fdds = []
     get_sub_fdds(pol_fdd, states, fdds)
     insts.extend(process(pol_fdd, fdds, is_edge, inports, fields,
-                         states, ranks, state_sw_map, state_port_map))
+                         states, ranks, state_sw_map, state_port_map,
+                         port_inports, assump))
     insts.extend(set_outport(fields))
     insts.extend(routing())
     insts.extend(ilabel("LBL_HALT"))
@@ -476,8 +528,11 @@ def state_meta_com(sw, states):
 
 def generate_dataplane(n, pol_fdd, inports, states, ranks, state_sw_map,
                         state_port_map, is_edge, port_map, R, 
-                        dfile, cfile):
+                        dfile, cfile, port_inports=None, assump=None):
     """
+    port_inports: the value of the inport field of the packets
+    coming in from each of inports, if it is not the port itself
+    assump: if given, the FDD of the assumptions on those packets
     """
     # TODO: commands for two tables, routing and set_outport, and meta table for states
     n = int(n)
@@ -493,7 +548,8 @@ def main():
                                 ",".join(get_fields(parsed_fields)),
                                 ",".join([sfield(f) for f in (parsed_fields.keys() + ["index", "value", "state"])]),
                                 ",\n".join(code(n, pol_fdd, is_edge, inports, parsed_fields,
-                                              states, ranks, state_sw_map, state_port_map)))
+                                              states, ranks, state_sw_map, state_port_map,
+                                              port_inports, assump)))
                                 
     f = open(dfile, 'w')
     f.write(dataplane_str)
@@ -0,0 +1,271 @@
+'''
+Binary format for compiled FDDs.
+
+An FDD is written as three tables and the index of its root:
+
+  header:   MAGIC, version (H)
+  tests:    count (I), then (kind (B), lh, rh) for each test
+  act_sets: count (I), then for each action set the number of
+            action sequences (I), and for each sequence the number
+            of actions (I) followed by (kind (B), lh, rh) per action
+  nodes:    count (I), then fixed-size (test, lchild, rchild)
+            records (NODE) in postorder; leaves have test -1 and
+            lchild set to their action set
+  root:     index of the root node (I)
+
+Shared sub-FDDs are written once and referred to by index,
+so the size is linear in the size of the DAG.
+'''
+
+from snap.fdd import to_tables, from_tables
+from snap.util import MAC
+from ipaddr import IPv4Network, IPv4Address
+import mmap
+import struct
+
+MAGIC = 'SNAPFDD\0'
+VERSION = 1
+
+HEADER = struct.Struct('<8sH')
+COUNT = struct.Struct('<I')
+NODE = struct.Struct('<iII')
+BYTE = struct.Struct('<B')
+INT = struct.Struct('<q')
+NET = struct.Struct('<IB')
+
+test_kinds = ['FV', 'FF', 'S']
+action_kinds = ['F', 'S', 'I']
+
+#########################################
+#####            Values             #####
+#########################################
+
+def dump_value(v, out):
+    if v is None:
+        out.append('N')
+    elif v is True:
+        out.append('T')
+    elif v is False:
+        out.append('F')
+    elif isinstance(v, (int, long)):
+        if -(1 << 63) <= v < (1 << 63):
+            out.append('i' + INT.pack(v))
+        else:
+            s = str(v)
+            out.append('l' + COUNT.pack(len(s)) + s)
+    elif isinstance(v, str):
+        out.append('s' + COUNT.pack(len(v)) + v)
+    elif isinstance(v, unicode):
+        s = v.encode('utf-8')
+        out.append('u' + COUNT.pack(len(s)) + s)
+    elif isinstance(v, IPv4Network):
+        out.append('P' + NET.pack(int(v.ip), v.prefixlen))
+    elif isinstance(v, MAC):
+        out.append('M' + v.to_bytes())
+    elif isinstance(v, tuple):
+        out.append('t' + COUNT.pack(len(v)))
+        for x in v:
+            dump_value(x, out)
+    else:
+        raise TypeError('can not serialize %s' % type(v))
+
+class Reader(object):
+    ''' reads values from a buffer (a string or an mmap) '''
+
+    def __init__(self, buf, pos=0):
+        self.buf = buf
+        self.pos = pos
+
+    def unpack(self, st):
+        if self.pos + st.size > len(self.buf):
+            raise ValueError('truncated FDD data')
+        res = st.unpack_from(self.buf, self.pos)
+        self.pos += st.size
+        return res
+
+    def count(self):
+        return self.unpack(COUNT)[0]
+
+    def kind(self, kinds):
+        i = self.unpack(BYTE)[0]
+        if i >= len(kinds):
+            raise ValueError('unknown kind %d' % i)
+        return kinds[i]
+
+    def bytes(self, n):
+        res = self.buf[self.pos:self.pos + n]
+        if len(res) != n:
+            raise ValueError('truncated FDD data')
+        self.pos += n
+        return res
+
+    def value(self):
+        tag = self.bytes(1)
+        if tag == 'N':
+            return None
+        elif tag == 'T':
+            return True
+        elif tag == 'F':
+            return False
+        elif tag == 'i':
+            return self.unpack(INT)[0]
+        elif tag == 'l':
+            return long(self.bytes(self.count()))
+        elif tag == 's':
+            return self.bytes(self.count())
+        elif tag == 'u':
+            return self.bytes(self.count()).decode('utf-8')
+        elif tag == 'P':
+            (ip, plen) = self.unpack(NET)
+            return IPv4Network('%s/%d' % (IPv4Address(ip), plen))
+        elif tag == 'M':
+            return MAC(self.bytes(6))
+        elif tag == 't':
+            return tuple([self.value() for _ in range(self.count())])
+        raise ValueError('unknown value tag %r' % tag)
+
+#########################################
+#####            Writing            #####
+#########################################
+
+def dump_tables(tables, f):
+    '''
+    writes the tables returned by fdd.to_tables to
+    the file object f, one entry at a time
+    '''
+    (tests, act_sets, nodes) = tables
+    f.write(HEADER.pack(MAGIC, VERSION))
+
+    f.write(COUNT.pack(len(tests)))
+    for (kind, lh, rh) in tests:
+        out = [BYTE.pack(test_kinds.index(kind))]
+        dump_value(lh, out)
+        dump_value(rh, out)
+        f.write(''.join(out))
+
+    f.write(COUNT.pack(len(act_sets)))
+    for act_set in act_sets:
+        out = [COUNT.pack(len(act_set))]
+        for act_seq in act_set:
+            out.append(COUNT.pack(len(act_seq)))
+            for (kind, lh, rh) in act_seq:
+                out.append(BYTE.pack(action_kinds.index(kind)))
+                dump_value(lh, out)
+                dump_value(rh, out)
+        f.write(''.join(out))
+
+    f.write(COUNT.pack(len(nodes)))
+    for (t, l, r) in nodes:
+        f.write(NODE.pack(t, l, max(r, 0)))
+    f.write(COUNT.pack(len(nodes) - 1))
+
+def dump(fdd, f):
+    ''' writes fdd to the file object f '''
+    dump_tables(to_tables(fdd), f)
+
+def dumps(fdd):
+    out = []
+    dump(fdd, Writer(out))
+    return ''.join(out)
+
+def dump_file(fdd, fname):
+    f = open(fname, 'wb')
+    try:
+        dump(fdd, f)
+    finally:
+        f.close()
+
+class Writer(object):
+    ''' collects writes in a list '''
+
+    def __init__(self, out):
+        self.out = out
+
+    def write(self, s):
+        self.out.append(s)
+
+#########################################
+#####            Reading            #####
+#########################################
+
+def read_tables(r):
+    ''' reads the tables of an FDD from the Reader r '''
+    (magic, version) = r.unpack(HEADER)
+    if magic != MAGIC:
+        raise ValueError('not an FDD file')
+    if version != VERSION:
+        raise ValueError('unsupported FDD format version %d' % version)
+
+    tests = []
+    for _ in range(r.count()):
+        kind = r.kind(test_kinds)
+        tests.append((kind, r.value(), r.value()))
+
+    act_sets = []
+    for _ in range(r.count()):
+        act_set = []
+        for _ in range(r.count()):
+            act_seq = []
+            for _ in range(r.count()):
+                kind = r.kind(action_kinds)
+                act_seq.append((kind, r.value(), r.value()))
+            act_set.append(tuple(act_seq))
+        act_sets.append(tuple(act_set))
+
+    num_nodes = r.count()
+    nodes = []
+    for i in range(num_nodes):
+        (t, l, rc) = r.unpack(NODE)
+        if t < 0:
+            if t != -1 or l >= len(act_sets):
+                raise ValueError('corrupt FDD data')
+            rc = -1
+        elif t >= len(tests) or l >= i or rc >= i:
+            # children come before their parents
+            raise ValueError('corrupt FDD data')
+        nodes.append((t, l, rc))
+    root = r.count()
+    if root != num_nodes - 1:
+        raise ValueError('corrupt FDD data')
+    return (tests, act_sets, nodes)
+
+def load(f):
+    ''' reads an fdd written by dump from the file object f '''
+    return from_tables(read_tables(StreamReader(f)))
+
+def loads(s):
+    return from_tables(read_tables(Reader(s)))
+
+def load_file(fname, use_mmap=False):
+    '''
+    reads an fdd written by dump_file. With use_mmap
+    the file is mapped into memory instead of read.
+    '''
+    f = open(fname, 'rb')
+    try:
+        if not use_mmap:
+            return load(f)
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return from_tables(read_tables(Reader(buf)))
+        finally:
+            buf.close()
+    finally:
+        f.close()
+
+class StreamReader(Reader):
+    ''' a Reader over a file object, reading only what it needs '''
+
+    def __init__(self, f):
+        super(StreamReader, self).__init__(None)
+        self.f = f
+
+    def unpack(self, st):
+        return st.unpack(self.bytes(st.size))
+
+    def bytes(self, n):
+        res = self.f.read(n)
+        if len(res) != n:
+            raise ValueError('truncated FDD data')
+        self.pos += n
+        return res
@@ -5,7 +5,9 @@ import pickle
 from snap.lang import *
 from snap.state_dep import st_dep
 from snap import fdd
+from snap import serialize
 from snap import rule_gen as gen
+from snap.cache import digest
 from snap.util import profile
 
 ##################################
@@ -53,34 +55,159 @@ def revise_st_req(st_req, ports, graph, traffic_req):
             res[pu, pv] = st_req[u][v]
     return res
 
+def fdd_settings():
+    ''' the settings of the fdd module that change pol_fdd or st_req '''
+    return (fdd.prune_translated, fdd.sift_threshold, fdd.switch_min_cases)
+
+def dump_pol_fdd(pol_fdd, f):
+    ''' writes pol_fdd along with the field order it was built in '''
+    pickle.dump(fdd.field_rank, f, pickle.HIGHEST_PROTOCOL)
+    serialize.dump(pol_fdd, f)
+
+def load_pol_fdd(f):
+    fdd.set_field_rank(pickle.load(f))
+    return serialize.load(f)
+
+def diff_st_req(old, new):
+    '''
+    returns the (added, removed, changed) port pairs of the
+    state requirements new with respect to old
+    '''
+    added = set([k for k in new if not k in old])
+    removed = set([k for k in old if not k in new])
+    changed = set([k for k in new if k in old and new[k] != old[k]])
+    return (added, removed, changed)
+
 def compile_to_req(pol, assumptions, ports,
-                   graph, traffic_req):
-    (tied, dep, rank) = st_dep(pol)
+                   graph, traffic_req, processes=None, cache=None, 
+                   stats=None, memo=None):
+    '''
+    processes: if given, independent parts of the policy
+    are translated in parallel by that many processes
+    cache: if given, a cache.CompileCache to take st_dep, 
+    pol_fdd and st_req from (and to store them in)
+    stats: if given, a dict that is filled with the
+    statistics of fdd.get_stats for this compilation
+    memo: if given, an fdd.TranslationMemo of the last 
+    compilation, only the sub-policies that changed since
+    are translated again (serially). The tables are then 
+    kept between compilations, and the nodes no longer 
+    needed collected (see fdd.maybe_collect); callers
+    keeping FDDs across compilations should fdd.ref them.
+    If the policy translates to an FDD equivalent to the last
+    one (see fdd.equivalent), its pol_fdd is reused, along with 
+    its st_req if the assumptions and ports are the same too,
+    and memo.unchanged is set.
+    Returns st_req, the states, dep, tied, pol_fdd, the state 
+    ranks and the FDD of the assumptions, to pass to rule_gen.
+    '''
+    if not stats is None:
+        fdd.reset_op_stats()
+        fdd.set_instrumentation(True)
+    try:
+        if cache is None:
+            (tied, dep, rank) = st_dep(pol)
+        else:
+            pol_key = cache.key(pol)
+            st_dep_res = cache.get('st_dep', pol_key)
+            if st_dep_res is None:
+                st_dep_res = st_dep(pol)
+                cache.put('st_dep', pol_key, st_dep_res)
+            (tied, dep, rank) = st_dep_res
+            fdd_key = cache.key(pol, fdd_settings())
     
-    print "dep", dep
-    print "tied", tied
-    @profile
-    def fdd_trans():
-        fdd.state_rank = rank
-        pol_fdd = fdd.FDDTranslator.translate(pol, fdd.Trace()) 
-        fdd.asgn_id(pol_fdd, 0)
-        assump = fdd.FDDTranslator.translate(assumptions, fdd.Trace())
-        return pol_fdd, assump
+        print "dep", dep
+        print "tied", tied
+        @profile
+        def fdd_trans():
+            if memo is None:
+                fdd.state_rank = rank
+                fdd.field_rank = dict(fdd.default_field_rank)
+                fdd.reset_tables()
+            else:
+                memo.prepare(rank)
+                memo.unchanged = False
+                freed = fdd.maybe_collect()
+                if freed > 0:
+                    print "collected FDD nodes, bytes freed", freed
+            pol_fdd = None
+            if cache is not None:
+                pol_fdd = cache.get('pol_fdd', fdd_key, load_pol_fdd)
+                if pol_fdd is not None:
+                    pol_fdd = fdd.to_switches(pol_fdd)
+            if pol_fdd is None:
+                if memo is not None:
+                    translated = memo.translate(pol, fdd.Trace())
+                    print "sub-policies reused/translated", memo.hits, memo.misses
+                    if (memo.translated is not None and 
+                        fdd.equivalent(memo.translated, translated)):
+                        print "policy unchanged since the last compilation"
+                        memo.unchanged = True
+                        pol_fdd = memo.pol_fdd
+                        fdd.set_field_rank(memo.pol_fdd_rank)
+                elif processes is None:
+                    translated = fdd.FDDTranslator.translate(pol, fdd.Trace()) 
+                else:
+                    translated = fdd.FDDTranslator.translate_parallel(pol, fdd.Trace(), processes)
+            if pol_fdd is None:
+                pol_fdd = translated
+                if fdd.prune_translated:
+                    pol_fdd = fdd.prune(pol_fdd)
+                    print "fdd size before/after pruning", fdd.prune_stats['before'], fdd.prune_stats['after']
+                size = fdd.dag_size(pol_fdd)
+                if not fdd.sift_threshold is None and size > fdd.sift_threshold:
+                    pol_fdd = fdd.sift(pol_fdd)
+                    print "fdd size before/after sifting", size, fdd.dag_size(pol_fdd)
+                pol_fdd = fdd.to_switches(pol_fdd)
+                if cache is not None:
+                    cache.put('pol_fdd', fdd_key, pol_fdd, dump_pol_fdd)
+                if memo is not None:
+                    memo.remember(translated, pol_fdd)
+            fdd.fdd_index(pol_fdd)
+            assump = fdd.FDDTranslator.translate(assumptions, fdd.Trace())
+            return pol_fdd, assump
    
-    (pol_fdd, assump) = fdd_trans()
+        (pol_fdd, assump) = fdd_trans()
     
-    print fdd.fdd_str(pol_fdd)
+        print fdd.fdd_str(pol_fdd)
 
-    @profile
-    def st_req():
-        fdd.augment_assump(assump, ports, (set(), []))
-        res = fdd.get_st_req(pol_fdd, ports, assump)
-        return revise_st_req(res, ports, graph, traffic_req)
+        @profile
+        def st_req():
+            res = None
+            if memo is not None:
+                req_inputs = digest((assumptions, ports, fdd_settings()))
+                if memo.unchanged and memo.req is not None and memo.req[0] == req_inputs:
+                    res = memo.req[1]
+            if res is None and cache is not None:
+                # keyed by the FDD rather than the policy, so
+                # that equivalent policies share the entry
+                req_key = cache.key(serialize.dumps(pol_fdd), assumptions, ports,
+                                    fdd_settings())
+                res = cache.get('st_req', req_key)
+            if res is None:
+                res = fdd.get_st_req(pol_fdd, ports, assump)
+                if cache is not None:
+                    cache.put('st_req', req_key, res)
+            if memo is not None and pol_fdd is memo.pol_fdd:
+                memo.req = (req_inputs, res)
+            return revise_st_req(res, ports, graph, traffic_req)
     
-    state_req = st_req()
-    print "state_req", state_req
+        state_req = st_req()
+        print "state_req", state_req
+        if memo is not None:
+            if memo.st_req is not None:
+                (added, removed, changed) = diff_st_req(memo.st_req, state_req)
+                print "state_req added", sorted(added)
+                print "state_req removed", sorted(removed)
+                print "state_req changed", sorted(changed)
+            memo.st_req = state_req
+    finally:
+        if not stats is None:
+            fdd.set_instrumentation(False)
+    if not stats is None:
+        stats.update(fdd.get_stats(pol_fdd))
     return (state_req, rank.keys(), dep, tied, 
-            pol_fdd, rank)
+            pol_fdd, rank, assump)
 
 ##################################
 ####     Compiler-Phase2      ####
@@ -88,8 +215,35 @@ def compile_to_req(pol, assumptions, ports,
 
 
 def compile_from_req(topo, traffic_req, st_req, states, dep, tied, 
-                        stateful=True, timelimit=None):
-    
+                        stateful=True, timelimit=None, cache=None, memo=None):
+    '''
+    cache: if given, a cache.CompileCache to take the
+    solution from (and to store it in)
+    memo: if given, the fdd.TranslationMemo passed to
+    compile_to_req. The solution of the last call is 
+    reused if the inputs did not change since.
+    '''
+    inputs = (topo, traffic_req, st_req, states, dep, tied, stateful, timelimit)
+    if memo is not None:
+        memo_key = digest(inputs)
+        if memo.mip is not None and memo.mip[0] == memo_key:
+            print "MIP inputs unchanged, reusing the last solution"
+            return memo.mip[1]
+    res = None
+    if cache is not None:
+        mip_key = cache.key(*inputs)
+        res = cache.get('mip', mip_key)
+    if res is None:
+        res = solve_mip(topo, traffic_req, st_req, states, dep, tied, 
+                        stateful, timelimit)
+        if cache is not None:
+            cache.put('mip', mip_key, res)
+    if memo is not None:
+        memo.mip = (memo_key, res)
+    return res
+
+def solve_mip(topo, traffic_req, st_req, states, dep, tied, 
+              stateful, timelimit):
     
     from snap.mip import create_mip, optimize_mip
     
@@ -162,6 +316,14 @@ def get_inports(topo, n, port_map):
             inports.append(port_map[n][nei])        
     return inports
 
+def get_port_inports(topo, n, port_map):
+    ''' maps the edge ports of n to the inport they stand for '''
+    res = {}
+    for nei in topo.neighbors(n):
+        if topo.node[nei]['edge_in']:
+            res[port_map[n][nei]] = int(nei[1:])
+    return res
+
 def is_edge(topo, n):
     for nei in topo.neighbors(n):
         if topo.node[nei]['edge_in']:
@@ -169,7 +331,12 @@ def is_edge(topo, n):
     return False
 
 @profile
-def rule_gen(topo, ilp, dep, pol_fdd, state_rank):
+def rule_gen(topo, ilp, dep, pol_fdd, state_rank, assump):
+    '''
+    assump: the FDD of the assumptions returned by compile_to_req,
+    edge switches run pol_fdd specialized to each of their inports 
+    and the assumptions for it. If None, they run pol_fdd as is.
+    '''
     (R, PS, sw_ie, st_to_flow, p_sw) = ilp
     sw_in = zip(*sw_ie)[0]
     p_sw = list(p_sw)
@@ -193,5 +360,6 @@ def rule_gen(topo, ilp, dep, pol_fdd, state_rank):
         gen.generate_dataplane(target, pol_fdd, inports, states, state_rank,
                                     state_sw_map, state_port, len(inports) > 0,
                                     port_map, R,
-                                    "./rules/dataplane_%s.py" % target, "./rules/commands_%s" % target)
+                                    "./rules/dataplane_%s.py" % target, "./rules/commands_%s" % target,
+                                    get_port_inports(topo, target, port_map), assump)
 
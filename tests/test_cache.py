@@ -0,0 +1,103 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import networkx as nx
+
+from snap import cache
+from snap.cache import CompileCache, digest
+from snap.lang import match, modify
+
+class DigestTest(unittest.TestCase):
+
+    def test_structure(self):
+        p = match(srcport=5) >> modify(outport=1)
+        self.assertEqual(digest(p), digest(match(srcport=5) >> modify(outport=1)))
+        self.assertNotEqual(digest(p), digest(match(srcport=5) >> modify(outport=2)))
+        self.assertNotEqual(digest(p), digest(match(srcport=5) + modify(outport=1)))
+
+    def test_values(self):
+        self.assertNotEqual(digest(1), digest('1'))
+        self.assertNotEqual(digest(1), digest(True))
+        self.assertNotEqual(digest((1, 2)), digest([1, 2]))
+        self.assertNotEqual(digest((1, (2, 3))), digest(((1, 2), 3)))
+
+    def test_unordered(self):
+        self.assertEqual(digest(set(range(100))), digest(set(reversed(range(100)))))
+        d1 = dict([(i, str(i)) for i in range(100)])
+        d2 = dict([(i, str(i)) for i in reversed(range(100))])
+        self.assertEqual(digest(d1), digest(d2))
+        g1 = nx.Graph()
+        g1.add_edge('a', 'b', c=1)
+        g1.add_edge('b', 'c', c=2)
+        g2 = nx.Graph()
+        g2.add_edge('c', 'b', c=2)
+        g2.add_edge('b', 'a', c=1)
+        self.assertEqual(digest(g1), digest(g2))
+        g2['a']['b']['c'] = 3
+        self.assertNotEqual(digest(g1), digest(g2))
+
+class CompileCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.cache = CompileCache(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.path, True)
+
+    def test_get_put(self):
+        key = self.cache.key('pol', 1)
+        self.assertIs(self.cache.get('req', key), None)
+        self.cache.put('req', key, {'a' : [1, 2]})
+        self.assertEqual(self.cache.get('req', key), {'a' : [1, 2]})
+        self.assertIs(self.cache.get('mip', key), None)
+        self.assertEqual(self.cache.stats(), {'hits' : 1, 'misses' : 2})
+        self.assertNotEqual(self.cache.key('pol', 2), key)
+
+    def test_unreadable(self):
+        key = self.cache.key('x')
+        f = open(self.cache.entry('req', key), 'wb')
+        f.write('not a pickle')
+        f.close()
+        self.assertIs(self.cache.get('req', key), None)
+        self.assertFalse(os.path.exists(self.cache.entry('req', key)))
+
+    def test_evict(self):
+        for i in range(4):
+            self.cache.put('req', self.cache.key(i), 'x' * 1000)
+            fname = self.cache.entry('req', self.cache.key(i))
+            os.utime(fname, (time.time() - 100 + i, time.time() - 100 + i))
+        # reading an entry makes it the most recently used
+        self.cache.get('req', self.cache.key(0))
+        self.cache.evict(max_bytes=2500)
+        kept = [i for i in range(4) 
+                    if os.path.exists(self.cache.entry('req', self.cache.key(i)))]
+        self.assertEqual(kept, [0, 3])
+        self.cache.evict(max_age=50)
+        self.assertEqual(os.listdir(self.path), 
+                         [os.path.basename(self.cache.entry('req', self.cache.key(0)))])
+        self.cache.clear()
+        self.assertEqual(os.listdir(self.path), [])
+
+    def test_temporary_files(self):
+        # an entry another process is still writing
+        (fd, tmp) = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        os.write(fd, 'x' * 5000)
+        os.close(fd)
+        os.utime(tmp, (0, 0))
+        self.cache.put('req', self.cache.key(1), 'x' * 1000)
+        self.assertEqual(self.cache.evict(max_bytes=2000), 0)
+        self.assertTrue(os.path.exists(tmp))
+        self.cache.evict(max_bytes=0)
+        self.cache.clear()
+        self.assertEqual(os.listdir(self.path), [os.path.basename(tmp)])
+
+    def test_version(self):
+        self.assertNotEqual(self.cache.key('pol'), digest(('pol',)))
+        self.assertEqual(self.cache.key('pol'), digest((cache.CACHE_VERSION, 'pol')))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+import unittest
+
+import numpy as np
+
+from snap import fdd
+from snap.classify import classify_batch, leaf_list, leaf_shares, to_number, is_field
+from snap.fdd import Trace, FDDTranslator, FVTest, STest
+from snap.lang import match, matchState, modify, if_
+from ipaddr import IPv4Network
+
+def walk(d, pkt, state):
+    ''' the leaf the packet (with column values) reaches '''
+    while not isinstance(d, fdd.Leaf):
+        t = d.test
+        if isinstance(t, FVTest):
+            if isinstance(t.rh, IPv4Network):
+                holds = pkt[t.lh] & int(t.rh.netmask) == int(t.rh.network)
+            else:
+                holds = pkt[t.lh] == to_number(t.rh)
+        elif isinstance(t, STest):
+            key = tuple([pkt[e] if is_field(e) else to_number(e) for e in t.index])
+            table = dict([(tuple([to_number(x) for x in k]), v) 
+                            for (k, v) in state[t.var].items()])
+            v = table.get(key)
+            holds = not v is None and all([v[j] == (pkt[e] if is_field(e) else e)
+                                           for (j, e) in enumerate(t.rh)])
+        else:
+            holds = pkt[t.lh] == pkt[t.rh]
+        d = d.lchild if holds else d.rchild
+    return d
+
+class ClassifyTest(unittest.TestCase):
+
+    def setUp(self):
+        fdd.reset_tables()
+        pol = if_(matchState('seen', ['srcip'], [True]), modify(outport=1),
+                  if_(match(dstip='10.0.0.0/24'), modify(outport=2),
+                      match(srcport=5) >> modify(outport=3)) + 
+                  (match(dstip='10.0.1.7') >> modify(outport=4)))
+        self.d = FDDTranslator.translate(pol, Trace())
+        self.state = {'seen' : {(IPv4Network('10.0.1.1'),) : (True,)}}
+        rand = np.random.RandomState(0)
+        base = int(IPv4Network('10.0.0.0').ip)
+        n = 500
+        self.headers = {'srcip' : base + 256 + rand.randint(0, 4, n),
+                        'dstip' : base + rand.randint(0, 512, n),
+                        'srcport' : rand.randint(4, 7, n)}
+        self.headers['dstip'][:10] = base + 256 + 7
+
+    def packet(self, i):
+        return dict([(f, int(col[i])) for (f, col) in self.headers.items()])
+
+    def test_same_leaves(self):
+        res = classify_batch(self.d, self.headers, self.state)
+        leaves = leaf_list(self.d)
+        for i in range(len(res)):
+            self.assertIs(leaves[res[i]], walk(self.d, self.packet(i), self.state))
+        self.assertTrue(len(set(res)) > 3)
+
+    def test_frozen(self):
+        frozen = fdd.freeze(self.d)
+        res = classify_batch(frozen, self.headers, self.state)
+        leaves = leaf_list(frozen)
+        self.assertEqual([leaves[x] for x in res], 
+                         [leaf_list(self.d)[x] for x in 
+                            classify_batch(self.d, self.headers, self.state)])
+        shares = leaf_shares(frozen, self.headers, self.state)
+        self.assertAlmostEqual(shares.sum(), 1.0)
+
+    def test_errors(self):
+        self.assertRaises(KeyError, classify_batch, self.d, self.headers)
+        headers = dict(self.headers, srcport=np.zeros(3))
+        self.assertRaises(ValueError, classify_batch, self.d, headers, self.state)
+        self.assertEqual(len(classify_batch(self.d, {})), 0)
+
+if __name__ == '__main__':
+    unittest.main()
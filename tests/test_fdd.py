@@ -0,0 +1,474 @@
+import json
+import pickle
+import sys
+import unittest
+
+from snap import fdd
+from snap.fdd import Trace, FDDTranslator, Node, Leaf, FVTest, FFTest, STest, FAction
+from snap.lang import match, modify, if_, drop, matchState, setState
+
+def translate(pol):
+    return FDDTranslator.translate(pol, Trace())
+
+def example():
+    return if_(match(srcport=5) | match(dstport=7), modify(outport=1), 
+               if_(match(srcport=6), modify(outport=2), drop))
+
+class HashConsTest(unittest.TestCase):
+
+    def setUp(self):
+        fdd.reset_tables()
+
+    def test_same_structure_same_node(self):
+        a = Leaf(frozenset([(FAction('outport', 1),)]))
+        b = Leaf(frozenset([(FAction('outport', 1),)]))
+        self.assertIs(a, b)
+        n = Node(FVTest('srcport', 5), a, fdd.drop_leaf())
+        self.assertIs(Node(FVTest('srcport', 5), b, fdd.drop_leaf()), n)
+        self.assertIsNot(Node(FVTest('srcport', 6), a, fdd.drop_leaf()), n)
+        self.assertIsNot(Node(FVTest('srcport', 5), fdd.drop_leaf(), a), n)
+
+    def test_translate_twice(self):
+        d = translate(example())
+        self.assertIs(translate(example()), d)
+        size = len(fdd.unique_table)
+        translate(example())
+        self.assertEqual(len(fdd.unique_table), size)
+
+    def test_shared_children(self):
+        sub = lambda : Node(FVTest('dstport', 7), fdd.id_leaf(), fdd.drop_leaf())
+        d = Node(FVTest('srcport', 5), sub(), 
+                 Node(FVTest('srcport', 6), sub(), fdd.drop_leaf()))
+        self.assertIs(d.lchild, d.rchild.lchild)
+        self.assertEqual(fdd.dag_size(d), 5)
+
+    def test_reset_tables(self):
+        d = translate(example())
+        fdd.reset_tables()
+        e = translate(example())
+        self.assertIsNot(e, d)
+        self.assertIs(translate(example()), e)
+
+class OpCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        fdd.reset_tables()
+
+    def test_memoized(self):
+        d1 = translate(match(srcport=5) | match(dstport=7))
+        d2 = translate(modify(outport=1))
+        T = Trace()
+        res = FDDTranslator.seq(d1, d2, T)
+        stats = fdd.get_cache_stats()['seq']
+        self.assertIs(FDDTranslator.seq(d1, d2, T), res)
+        self.assertEqual(fdd.get_cache_stats()['seq']['hits'], stats['hits'] + 1)
+        self.assertIs(FDDTranslator.par(d1, d2, T), FDDTranslator.par(d1, d2, T))
+        self.assertTrue(fdd.get_cache_stats()['par']['hits'] > 0)
+
+    def test_keyed_on_trace(self):
+        pol = match(srcport=5, dstport=7)
+        T = Trace()
+        d = FDDTranslator.translate(pol, T)
+        self.assertIsNot(d, fdd.drop_leaf())
+        T['srcport'] = 6
+        self.assertIs(FDDTranslator.translate(pol, T), fdd.drop_leaf())
+
+    def test_eviction(self):
+        cache = fdd.OpCache('test', 4)
+        for i in range(10):
+            cache.put(i, i)
+            self.assertTrue(len(cache.table) <= 4)
+        self.assertEqual(cache.get(9), 9)
+        self.assertIs(cache.get(0), None)
+        self.assertEqual(cache.stats(), {'hits' : 1, 'misses' : 1, 
+                                         'size' : len(cache.table)})
+
+    def test_put_again(self):
+        cache = fdd.OpCache('test', 4)
+        for i in range(10):
+            cache.put(i % 3, i)
+            cache.put(i, i)
+        self.assertEqual(len(cache.order), len(cache.table))
+        self.assertEqual(sorted(cache.order), sorted(cache.table))
+
+class InternTest(unittest.TestCase):
+
+    def setUp(self):
+        fdd.reset_tables()
+
+    def test_tests(self):
+        t = FVTest('srcport', 5)
+        self.assertIs(FVTest('srcport', 5), t)
+        self.assertIsNot(FVTest('srcport', 6), t)
+        self.assertIs(FFTest('srcport', 'dstport'), FFTest('srcport', 'dstport'))
+        self.assertIs(STest(('s', ('srcip',)), (1,)), STest(('s', ('srcip',)), (1,)))
+        self.assertEqual(len(set([t.tid for t in fdd.test_table])), 
+                         len(fdd.test_table))
+
+    def test_action_sets(self):
+        acts = frozenset([(FAction('outport', 1),), (FAction('outport', 2),)])
+        a = Leaf(acts)
+        self.assertIs(Leaf(set(acts)).acts, a.acts)
+        self.assertIs(fdd.action_index[a.act_set], a.acts)
+        self.assertIsNot(Leaf(frozenset([(FAction('outport', 1),)])).acts, a.acts)
+
+    def test_reset(self):
+        t = FVTest('srcport', 5)
+        fdd.reset_tables()
+        self.assertIsNot(FVTest('srcport', 5), t)
+        self.assertNotEqual(FVTest('srcport', 5).tid, t.tid)
+
+class RankTest(unittest.TestCase):
+
+    def setUp(self):
+        fdd.reset_tables()
+
+    def tearDown(self):
+        fdd.set_field_rank(dict(fdd.default_field_rank))
+
+    def check_order(self):
+        ranks = [t.rank for t in fdd.test_order]
+        self.assertEqual(ranks, sorted(set(ranks)))
+        keys = [t.order_key() for t in fdd.test_order]
+        self.assertEqual(keys, sorted(keys))
+
+    def test_renumbering(self):
+        FVTest('srcport', 1000)
+        FVTest('srcport', 0)
+        # each test goes in the same gap, which runs out
+        for i in range(1, 100):
+            FVTest('srcport', i)
+        self.check_order()
+        self.assertTrue(FVTest('srcport', 2) < FVTest('srcport', 1))
+
+    def test_kinds(self):
+        s = STest(('s', ('srcip',)), (1,))
+        f = FFTest('srcport', 'dstport')
+        v = FVTest('dstport', 7)
+        self.assertTrue(s < f < v)
+        self.check_order()
+
+    def test_rerank(self):
+        d = translate(example())
+        self.assertTrue(fdd.is_ordered(d))
+        fdd.set_field_order(['dstport', 'outport'])
+        self.check_order()
+        self.assertTrue(FVTest('srcport', 5) < FVTest('dstport', 7))
+        self.assertTrue(fdd.is_ordered(fdd.rebuild(d)))
+
+class DeepTest(unittest.TestCase):
+
+    def setUp(self):
+        fdd.reset_tables()
+        self.n = sys.getrecursionlimit() + 100
+        d = fdd.drop_leaf()
+        for i in reversed(range(self.n)):
+            d = Node(FVTest('srcport', i), fdd.id_leaf(), d)
+        self.d = d
+
+    def test_traversals(self):
+        d = self.d
+        self.assertEqual(fdd.dag_size(d), self.n + 2)
+        nodes = list(fdd.preorder(d))
+        self.assertIs(nodes[0], d)
+        self.assertEqual(len(nodes), self.n + 2)
+        nodes = list(fdd.postorder(d))
+        self.assertIs(nodes[-1], d)
+        self.assertEqual(len(set(nodes)), self.n + 2)
+        self.assertEqual(len(fdd.fdd_str(d).splitlines()), 2 * self.n + 1)
+        self.assertTrue(fdd.is_ordered(d))
+
+    def test_rebuilds(self):
+        d = self.d
+        self.assertIs(fdd.from_tables(fdd.to_tables(d)), d)
+        self.assertIs(fdd.map_fdd(d, lambda l : l, 
+                                  lambda n, l, r : Node(n.test, l, r)), d)
+        neg = fdd.map_fdd(d, lambda l : ~l, lambda n, l, r : Node(n.test, l, r))
+        self.assertIs(FDDTranslator.neg(d), neg)
+        self.assertEqual(fdd.asgn_id(d, 0), self.n + 2)
+
+class StatsTest(unittest.TestCase):
+
+    def setUp(self):
+        fdd.reset_tables()
+
+    def tearDown(self):
+        fdd.set_instrumentation(False)
+
+    def test_fdd_stats(self):
+        sub = Node(FVTest('dstport', 7), fdd.id_leaf(), fdd.drop_leaf())
+        d = Node(FVTest('srcport', 5), sub, 
+                 Node(FVTest('srcport', 6), sub, fdd.drop_leaf()))
+        stats = fdd.fdd_stats(d)
+        self.assertEqual((stats['dag_nodes'], stats['dag_leaves']), (3, 2))
+        self.assertEqual((stats['tree_nodes'], stats['tree_leaves']), (4, 5))
+        self.assertEqual(stats['depth'], 3)
+        self.assertEqual(stats['tests_per_field'], {'srcport' : 2, 'dstport' : 1})
+        self.assertEqual(stats['tests_per_state'], {})
+        self.assertEqual(fdd.fdd_stats(fdd.id_leaf())['depth'], 0)
+
+    def test_instrumentation(self):
+        seq = FDDTranslator.__dict__['seq']
+        fdd.set_instrumentation(True)
+        fdd.reset_op_stats()
+        d = translate(example())
+        stats = fdd.get_stats(d)
+        self.assertTrue(stats['ops']['FDDTranslator.seq']['calls'] > 0)
+        self.assertEqual(stats['fdd'], fdd.fdd_stats(d))
+        json.dumps(stats)
+        fdd.set_instrumentation(False)
+        self.assertEqual(fdd.uninstrumented, {})
+        self.assertIs(FDDTranslator.__dict__['seq'], seq)
+        calls = fdd.op_stats['FDDTranslator.seq']['calls']
+        fdd.reset_tables()
+        translate(example())
+        self.assertEqual(fdd.op_stats['FDDTranslator.seq']['calls'], calls)
+
+class LeafTest(unittest.TestCase):
+
+    def setUp(self):
+        fdd.reset_tables()
+
+    def test_refined_once(self):
+        out = FAction('outport', 1)
+        a = Leaf(frozenset([(out,)]))
+        b = Leaf(frozenset([(fdd.id_action, out)]))
+        self.assertIs(b, a)
+        self.assertEqual(len(fdd.action_table), 1)
+        self.assertIs(fdd.leaf_index[frozenset([(fdd.id_action, out)])], a)
+        self.assertIs(Leaf([(fdd.id_action, out)]), a)
+
+    def test_singletons(self):
+        i = fdd.id_leaf()
+        self.assertIs(Leaf(frozenset([(fdd.id_action,)])), i)
+        self.assertIs(Leaf(frozenset([(fdd.drop_action,)])), fdd.drop_leaf())
+        self.assertIs(fdd.id_leaf(), i)
+        self.assertTrue(fdd.drop_leaf().is_drop())
+        self.assertFalse(i.is_drop())
+        fdd.reset_tables()
+        self.assertIsNot(fdd.id_leaf(), i)
+
+    def test_leaf_ops(self):
+        a = Leaf(frozenset([(FAction('outport', 1),)]))
+        T = Trace()
+        self.assertIs(fdd.drop_leaf().par(a, T), a)
+        self.assertIs(a.par(fdd.drop_leaf(), T), a)
+        self.assertIs(fdd.id_leaf().seq(a, T), a)
+        self.assertIs(a.seq(fdd.drop_leaf(), T), fdd.drop_leaf())
+        self.assertIs(fdd.drop_leaf().seq(a, T), fdd.drop_leaf())
+
+class CollectTest(unittest.TestCase):
+
+    def setUp(self):
+        fdd.reset_tables()
+
+    def live(self, *fdds):
+        res = set([fdd.id_leaf(), fdd.drop_leaf()])
+        for d in fdds:
+            res.update(fdd.preorder(d))
+        return res
+
+    def test_collect(self):
+        d = fdd.ref(translate(example()))
+        e = translate(match(dstport=9) >> modify(outport=4))
+        fdd.collect()
+        self.assertEqual(set(fdd.unique_table.values()), self.live(d))
+        tests = set([x.test for x in self.live(d) if isinstance(x, Node)])
+        self.assertEqual(set(fdd.test_table), tests)
+        self.assertEqual(set(fdd.test_order), tests)
+        for cache in fdd.op_caches.values():
+            for (k, v) in cache.table.items():
+                self.assertTrue(fdd.is_live(k, self.live(d), tests))
+                self.assertTrue(fdd.is_live(v, self.live(d), tests))
+        self.assertIs(translate(example()), d)
+        self.assertTrue(fdd.in_tables(d))
+        self.assertFalse(fdd.in_tables(e))
+        self.assertTrue(fdd.equivalent(e, translate(match(dstport=9) >> modify(outport=4))))
+
+    def test_ref_counts(self):
+        d = fdd.ref(fdd.ref(translate(example())))
+        fdd.deref(d)
+        fdd.collect()
+        self.assertTrue(fdd.in_tables(d))
+        fdd.deref(d)
+        fdd.collect()
+        self.assertEqual(set(fdd.unique_table.values()), self.live())
+        self.assertEqual(fdd.test_table, [])
+        self.assertEqual(fdd.roots, {})
+        fdd.deref(d)
+
+class EquivalenceTest(unittest.TestCase):
+
+    def setUp(self):
+        fdd.reset_tables()
+
+    def tearDown(self):
+        fdd.set_field_rank(dict(fdd.default_field_rank))
+
+    def test_same_function(self):
+        d = translate(example())
+        self.assertTrue(fdd.equivalent(d, translate(
+            if_(match(dstport=7) | match(srcport=5), modify(outport=1), 
+                if_(~match(srcport=6), drop, modify(outport=2))))))
+        self.assertFalse(fdd.equivalent(d, translate(
+            if_(match(srcport=5), modify(outport=1), 
+                if_(match(srcport=6), modify(outport=2), drop)))))
+
+    def test_other_tables(self):
+        d = translate(example())
+        fdd.reset_tables()
+        e = translate(example())
+        self.assertFalse(fdd.in_tables(d))
+        self.assertTrue(fdd.equivalent(d, e))
+        self.assertIs(fdd.canonical(d), e)
+        self.assertFalse(fdd.equivalent(d, translate(match(srcport=5))))
+
+    def test_switches_and_order(self):
+        pol = if_(match(srcport=1), modify(outport=1), 
+                  if_(match(srcport=2), modify(outport=2),
+                      if_(match(srcport=3), modify(outport=3), match(dstport=7))))
+        d = translate(pol)
+        s = fdd.to_switches(d, 2)
+        self.assertIsNot(s, d)
+        self.assertTrue(fdd.equivalent(s, d))
+        fdd.set_field_order(['dstport'])
+        self.assertFalse(fdd.is_ordered(d))
+        e = translate(pol)
+        self.assertIsNot(e, d)
+        self.assertTrue(fdd.equivalent(d, e))
+        self.assertTrue(fdd.equivalent(s, e))
+
+class FrozenTest(unittest.TestCase):
+
+    def setUp(self):
+        fdd.reset_tables()
+
+    def test_thaw(self):
+        d = translate(example())
+        frozen = fdd.freeze(d)
+        self.assertEqual(len(frozen), fdd.dag_size(d))
+        self.assertIs(frozen.thaw(), d)
+        self.assertIs(frozen.test(frozen.root), d.test)
+        leaves = [frozen.leaf(i) for i in range(len(frozen)) if frozen.is_leaf(i)]
+        self.assertEqual(set(leaves), 
+                         set([x for x in fdd.preorder(d) if isinstance(x, Leaf)]))
+        for i in range(len(frozen)):
+            if not frozen.is_leaf(i):
+                self.assertTrue(frozen.lo[i] < i and frozen.hi[i] < i)
+
+    def test_switches(self):
+        d = translate(if_(match(srcport=1), modify(outport=1), 
+                          if_(match(srcport=2), modify(outport=2), 
+                              match(srcport=3) >> modify(outport=3))))
+        self.assertIs(fdd.freeze(fdd.to_switches(d, 2)).thaw(), d)
+
+    def test_pickle(self):
+        d = translate(example())
+        s = pickle.dumps(fdd.freeze(d), pickle.HIGHEST_PROTOCOL)
+        self.assertIs(pickle.loads(s).thaw(), d)
+        fdd.reset_tables()
+        e = pickle.loads(s).thaw()
+        self.assertIs(e, translate(example()))
+
+    def test_share(self):
+        d = translate(example())
+        frozen = fdd.freeze(d).share()
+        self.assertIs(frozen.thaw(), d)
+        self.assertIs(pickle.loads(pickle.dumps(frozen)).thaw(), d)
+
+class IndexTest(unittest.TestCase):
+
+    def setUp(self):
+        fdd.reset_tables()
+        pol = if_(matchState('s', ['srcport'], [1]), 
+                  setState('t', ['srcport', 'dstport'], [2]) >> modify(outport=1),
+                  if_(match(dstport=7), setState('t', ['srcport', 'dstport'], [3]), 
+                      modify(outport=2)))
+        self.d = translate(pol + (match(srcport=5) >> modify(outport=3)))
+
+    def test_ids(self):
+        index = fdd.fdd_index(self.d)
+        self.assertIs(fdd.fdd_index(self.d), index)
+        nodes = list(fdd.preorder(self.d))
+        ids = dict([(x, x.id) for x in nodes])
+        self.assertEqual(sorted(ids.values()), range(len(nodes)))
+        self.assertEqual(index.next_id, len(nodes))
+        for x in nodes:
+            x.id = None
+        fdd.asgn_id(self.d, 0)
+        self.assertEqual(dict([(x, x.id) for x in nodes]), ids)
+
+    def test_states(self):
+        index = fdd.fdd_index(self.d)
+        self.assertEqual(index.states[self.d], frozenset(['s', 't']))
+        self.assertEqual(index.state_info, {'s' : 1, 't' : 2})
+        for x in fdd.preorder(self.d):
+            if isinstance(x, Leaf):
+                mods = set([s for info in x.act_info.values() for s in info[1]])
+                self.assertEqual(index.states[x], mods)
+
+    def test_sub_fdds(self):
+        index = fdd.fdd_index(self.d)
+        s_nodes = index.sub_fdds(['s'])
+        self.assertTrue(len(s_nodes) > 0)
+        for x in s_nodes:
+            self.assertEqual(x.test.var, 's')
+        t_leaves = index.sub_fdds(['t'])
+        self.assertTrue(len(t_leaves) > 0)
+        for x in t_leaves:
+            self.assertTrue('t' in index.states[x])
+        both = index.sub_fdds(['s', 't'])
+        under = set()
+        for x in s_nodes:
+            under.update(fdd.preorder(x))
+        self.assertEqual(set(both), set(s_nodes + [x for x in t_leaves if not x in under]))
+        self.assertEqual(index.sub_fdds(['u']), [])
+
+class SwitchTest(unittest.TestCase):
+
+    def setUp(self):
+        fdd.reset_tables()
+        self.pol = if_(match(srcport=1), modify(outport=1), 
+                       if_(match(srcport=2), modify(outport=2),
+                           if_(match(srcport=3), modify(outport=3), 
+                               match(dstport=7))))
+        self.d = translate(self.pol)
+
+    def test_to_switches(self):
+        s = fdd.to_switches(self.d, 3)
+        self.assertTrue(isinstance(s, fdd.Switch))
+        self.assertEqual([v for (v, _) in s.cases], [3, 2, 1])
+        self.assertIs(s.child(2), translate(modify(outport=2)))
+        self.assertIs(s.child(9), s.default)
+        self.assertIs(fdd.to_switches(s, 3), s)
+        self.assertIs(fdd.to_switches(self.d, 4), self.d)
+        self.assertIs(fdd.expand_switches(s), self.d)
+        self.assertIs(s.expand(), self.d)
+
+    def test_switch(self):
+        a = translate(modify(outport=1))
+        b = translate(modify(outport=2))
+        s = fdd.switch('srcport', [(2, b), (1, a), (3, b)], b)
+        self.assertEqual(s.cases, ((1, a),))
+        self.assertIs(fdd.switch('srcport', [(1, b)], b), b)
+        self.assertIs(fdd.switch('srcport', [(1, a)], b), s)
+
+    def test_prefixes(self):
+        d = translate(if_(match(dstip='10.0.0.0/24'), modify(outport=1),
+                          if_(match(dstip='10.0.1.0/24'), modify(outport=2),
+                              if_(match(dstip='10.0.2.0/24'), modify(outport=3), drop))))
+        self.assertIs(fdd.to_switches(d, 2), d)
+
+    def test_operations(self):
+        s = fdd.to_switches(self.d, 2)
+        T = Trace()
+        m = translate(match(dstport=7) >> modify(tos=1))
+        self.assertTrue(fdd.equivalent(FDDTranslator.seq(s, m, T), 
+                                       FDDTranslator.seq(self.d, m, T)))
+        self.assertTrue(fdd.equivalent(FDDTranslator.par(m, s, T), 
+                                       FDDTranslator.par(m, self.d, T)))
+        self.assertEqual(fdd.dag_size(fdd.expand_switches(s)), fdd.dag_size(self.d))
+        self.assertEqual(fdd.fdd_stats(s)['depth'], 2)
+
+if __name__ == '__main__':
+    unittest.main()
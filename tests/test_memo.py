@@ -0,0 +1,65 @@
+import unittest
+
+from snap import fdd, policies
+from snap.fdd import Trace, FDDTranslator, TranslationMemo
+from snap.lang import match, modify
+from snap.state_dep import st_dep
+from tests.test_stateful import compile_to_req
+from tests.util import quiet
+
+def firewall(ports, out_port):
+    (routing, _) = policies.get_route_and_assump_policy(ports)
+    pol = quiet(policies.get_stateful_firewall_policy, ports)
+    return (pol >> routing) + (match(srcport=5) >> modify(outport=out_port))
+
+class TranslationMemoTest(unittest.TestCase):
+
+    def setUp(self):
+        self.state_rank = fdd.state_rank
+        self.ports = range(1, 4)
+        self.memo = TranslationMemo()
+
+    def tearDown(self):
+        self.memo.release()
+        self.memo.forget()
+        fdd.state_rank = self.state_rank
+        fdd.set_field_rank(dict(fdd.default_field_rank))
+        fdd.reset_tables()
+
+    def translate(self, pol):
+        (_, _, rank) = quiet(st_dep, pol)
+        self.memo.prepare(rank)
+        return self.memo.translate(pol, Trace())
+
+    def test_same_policy(self):
+        d = self.translate(firewall(self.ports, 1))
+        self.assertTrue(self.memo.misses > 0)
+        self.assertIs(self.translate(firewall(self.ports, 1)), d)
+        self.assertEqual((self.memo.hits, self.memo.misses), (1, 0))
+
+    def test_changed_policy(self):
+        self.translate(firewall(self.ports, 1))
+        misses = self.memo.misses
+        pol = firewall(self.ports, 2)
+        d = self.translate(pol)
+        self.assertTrue(self.memo.hits > 0)
+        self.assertTrue(0 < self.memo.misses < misses)
+        self.assertIs(FDDTranslator.translate(pol, Trace()), d)
+
+    def test_state_order_change(self):
+        d = self.translate(firewall(self.ports, 1))
+        self.memo.prepare({'other' : 0})
+        self.assertEqual(self.memo.fdds, {})
+        self.assertFalse(fdd.in_tables(d))
+
+    def test_compile_to_req(self):
+        (routing, assump) = policies.get_route_and_assump_policy(self.ports)
+        pol = quiet(policies.get_stateful_firewall_policy, self.ports) >> routing
+        first = compile_to_req(pol, assump, self.ports, memo=self.memo)
+        self.assertFalse(self.memo.unchanged)
+        second = compile_to_req(pol, assump, self.ports, memo=self.memo)
+        self.assertTrue(self.memo.unchanged)
+        self.assertEqual(first[0], second[0])
+
+if __name__ == '__main__':
+    unittest.main()
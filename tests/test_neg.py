@@ -0,0 +1,39 @@
+import unittest
+
+from snap import fdd
+from snap.fdd import Trace, FDDTranslator
+from snap.lang import match, modify, if_, identity, drop
+
+def translate(pol):
+    return FDDTranslator.translate(pol, Trace())
+
+class NegTest(unittest.TestCase):
+
+    def setUp(self):
+        fdd.reset_tables()
+
+    def test_same_function_same_fdd(self):
+        a = match(dstip='10.0.0.1')
+        b = match(srcport=5)
+        self.assertIs(translate(~a), translate(if_(a, drop, identity)))
+        self.assertIs(translate(~(a | b)), translate(~a & ~b))
+        self.assertIs(translate(~(a & b)), translate(~a | ~b))
+
+    def test_double_negation(self):
+        d = translate(match(dstip='10.0.0.0/24') | match(srcport=5, dstport=7))
+        n = FDDTranslator.neg(d)
+        self.assertIsNot(n, d)
+        self.assertIs(FDDTranslator.neg(n), d)
+        self.assertIs(translate(~~(match(dstip='10.0.0.0/24') |
+                                   match(srcport=5, dstport=7))), d)
+
+    def test_leaves(self):
+        self.assertIs(FDDTranslator.neg(fdd.id_leaf()), fdd.drop_leaf())
+        self.assertIs(FDDTranslator.neg(fdd.drop_leaf()), fdd.id_leaf())
+
+    def test_not_a_filter(self):
+        d = translate(if_(match(srcport=5), modify(outport=1), drop))
+        self.assertRaises(TypeError, FDDTranslator.neg, d)
+
+if __name__ == '__main__':
+    unittest.main()
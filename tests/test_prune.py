@@ -0,0 +1,67 @@
+import unittest
+
+from snap import fdd
+from snap.fdd import Trace, FDDTranslator, Node, Leaf, FVTest, STest, FAction
+from snap.lang import match, modify, if_, drop
+from tests.util import outputs
+
+def out_leaf(port):
+    return Leaf(frozenset([(FAction('outport', port),)]))
+
+class PruneTest(unittest.TestCase):
+
+    def setUp(self):
+        fdd.reset_tables()
+        (self.a, self.b, self.c) = (out_leaf(1), out_leaf(2), out_leaf(3))
+
+    def test_field_tests(self):
+        (a, b, c) = (self.a, self.b, self.c)
+        d = Node(FVTest('srcport', 5), Node(FVTest('srcport', 6), a, b), c)
+        self.assertIs(fdd.prune(d), Node(FVTest('srcport', 5), b, c))
+        self.assertEqual(fdd.prune_stats, {'before' : 5, 'after' : 3})
+        d = Node(FVTest('srcport', 5), Node(FVTest('dstport', 7), a, b), 
+                 Node(FVTest('dstport', 7), a, a))
+        self.assertIs(fdd.prune(d), Node(FVTest('srcport', 5), d.lchild, a))
+
+    def test_state_tests(self):
+        (a, b, c) = (self.a, self.b, self.c)
+        s1 = STest(('s', ('srcport',)), (1,))
+        s2 = STest(('s', ('srcport',)), (2,))
+        d = Node(s1, Node(s2, a, b), Node(s2, c, b))
+        self.assertIs(fdd.prune(d), Node(s1, b, Node(s2, c, b)))
+        # a different index says nothing
+        s3 = STest(('s', ('dstport',)), (2,))
+        d = Node(s1, Node(s3, a, b), c)
+        self.assertIs(fdd.prune(d), d)
+
+    def test_trace(self):
+        (a, b, c) = (self.a, self.b, self.c)
+        d = Node(FVTest('srcport', 5), Node(FVTest('dstport', 7), a, b), c)
+        T = Trace()
+        T['srcport'] = 5
+        self.assertIs(fdd.prune(d, T), d.lchild)
+        self.assertEqual(T.fmap, {'srcport' : 5})
+        T = Trace()
+        T.add_inequality('srcport', 5)
+        self.assertIs(fdd.prune(d, T), c)
+
+    def test_switch(self):
+        (a, b, c) = (self.a, self.b, self.c)
+        sw = fdd.switch('srcport', [(5, a), (6, b)], c)
+        d = Node(FVTest('dstport', 7), sw, c)
+        T = Trace()
+        T['srcport'] = 6
+        self.assertIs(fdd.prune(d, T), Node(FVTest('dstport', 7), b, c))
+
+    def test_translated(self):
+        pol = if_(match(srcport=5) | match(dstport=7), modify(outport=1), 
+                  if_(match(srcport=6), modify(outport=2), drop))
+        d = FDDTranslator.translate(pol, Trace())
+        p = fdd.prune(d)
+        self.assertIs(p, d)
+        for (s, t) in [(5, 7), (6, 7), (6, 8), (4, 8)]:
+            pkt = {'srcport' : s, 'dstport' : t, 'outport' : 0}
+            self.assertEqual(outputs(p, pkt), outputs(d, pkt))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,49 @@
+import re
+import unittest
+
+from snap import fdd, policies
+from snap import rule_gen as gen
+from snap.state_dep import st_dep
+from tests.util import quiet
+
+label_def = re.compile(r"I\.LBL\(Label\('([^']*)'\)\)")
+label_ref = re.compile(r"Label\('([^']*)'\)")
+
+def edge_code(name, switch_min_cases=None, num_states=None):
+    ports = range(1, 5)
+    (routing, _) = policies.get_route_and_assump_policy(ports)
+    pol = quiet(getattr(policies, name), ports) >> routing
+    (tied, dep, rank) = quiet(st_dep, pol)
+    fdd.state_rank = rank
+    fdd.reset_tables()
+    d = fdd.FDDTranslator.translate(pol, fdd.Trace())
+    if not switch_min_cases is None:
+        d = fdd.to_switches(d, switch_min_cases)
+    states = sorted(rank)[:num_states]
+    return quiet(gen.code, 1, d, True, [1, 2], gen.parsed_fields, set(states), rank,
+                 dict([(s, 2) for s in rank]), {})
+
+class LabelTest(unittest.TestCase):
+
+    def check_labels(self, insts):
+        defined = []
+        used = set()
+        for inst in insts:
+            m = label_def.match(inst)
+            if m:
+                defined.append(m.group(1))
+            else:
+                used.update(label_ref.findall(inst))
+        dups = sorted(set([l for l in defined if defined.count(l) > 1]))
+        self.assertEqual(dups, [])
+        self.assertEqual(sorted(used - set(defined)), [])
+
+    def test_labels_defined_once(self):
+        for name in ['get_stateful_firewall_policy', 'get_tcp_state_machine_policy',
+                     'get_super_spreader_detection_policy']:
+            for min_cases in [None, 2]:
+                for num_states in [None, 1]:
+                    self.check_labels(edge_code(name, min_cases, num_states))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from snap import fdd, policies, serialize
+from snap.fdd import Trace, FDDTranslator
+from snap.state_dep import st_dep
+
+def translate(name):
+    ports = range(1, 5)
+    (routing, _) = policies.get_route_and_assump_policy(ports)
+    out = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        pol = getattr(policies, name)(ports) >> routing
+        (_, _, fdd.state_rank) = st_dep(pol)
+        return FDDTranslator.translate(pol, Trace())
+    finally:
+        sys.stdout.close()
+        sys.stdout = out
+
+names = ['get_stateful_firewall_policy', 'get_tcp_state_machine_policy',
+         'get_dns_tunnel_policy', 'get_sidejack_policy']
+
+class SerializeTest(unittest.TestCase):
+
+    def setUp(self):
+        fdd.reset_tables()
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path, True)
+
+    def test_dumps_loads(self):
+        for name in names:
+            d = translate(name)
+            self.assertIs(serialize.loads(serialize.dumps(d)), d, name)
+
+    def test_new_tables(self):
+        d = translate('get_tcp_state_machine_policy')
+        s = serialize.dumps(d)
+        tables = fdd.to_tables(d)
+        fdd.reset_tables()
+        e = serialize.loads(s)
+        self.assertEqual(fdd.to_tables(e), tables)
+        self.assertEqual(serialize.dumps(e), s)
+
+    def test_file(self):
+        fname = os.path.join(self.path, 'pol.fdd')
+        for name in names:
+            d = translate(name)
+            serialize.dump_file(d, fname)
+            self.assertIs(serialize.load_file(fname), d, name)
+            self.assertIs(serialize.load_file(fname, use_mmap=True), d, name)
+
+    def test_leaves(self):
+        for d in [fdd.id_leaf(), fdd.drop_leaf()]:
+            self.assertIs(serialize.loads(serialize.dumps(d)), d)
+
+    def test_bad_data(self):
+        s = serialize.dumps(translate('get_stateful_firewall_policy'))
+        self.assertRaises(ValueError, serialize.loads, 'X' + s[1:])
+        fname = os.path.join(self.path, 'pol.fdd')
+        for n in [4, 20, len(s) // 2, len(s) - 1]:
+            self.assertRaises(ValueError, serialize.loads, s[:n])
+            f = open(fname, 'wb')
+            f.write(s[:n])
+            f.close()
+            self.assertRaises(ValueError, serialize.load_file, fname)
+            self.assertRaises(ValueError, serialize.load_file, fname, True)
+
+    def test_bad_nodes(self):
+        s = serialize.dumps(translate('get_stateful_firewall_policy'))
+        end = len(s) - serialize.COUNT.size
+        # the root is written last, and its index after it
+        n = serialize.COUNT.unpack_from(s, end)[0] + 1
+        root = end - serialize.NODE.size
+        (t, l, r) = serialize.NODE.unpack_from(s, root)
+        for node in [(t, n - 1, r), (t, l, n + 5), (1 << 20, l, r), 
+                     (-1, 1 << 20, 0), (-2, 0, 0)]:
+            bad = s[:root] + serialize.NODE.pack(*node) + s[end:]
+            self.assertRaises(ValueError, serialize.loads, bad)
+        self.assertIs(serialize.loads(s[:root] + serialize.NODE.pack(t, l, r) + s[end:]), 
+                      serialize.loads(s))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+import itertools
+import unittest
+
+from snap import fdd
+from snap.fdd import Trace, FDDTranslator
+from snap.lang import match
+from tests.util import outputs
+
+# pairs of fields that are far apart in the default order
+pairs = [('vlan_pcp', 'protocol'), ('vlan_id', 'ethtype'), ('tos', 'dstport')]
+
+def pairs_policy(values):
+    pol = None
+    for (f1, f2) in pairs:
+        for v in values:
+            p = match(**{f1 : v, f2 : v})
+            pol = p if pol is None else pol + p
+    return pol
+
+class SiftTest(unittest.TestCase):
+
+    def setUp(self):
+        fdd.reset_tables()
+
+    def tearDown(self):
+        fdd.set_field_rank(dict(fdd.default_field_rank))
+
+    def check_same(self, d1, d2, values):
+        fields = [f for pair in pairs for f in pair]
+        for vals in itertools.product(values, repeat=len(fields)):
+            pkt = dict(zip(fields, vals))
+            self.assertEqual(outputs(d1, pkt), outputs(d2, pkt))
+
+    def test_smaller_and_same(self):
+        d = FDDTranslator.translate(pairs_policy([1]), Trace())
+        size = fdd.dag_size(d)
+        s = fdd.sift(d)
+        self.assertTrue(fdd.dag_size(s) < size)
+        self.assertTrue(fdd.is_ordered(s))
+        order = fdd.tested_fields(s)
+        for (f1, f2) in pairs:
+            self.assertEqual(abs(order.index(f1) - order.index(f2)), 1)
+        self.check_same(d, s, [0, 1])
+        self.assertTrue(fdd.equivalent(d, s))
+
+    def test_set_field_order(self):
+        d = FDDTranslator.translate(pairs_policy([1, 2]), Trace())
+        fdd.set_field_order(['dstport', 'tos', 'ethtype'])
+        self.assertEqual(fdd.tested_fields(d)[:3], ['dstport', 'tos', 'ethtype'])
+        r = fdd.rebuild(d)
+        self.assertTrue(fdd.is_ordered(r))
+        self.assertEqual(fdd.tested_fields(r)[:3], ['dstport', 'tos', 'ethtype'])
+        self.check_same(d, r, [0, 2])
+
+    def test_swap_fields(self):
+        d = FDDTranslator.translate(pairs_policy([1, 2]), Trace())
+        order = fdd.tested_fields(d)
+        for i in range(len(order) - 1):
+            s = fdd.swap_fields(d, order, i)
+            new_order = order[:i] + [order[i + 1], order[i]] + order[i + 2:]
+            fdd.set_field_order(new_order)
+            self.assertTrue(fdd.is_ordered(s))
+            self.assertEqual(fdd.tested_fields(s), new_order)
+            self.assertTrue(s is fdd.rebuild(d))
+            fdd.set_field_order(order)
+
+    def test_keeps_order_if_not_smaller(self):
+        # already in the best order
+        d = FDDTranslator.translate(match(vlan_pcp=1, protocol=1) + 
+                                    match(vlan_pcp=2), Trace())
+        ranks = dict(fdd.field_rank)
+        cache = fdd.op_caches['restrict']
+        size = len(cache.table)
+        self.assertTrue(size > 0)
+        self.assertTrue(fdd.sift(d) is d)
+        self.assertEqual(fdd.field_rank, ranks)
+        self.assertEqual(len(cache.table), size)
+
+if __name__ == '__main__':
+    unittest.main()
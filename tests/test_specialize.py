@@ -0,0 +1,78 @@
+import unittest
+
+from snap import fdd
+from snap.fdd import Trace, FDDTranslator
+from snap.lang import match, modify, if_, drop
+from tests.util import outputs
+
+def translate(pol):
+    return FDDTranslator.translate(pol, Trace())
+
+def by_inport():
+    return if_(match(inport=1), modify(outport=2),
+               if_(match(inport=2), match(srcport=5) >> modify(outport=1),
+                   if_(match(inport=4), modify(outport=3), drop)))
+
+class SpecializeTest(unittest.TestCase):
+
+    def setUp(self):
+        fdd.reset_tables()
+
+    def check_same(self, d, spec):
+        for (i, s) in spec.items():
+            self.assertFalse('inport' in fdd.tested_fields(s))
+            for port in [4, 5, 6]:
+                pkt = {'inport' : i, 'srcport' : port, 'outport' : 0}
+                self.assertEqual(outputs(s, pkt), outputs(d, pkt))
+
+    def test_inports(self):
+        d = translate(by_inport())
+        spec = fdd.specialize_inports(d, [1, 2, 3])
+        self.check_same(d, spec)
+        self.assertIs(spec[1], translate(modify(outport=2)))
+        self.assertIs(spec[3], fdd.drop_leaf())
+        self.assertIs(fdd.specialize_inports(d, [2])[2], spec[2])
+
+    def test_switch(self):
+        d = translate(by_inport())
+        s = fdd.to_switches(d, 2)
+        self.assertTrue(any([isinstance(x, fdd.Switch) for x in fdd.preorder(s)]))
+        spec = fdd.specialize_inports(s, [1, 2, 3, 4])
+        self.check_same(d, spec)
+        self.assertEqual(spec, fdd.specialize_inports(d, [1, 2, 3, 4]))
+
+    def test_assumptions(self):
+        d = translate(by_inport())
+        assump = translate(if_(match(inport=2), match(srcport=5), drop) + 
+                           ~match(inport=2))
+        spec = fdd.specialize_inports(d, [1, 2], assump)
+        self.assertIs(spec[2], translate(modify(outport=1)))
+        self.assertIs(spec[1], translate(modify(outport=2)))
+
+    def test_ids(self):
+        d = translate(by_inport())
+        fdd.asgn_id(d, 0)
+        spec = fdd.specialize_inports(d, [1, 2, 3])
+        ids = [x.id for s in spec.values() for x in fdd.preorder(s)]
+        self.assertFalse(None in ids)
+        nodes = set([x for s in spec.values() for x in fdd.preorder(s)] + 
+                    list(fdd.preorder(d)))
+        self.assertEqual(len(set([x.id for x in nodes])), len(nodes))
+
+    def test_ids_across_assumptions(self):
+        # both specializations to inport 2 have new nodes
+        d = translate(if_(match(inport=2), match(srcport=5, dstport=7) >> modify(outport=1),
+                          modify(outport=2)))
+        fdd.asgn_id(d, 0)
+        assump = translate(if_(match(inport=2), match(dstport=7), drop) + 
+                           ~match(inport=2))
+        nodes = set(fdd.preorder(d))
+        for a in [assump, None, assump]:
+            for s in fdd.specialize_inports(d, [1, 2, 3, 4], a).values():
+                nodes.update(fdd.preorder(s))
+        ids = [x.id for x in nodes]
+        self.assertFalse(None in ids)
+        self.assertEqual(len(set(ids)), len(nodes))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+import shutil
+import tempfile
+import unittest
+
+import networkx as nx
+
+from snap import fdd, policies, stateful
+from snap.cache import CompileCache
+from tests.util import quiet
+
+def topology(ports):
+    g = nx.Graph()
+    for p in ports:
+        g.add_node('p%d' % p, edge_in=True, edge_out=True)
+    g.add_node('s1', edge_in=False, edge_out=False)
+    for p in ports:
+        g.add_edge('p%d' % p, 's1', c=10)
+    traffic = dict([(('p%d' % a, 'p%d' % b), 1) for a in ports for b in ports])
+    return (g, traffic)
+
+def compile_to_req(pol, assump, ports, **kwargs):
+    (g, traffic) = topology(ports)
+    return quiet(stateful.compile_to_req, pol, assump, list(ports), g, traffic, **kwargs)
+
+class CompileCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.cache = CompileCache(self.path)
+        self.settings = stateful.fdd_settings()
+        ports = range(1, 4)
+        (routing, self.assump) = policies.get_route_and_assump_policy(ports)
+        self.pol = quiet(policies.get_stateful_firewall_policy, ports) >> routing
+        self.ports = ports
+
+    def tearDown(self):
+        (fdd.prune_translated, fdd.sift_threshold, fdd.switch_min_cases) = self.settings
+        shutil.rmtree(self.path, True)
+
+    def compile(self):
+        return compile_to_req(self.pol, self.assump, self.ports, cache=self.cache)
+
+    def test_hit(self):
+        first = self.compile()
+        hits = self.cache.hits
+        second = self.compile()
+        self.assertEqual(self.cache.hits, hits + 3)
+        self.assertEqual(first[0], second[0])
+
+    def test_settings_change_key(self):
+        self.compile()
+        for (name, value) in [('prune_translated', False), ('sift_threshold', 1),
+                              ('switch_min_cases', None)]:
+            old = getattr(fdd, name)
+            setattr(fdd, name, value)
+            misses = self.cache.misses
+            self.compile()
+            # st_dep is shared, pol_fdd and st_req are not
+            self.assertEqual(self.cache.misses, misses + 2, name)
+            setattr(fdd, name, old)
+
+class ResultTest(unittest.TestCase):
+
+    def test_returns_assumptions(self):
+        ports = range(1, 4)
+        (routing, assump) = policies.get_route_and_assump_policy(ports)
+        pol = quiet(policies.get_stateful_firewall_policy, ports) >> routing
+        res = compile_to_req(pol, assump, ports)
+        # FDDs are hash-consed, the same translation is the same node
+        self.assertTrue(res[-1] is fdd.FDDTranslator.translate(assump, fdd.Trace()))
+
+class InstrumentationTest(unittest.TestCase):
+
+    def setUp(self):
+        ports = range(1, 4)
+        (routing, self.assump) = policies.get_route_and_assump_policy(ports)
+        self.pol = quiet(policies.get_stateful_firewall_policy, ports) >> routing
+
+    def test_stats(self):
+        stats = {}
+        compile_to_req(self.pol, self.assump, range(1, 4), stats=stats)
+        self.assertTrue(len(stats) > 0)
+        self.assertEqual(fdd.uninstrumented, {})
+
+    def test_turned_off_on_error(self):
+        # no ports fails in revise_st_req, after the translation
+        self.assertRaises(ValueError, compile_to_req, self.pol,
+                          self.assump, [], stats={})
+        self.assertEqual(fdd.uninstrumented, {})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,202 @@
+import random
+import unittest
+
+from snap import fdd
+from snap.fdd import Trace, FDDTranslator
+from snap.lang import match, modify, if_, drop
+from ipaddr import IPv4Network
+from tests.util import outputs
+
+def state(T):
+    return (dict(T.parent), dict([(f, r) for (f, r) in T.rank.items() if r > 0]),
+            dict(T.value),
+            dict([(f, set(vs)) for (f, vs) in T.neq_dict.items() if len(vs) > 0]))
+
+class TraceTest(unittest.TestCase):
+
+    def test_equality_classes(self):
+        T = Trace()
+        T.add_equality('srcport', 'dstport')
+        T.add_equality('tos', 'protocol')
+        self.assertEqual(T.equal_field('srcport', 'tos'), Trace.BOTH)
+        T.add_equality(80, 'protocol')
+        T.add_equality('dstport', 'tos')
+        self.assertEqual(T.equal_field('srcport', 'protocol'), Trace.EQ)
+        self.assertEqual(T.equal_value('srcport', 80), Trace.EQ)
+        self.assertEqual(T.equal_value('srcport', 81), Trace.NEQ)
+        self.assertEqual(T.fmap, dict([(f, 80) for f in 
+                                       ['srcport', 'dstport', 'tos', 'protocol']]))
+        self.assertRaises(fdd.ContradictionError, T.add_equality, 'srcport', 81)
+        self.assertRaises(fdd.ContradictionError, T.add_inequality, 'tos', 'srcport')
+
+    def test_inequalities(self):
+        T = Trace()
+        T.add_inequality('srcport', 'dstport')
+        T.add_inequality('srcport', 5)
+        self.assertEqual(T.equal_field('srcport', 'dstport'), Trace.NEQ)
+        self.assertEqual(T.equal_value('srcport', 5), Trace.NEQ)
+        self.assertRaises(fdd.ContradictionError, T.add_equality, 'srcport', 'dstport')
+
+    def test_prefixes(self):
+        T = Trace()
+        T['dstip'] = IPv4Network('10.0.0.0/24')
+        self.assertEqual(T.equal_value('dstip', IPv4Network('10.0.0.0/16')), Trace.EQ)
+        self.assertEqual(T.equal_value('dstip', IPv4Network('10.0.0.1')), Trace.BOTH)
+        self.assertEqual(T.equal_value('dstip', IPv4Network('10.0.1.0/24')), Trace.NEQ)
+        T['dstip'] = IPv4Network('10.0.0.1')
+        self.assertEqual(T['dstip'], IPv4Network('10.0.0.1'))
+        T = Trace()
+        T.add_inequality('dstip', IPv4Network('10.0.0.0/24'))
+        self.assertEqual(T.equal_value('dstip', IPv4Network('10.0.0.1')), Trace.NEQ)
+
+    def test_rollback(self):
+        T = Trace()
+        T.add_equality('srcport', 'dstport')
+        T.add_inequality('tos', 3)
+        before = state(T)
+        mark = T.checkpoint()
+        T.add_equality('tos', 'protocol')
+        T.add_equality('protocol', 'srcport')
+        T.add_equality('dstport', 7)
+        T.add_inequality('ethtype', 'vlan_id')
+        T.add_inequality('dstip', IPv4Network('10.0.0.0/8'))
+        T.find('tos')
+        self.assertNotEqual(state(T), before)
+        T.rollback(mark)
+        self.assertEqual(state(T), before)
+        self.assertEqual(T.equal_field('srcport', 'dstport'), Trace.EQ)
+        self.assertEqual(T.equal_field('srcport', 'tos'), Trace.BOTH)
+        self.assertEqual(T.equal_value('dstip', IPv4Network('10.0.0.1')), Trace.BOTH)
+        T.rollback(0)
+        self.assertEqual(state(T), state(Trace()))
+
+    def test_overwrite(self):
+        for (first, second) in [('srcport', 'dstport'), ('dstport', 'srcport')]:
+            T = Trace()
+            T.add_equality('srcport', 'dstport')
+            T.add_equality(first, 'tos')
+            T.add_equality('tos', 80)
+            T.add_inequality('srcport', 'protocol')
+            T.add_inequality('srcport', 7)
+            before = (state(T), T.fingerprint())
+            mark = T.checkpoint()
+            T.overwrite('srcport', 5)
+            self.assertEqual(T.fmap, {'srcport' : 5, 'dstport' : 80, 'tos' : 80})
+            self.assertEqual(T.equal_field('srcport', 'dstport'), Trace.NEQ)
+            self.assertEqual(T.equal_field('srcport', 'protocol'), Trace.BOTH)
+            self.assertEqual(T.equal_field('dstport', 'tos'), Trace.EQ)
+            self.assertEqual(T.equal_value('srcport', 7), Trace.NEQ)
+            expected = Trace()
+            expected.add_equality('tos', 'dstport')
+            expected.add_equality('dstport', 80)
+            expected.add_equality('srcport', 5)
+            self.assertEqual(T.constraints(), expected.constraints())
+            self.assertEqual(T.fingerprint(), expected.fingerprint())
+            T.rollback(mark)
+            self.assertEqual((state(T), T.fingerprint()), before)
+
+    def test_overwrite_pair(self):
+        T = Trace()
+        T.add_equality('srcport', 'dstport')
+        T.add_equality('srcport', 80)
+        T.overwrite('srcport', 5)
+        T.overwrite('dstport', 6)
+        self.assertEqual(T.fmap, {'srcport' : 5, 'dstport' : 6})
+        self.assertEqual(T.eq_classes(), [])
+
+class FingerprintTest(unittest.TestCase):
+
+    def setUp(self):
+        fdd.reset_tables()
+
+    def check_distinct(self, add, f, v1, v2):
+        T1 = Trace()
+        getattr(T1, add)(f, v1)
+        T2 = Trace()
+        getattr(T2, add)(f, v2)
+        self.assertNotEqual(T1.constraints(), T2.constraints())
+        self.assertNotEqual(T1.fingerprint(), T2.fingerprint())
+
+    def test_values_with_equal_hashes(self):
+        # hash(10.0.0.1/32) == hash(10.0.0.0/31) and hash(-1) == hash(-2)
+        (n1, n2) = (IPv4Network('10.0.0.1/32'), IPv4Network('10.0.0.0/31'))
+        self.check_distinct('add_inequality', 'dstip', n1, n2)
+        self.check_distinct('add_equality', 'dstip', n1, n2)
+        self.check_distinct('add_equality', 'srcport', -1, -2)
+        self.check_distinct('add_inequality', 'srcport', -1, -2)
+
+    def test_same_constraints_same_fingerprint(self):
+        T1 = Trace()
+        T1.add_equality('srcport', 'dstport')
+        T1.add_equality('srcport', 80)
+        T2 = Trace()
+        T2.add_equality('dstport', 80)
+        T2.add_equality('dstport', 'srcport')
+        self.assertEqual(T1.fingerprint(), T2.fingerprint())
+
+    def test_rollback_restores_fingerprint(self):
+        T = Trace()
+        T.add_inequality('dstip', IPv4Network('10.0.0.0/31'))
+        before = T.fingerprint()
+        mark = T.checkpoint()
+        T.add_equality('srcport', 3)
+        self.assertNotEqual(T.fingerprint(), before)
+        T.rollback(mark)
+        self.assertEqual(T.fingerprint(), before)
+
+    def test_equal_cache(self):
+        v = IPv4Network('10.0.0.0/32')
+        T1 = Trace()
+        T1.add_equality('dstip', IPv4Network('10.0.0.1/32'))
+        self.assertEqual(T1.equal(['dstip'], [v]), Trace.NEQ)
+        T2 = Trace()
+        T2.add_equality('dstip', IPv4Network('10.0.0.0/31'))
+        self.assertEqual(T2.equal(['dstip'], [v]), Trace.BOTH)
+
+    def test_translation(self):
+        pol = if_(match(srcport=2),
+                  if_(match(dstip='10.0.0.0/31'),
+                      drop,
+                      if_(~match(dstip='10.0.0.4/31'),
+                          ~(match(dstip='10.0.0.4') | match(dstip='10.0.0.0/31')) >>
+                          modify(outport=3),
+                          modify(outport=1))),
+                  modify(outport=3) +
+                  if_(match(dstip='10.0.0.1'),
+                      ~match(dstip='10.0.0.0/31') >> modify(outport=1),
+                      modify(outport=1)))
+        d = FDDTranslator.translate(pol, Trace())
+        pkt = {'dstip' : IPv4Network('10.0.0.0'), 'srcport' : 2, 'outport' : 0}
+        self.assertEqual(outputs(d, pkt), set())
+        pkt['srcport'] = 1
+        self.assertEqual(outputs(d, pkt), set([
+            (('dstip', IPv4Network('10.0.0.0')), ('outport', o), ('srcport', 1))
+            for o in (1, 3)]))
+
+    def test_key_follows_constraints(self):
+        # traces built by random changes (and rollbacks) have the
+        # same fingerprint exactly when they have the same constraints
+        fields = ['srcport', 'dstport', 'tos', 'protocol']
+        r = random.Random(0)
+        keys = {}
+        for _ in range(300):
+            T = Trace()
+            marks = []
+            for _ in range(r.randint(0, 8)):
+                (f, g) = r.sample(fields, 2)
+                e = g if r.random() < 0.5 else r.randint(1, 2)
+                if r.random() < 0.3:
+                    marks.append(T.checkpoint())
+                try:
+                    (T.add_equality if r.random() < 0.5 else T.add_inequality)(f, e)
+                except (fdd.ContradictionError, fdd.RedundentError):
+                    pass
+                if marks and r.random() < 0.2:
+                    T.rollback(marks.pop())
+            c = T.constraints()
+            self.assertEqual(keys.setdefault(T.fingerprint(), c), c)
+        self.assertEqual(len(keys), len(set(keys.values())))
+        self.assertTrue(len(keys) > 50)
+
+if __name__ == '__main__':
+    unittest.main()
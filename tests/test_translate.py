@@ -0,0 +1,166 @@
+import os
+import sys
+import unittest
+
+from snap import fdd, policies
+from snap.fdd import Trace, FDDTranslator
+from snap.lang import match, modify, if_, identity, drop
+from ipaddr import IPv4Network
+from snap.state_dep import st_dep
+from tests.util import outputs
+
+class ActSeqTest(unittest.TestCase):
+
+    def setUp(self):
+        fdd.reset_tables()
+
+    def test_modify_then_filter(self):
+        # seq on the children of the filter goes back through act_seq
+        # with the modified outport already in the trace
+        pol = modify(outport=1) >> (match(dstip='10.0.0.1') + match(srcport=5))
+        d = FDDTranslator.translate(pol, Trace())
+        for (ip, port, out) in [('10.0.0.1', 7, True), ('10.0.0.2', 5, True),
+                                ('10.0.0.2', 7, False)]:
+            pkt = {'dstip' : IPv4Network(ip), 'srcport' : port, 'outport' : 0}
+            res = set()
+            if out:
+                res.add(tuple(sorted(dict(pkt, outport=1).items())))
+            self.assertEqual(outputs(d, pkt), res)
+
+    def test_modify_then_match_modified(self):
+        pol = modify(outport=1) >> (match(outport=1) + match(srcport=5))
+        self.assertIs(FDDTranslator.translate(pol, Trace()),
+                      FDDTranslator.translate(modify(outport=1), Trace()))
+
+    def test_modify_matched_field(self):
+        d = FDDTranslator.translate(match(srcport=6) >> modify(srcport=5) >> 
+                                    match(srcport=5), Trace())
+        self.assertIs(d, FDDTranslator.translate(match(srcport=6) >> modify(srcport=5), 
+                                                 Trace()))
+
+    def test_modify_then_match_both_values(self):
+        pol = (if_(match(srcport=80), modify(srcport=8080), identity) >> 
+               ((match(srcport=8080) >> modify(outport=2)) + 
+                (match(srcport=80) >> modify(outport=1))))
+        d = FDDTranslator.translate(pol, Trace())
+        for (port, res) in [(80, [(8080, 2)]), (8080, [(8080, 2)]), (81, [])]:
+            pkt = {'srcport' : port, 'outport' : 0}
+            self.assertEqual(outputs(d, pkt), set([(('outport', o), ('srcport', p)) 
+                                                   for (p, o) in res]))
+
+    def test_redundant_error(self):
+        T = Trace()
+        T['srcport'] = 5
+        self.assertRaises(fdd.RedundentError, T.__setitem__, 'srcport', 5)
+
+class ReductionTest(unittest.TestCase):
+
+    def setUp(self):
+        fdd.reset_tables()
+        self.balanced = fdd.balanced_reduction
+
+    def tearDown(self):
+        fdd.balanced_reduction = self.balanced
+
+    def translate_both(self, pol):
+        res = []
+        for balanced in [True, False]:
+            fdd.balanced_reduction = balanced
+            res.append(FDDTranslator.translate(pol, Trace()))
+        return res
+
+    def test_parallel(self):
+        pol = match(srcport=1) >> modify(outport=1)
+        for i in range(2, 8):
+            pol = pol + (match(srcport=i) >> modify(outport=i % 3))
+        (balanced, fold) = self.translate_both(pol)
+        self.assertIs(balanced, fold)
+
+    def test_sequential(self):
+        pol = match(dstport=7)
+        for i in range(1, 6):
+            pol = pol >> if_(match(srcport=i), modify(outport=i), match(srcport=i + 1))
+        (balanced, fold) = self.translate_both(pol)
+        self.assertIs(balanced, fold)
+
+    def test_order_kept(self):
+        pol = modify(outport=1) >> modify(outport=2) >> match(outport=1)
+        (balanced, fold) = self.translate_both(pol)
+        self.assertIs(balanced, fdd.drop_leaf())
+        self.assertIs(fold, balanced)
+
+class ParallelTest(unittest.TestCase):
+
+    def setUp(self):
+        fdd.reset_tables()
+        self.state_rank = fdd.state_rank
+
+    def tearDown(self):
+        fdd.state_rank = self.state_rank
+
+    def test_same_fdd(self):
+        ports = range(1, 5)
+        (routing, _) = policies.get_route_and_assump_policy(ports)
+        out = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+        try:
+            for pol in [policies.get_stateful_firewall_policy(ports) + routing,
+                        if_(match(srcport=5), modify(outport=1), routing),
+                        policies.get_tcp_state_machine_policy(ports) >> routing]:
+                (_, _, fdd.state_rank) = st_dep(pol)
+                fdd.reset_tables()
+                d = FDDTranslator.translate(pol, Trace())
+                self.assertIs(FDDTranslator.translate_parallel(pol, Trace(), 2), d)
+        finally:
+            sys.stdout.close()
+            sys.stdout = out
+
+class PrefixTest(unittest.TestCase):
+
+    def setUp(self):
+        fdd.reset_tables()
+        self.pol = (if_(match(dstip='10.0.0.0/16'), 
+                        if_(match(dstip='10.0.1.0/24'), modify(outport=1), 
+                            modify(outport=2)),
+                        if_(match(dstip='10.1.0.5'), modify(outport=3), drop)) +
+                    (match(dstip='10.0.1.128/25') >> modify(outport=4)) +
+                    (~match(dstip='10.0.0.0/8') >> modify(outport=5)))
+
+    def expected(self, ip):
+        res = set()
+        if ip in IPv4Network('10.0.0.0/16'):
+            res.add(1 if ip in IPv4Network('10.0.1.0/24') else 2)
+        elif ip == IPv4Network('10.1.0.5'):
+            res.add(3)
+        if ip in IPv4Network('10.0.1.128/25'):
+            res.add(4)
+        if not ip in IPv4Network('10.0.0.0/8'):
+            res.add(5)
+        return res
+
+    def test_semantics(self):
+        d = FDDTranslator.translate(self.pol, Trace())
+        for ip in ['10.0.0.1', '10.0.1.0', '10.0.1.127', '10.0.1.128', '10.0.1.255',
+                   '10.0.2.0', '10.0.255.255', '10.1.0.5', '10.1.0.4', '11.0.0.0', 
+                   '9.255.255.255']:
+            pkt = {'dstip' : IPv4Network(ip), 'outport' : 0}
+            res = set([dict(x)['outport'] for x in outputs(d, pkt)])
+            self.assertEqual(res, self.expected(IPv4Network(ip)), ip)
+
+    def test_no_decided_tests(self):
+        # no test on a path is decided by the tests above it
+        d = FDDTranslator.translate(self.pol, Trace())
+        stack = [(d, [])]
+        while stack:
+            (x, path) = stack.pop()
+            if isinstance(x, fdd.Leaf):
+                continue
+            T = Trace()
+            for (t, holds) in path:
+                (T.add_equality if holds else T.add_inequality)(t.lh, t.rh)
+            self.assertEqual(T.equal_value(x.test.lh, x.test.rh), Trace.BOTH, x.test)
+            stack.append((x.lchild, path + [(x.test, True)]))
+            stack.append((x.rchild, path + [(x.test, False)]))
+
+if __name__ == '__main__':
+    unittest.main()
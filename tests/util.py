@@ -0,0 +1,32 @@
+from snap import fdd
+from ipaddr import IPv4Network
+import os
+import sys
+
+def outputs(d, pkt):
+    ''' the packets the translated stateless FDD d makes of pkt '''
+    while not isinstance(d, fdd.Leaf):
+        t = d.test
+        v = pkt[t.lh]
+        holds = v in t.rh if isinstance(t.rh, IPv4Network) else v == t.rh
+        d = d.lchild if holds else d.rchild
+    res = set()
+    for act_seq in d.act_set:
+        out = dict(pkt)
+        if fdd.drop_action in act_seq:
+            continue
+        for a in act_seq:
+            if a != fdd.id_action:
+                out[a.lh] = a.rh
+        res.add(tuple(sorted(out.items())))
+    return res
+
+def quiet(f, *args, **kwargs):
+    ''' calls f without its prints '''
+    out = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        return f(*args, **kwargs)
+    finally:
+        sys.stdout.close()
+        sys.stdout = out